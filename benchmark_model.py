@@ -0,0 +1,145 @@
+import argparse
+import os
+import time
+from datetime import datetime
+
+import pandas as pd
+import torch
+import torch.nn as nn
+import yaml
+
+from models import *  # For loading classes specified in config
+from models.legacy import *  # For loading classes specified in config
+
+
+def run_model(model: nn.Module, x: torch.Tensor, model_kwargs: dict, backward: bool):
+    """
+    One forward pass and if backward is true a backward pass of the sum of the outputs
+    """
+    with torch.set_grad_enabled(backward):
+        out = model(x, **model_kwargs)
+        if backward:
+            out.sum().backward()
+            model.zero_grad(set_to_none=True)
+
+
+def measure(model: nn.Module, batch_size: int, length: int, embeddings_dim: int, args, device: torch.device) -> dict:
+    """
+    Measure time and memory of the model on random inputs
+    Args:
+        model: model to benchmark
+        batch_size: number of sequences in the batch
+        length: length of every sequence in the batch
+        embeddings_dim: dimension of the input embeddings
+        args: benchmark arguments
+        device: device on which the model is
+
+    Returns:
+        dictionary with the milliseconds per iteration, the memory of the tensors saved for the backward pass and the
+        peak memory of the cuda allocator
+    """
+    if args.per_residue:
+        x = torch.randn(batch_size, embeddings_dim, length, device=device)
+    else:
+        x = torch.randn(batch_size, embeddings_dim, device=device)
+    lengths = torch.full((batch_size,), length, device=device)
+    model_kwargs = {'mask': torch.arange(length, device=device)[None, :] < lengths[:, None],
+                    'sequence_lengths': lengths[:, None],
+                    'frequencies': torch.zeros(batch_size, 25, device=device)}
+
+    for _ in range(args.warmup):
+        run_model(model, x, model_kwargs, args.backward)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        run_model(model, x, model_kwargs, args.backward)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    milliseconds = 1000 * (time.perf_counter() - start) / args.repeats
+
+    saved = {}  # tensors that are kept for the backward pass identified by their storage
+
+    def pack_hook(tensor):
+        saved[(tensor.data_ptr(), tensor.numel(), tensor.dtype)] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda tensor: tensor):
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+        run_model(model, x, model_kwargs, args.backward)
+    cuda_peak_mb = torch.cuda.max_memory_allocated() / 2 ** 20 if device.type == 'cuda' else float('nan')
+    return {'ms_per_iteration': milliseconds,
+            'residues_per_sec': 1000 * batch_size * length / milliseconds,
+            'saved_activations_mb': sum(saved.values()) / 2 ** 20,
+            'cuda_peak_mb': cuda_peak_mb}
+
+
+def benchmark(args):
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    rows = []
+    for variant in args.variants:
+        model_parameters = {**args.model_parameters, **variant.get('model_parameters', {})}
+        embeddings_dim = variant.get('embeddings_dim', args.embeddings_dim)
+        torch.manual_seed(args.seed)
+        # Needs "from models import *" to work
+        model = globals()[variant.get('model_type', args.model_type)](embeddings_dim=embeddings_dim,
+                                                                      **model_parameters).to(device)
+        model.train(args.backward)  # train mode for measuring training and eval mode for measuring inference
+        for batch_size in args.batch_sizes:
+            for length in args.lengths:
+                row = {'variant': variant['name'], 'embeddings_dim': embeddings_dim, 'batch_size': batch_size,
+                       'length': length}
+                try:
+                    row.update(measure(model, batch_size, length, embeddings_dim, args, device))
+                except RuntimeError as error:  # like the [L, L] attention scores of long sequences on the gpu
+                    if 'out of memory' not in str(error):
+                        raise
+                    model.zero_grad(set_to_none=True)
+                    torch.cuda.empty_cache()
+                    row.update({'ms_per_iteration': float('nan'), 'residues_per_sec': float('nan'),
+                                'saved_activations_mb': float('nan'), 'cuda_peak_mb': float('nan')})
+                print(row)
+                rows.append(row)
+
+    results = pd.DataFrame(rows)
+    print(results.to_string())
+    run_dir = 'runs/benchmark_{}_{}'.format(args.experiment_name, datetime.now().strftime('%d-%m_%H-%M-%S'))
+    os.makedirs(run_dir, exist_ok=True)
+    results.to_csv(os.path.join(run_dir, 'benchmark.csv'), index=False)
+    print('Saved results to {}'.format(os.path.join(run_dir, 'benchmark.csv')))
+    return results
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser()
+    p.add_argument('--config', type=argparse.FileType(mode='r'),
+                   default='configs/benchmark_activation_checkpointing.yaml')
+    p.add_argument('--experiment_name', type=str, default='', help='name that will be added to the runs folder output')
+    p.add_argument('--seed', type=int, default=123, help='seed for the initialization of the models')
+    p.add_argument('--model_type', type=str, default='LightAttention',
+                   help='Classname of one of the models in the models dir')
+    p.add_argument('--model_parameters', type=dict, default={}, help='model parameters shared by all variants')
+    p.add_argument('--variants', type=list, default=[{'name': 'default'}],
+                   help='list of dictionaries with a name and optionally a model_type, model_parameters and '
+                        'embeddings_dim that overwrite the shared ones')
+    p.add_argument('--embeddings_dim', type=int, default=1024, help='dimension of the random input embeddings')
+    p.add_argument('--per_residue', type=bool, default=True,
+                   help='whether to use per residue inputs [batch_size, embeddings_dim, length] or reduced ones')
+    p.add_argument('--batch_sizes', type=list, default=[16], help='batch sizes to measure')
+    p.add_argument('--lengths', type=list, default=[1000], help='sequence lengths to measure')
+    p.add_argument('--backward', type=bool, default=True,
+                   help='measure forward and backward pass in train mode or only the forward pass in eval mode')
+    p.add_argument('--warmup', type=int, default=2, help='iterations before the time is measured')
+    p.add_argument('--repeats', type=int, default=5, help='iterations over which the time is averaged')
+    args = p.parse_args()
+    if args.config:
+        data = yaml.load(args.config, Loader=yaml.FullLoader)
+        arg_dict = args.__dict__
+        for key, value in data.items():
+            arg_dict[key] = value
+    return args
+
+
+if __name__ == '__main__':
+    benchmark(parse_arguments())
@@ -0,0 +1,156 @@
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import matplotlib.pyplot as plt
+import pandas as pd
+import seaborn as sn
+import yaml
+
+
+def batching_mode(train_arguments: dict) -> str:
+    """
+    Returns:
+        short description of how the batches of the run were built
+    """
+    if train_arguments.get('in_memory'):
+        mode = 'in_memory'
+    elif train_arguments.get('crop_length', 0) > 0:
+        mode = 'crop_{}_{}'.format(train_arguments['crop_mode'], train_arguments['crop_length'])
+    else:
+        mode = 'padded'
+    if train_arguments.get('memory_guard'):
+        mode += '_guarded'
+    return '{}_bs{}'.format(mode, train_arguments['batch_size'])
+
+
+def time_to_target(curve: pd.DataFrame, column: str, target: float) -> float:
+    """
+    Returns:
+        seconds of the first validation event at which column reached target or nan if it was never reached
+    """
+    reached = curve[curve[column] >= target]
+    return reached['seconds'].iloc[0] if len(reached) > 0 else float('nan')
+
+
+def run_variant(variant: dict, args, run_dir: str, repeat: int) -> dict:
+    """
+    Train the variant with train.py in its own process and collect its settings and validation curve
+    Args:
+        variant: dictionary with a name and the training arguments that overwrite the shared ones
+        args: harness arguments
+        run_dir: directory of the harness run into which the config of the variant is written
+        repeat: index of the repetition of the variant
+
+    Returns:
+        dictionary with the summary row of the variant and its validation curve
+    """
+    experiment_name = 'tta_{}_{}_{}'.format(variant['name'], repeat, os.path.basename(run_dir))
+    with open(args.train_config, 'r') as file:
+        train_config = yaml.load(file, Loader=yaml.FullLoader)
+    train_config.update(args.train_overrides)
+    train_config.update(variant.get('train_overrides', {}))
+    train_config['experiment_name'] = experiment_name
+    config_path = os.path.join(run_dir, '{}_{}.yaml'.format(variant['name'], repeat))
+    with open(config_path, 'w') as file:
+        yaml.dump(train_config, file)
+
+    env = dict(os.environ)
+    if train_config.get('num_threads', 0) > 0:  # also limit the threads of numpy and the interop pool of torch
+        env['OMP_NUM_THREADS'] = env['MKL_NUM_THREADS'] = str(train_config['num_threads'])
+    start = time.time()
+    process = subprocess.run([sys.executable, 'train.py', '--config', config_path], env=env)
+    process_seconds = time.time() - start
+    if process.returncode != 0:
+        print('Variant {} failed with return code {}'.format(variant['name'], process.returncode))
+        return {'row': {'variant': variant['name'], 'repeat': repeat, 'failed': True}, 'curve': pd.DataFrame()}
+
+    train_run_dir = sorted(glob.glob(os.path.join('runs', '*_{}_*'.format(experiment_name))))[-1]
+    curve = pd.read_json(os.path.join(train_run_dir, 'validation.jsonl'), lines=True)
+    with open(os.path.join(train_run_dir, 'run_settings.json'), 'r') as file:
+        settings = json.load(file)
+    with open(os.path.join(train_run_dir, 'train_arguments.yaml'), 'r') as file:
+        train_arguments = yaml.load(file, Loader=yaml.FullLoader)
+
+    row = {'variant': variant['name'], 'repeat': repeat, 'failed': False, 'model_type': train_arguments['model_type'],
+           'batching': batching_mode(train_arguments), **settings,
+           'process_seconds': process_seconds, 'train_seconds': curve['seconds'].iloc[-1],
+           'validation_events': len(curve), 'best_val_acc': curve['val_acc'].max(),
+           'best_val_mcc': curve['val_mcc'].max()}
+    for target in args.targets.get('accuracy', []):
+        row['seconds_to_acc_{}'.format(target)] = time_to_target(curve, 'val_acc', target)
+    for target in args.targets.get('mcc', []):
+        row['seconds_to_mcc_{}'.format(target)] = time_to_target(curve, 'val_mcc', target)
+    row['train_run_dir'] = train_run_dir
+    curve.insert(0, 'variant', variant['name'])
+    curve.insert(1, 'repeat', repeat)
+    return {'row': row, 'curve': curve}
+
+
+def plot_curves(curves: pd.DataFrame, targets: dict, path: str):
+    """
+    Plot the val accuracy and MCC of all variants against the training time with the targets as horizontal lines
+    """
+    sn.set_style('darkgrid')
+    fig, ax = plt.subplots(1, 2, figsize=(15, 6.5))
+    for i, (column, key, title) in enumerate([('val_acc', 'accuracy', 'Val accuracy'), ('val_mcc', 'mcc', 'Val MCC')]):
+        sn.lineplot(data=curves, x='seconds', y=column, hue='variant', units='repeat', estimator=None, ax=ax[i])
+        for target in targets.get(key, []):
+            ax[i].axhline(target, color='grey', linestyle='--')
+        ax[i].set_title(title + ' against training time')
+        ax[i].set(xlabel='seconds', ylabel=column)
+    plt.tight_layout()
+    fig.savefig(path)
+
+
+def benchmark(args):
+    run_dir = 'runs/time_to_accuracy_{}_{}'.format(args.experiment_name, datetime.now().strftime('%d-%m_%H-%M-%S'))
+    os.makedirs(run_dir, exist_ok=True)
+    rows = []
+    curves = []
+    for repeat in range(args.repeats):
+        for variant in args.variants:
+            result = run_variant(variant, args, run_dir, repeat)
+            rows.append(result['row'])
+            curves.append(result['curve'])
+            summary = pd.DataFrame(rows)
+            summary.to_csv(os.path.join(run_dir, 'summary.csv'), index=False)
+    curves = pd.concat(curves, ignore_index=True)
+    curves.to_csv(os.path.join(run_dir, 'curves.csv'), index=False)
+    if len(curves) > 0:
+        plot_curves(curves, args.targets, os.path.join(run_dir, 'curves.png'))
+    print(summary.to_string())
+    print('Saved results to {}'.format(run_dir))
+    return summary
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser()
+    p.add_argument('--config', type=argparse.FileType(mode='r'), default='configs/time_to_accuracy.yaml')
+    p.add_argument('--experiment_name', type=str, default='', help='name that will be added to the runs folder output')
+    p.add_argument('--train_config', type=str, default='configs/light_attention.yaml',
+                   help='training config that is shared by all variants')
+    p.add_argument('--train_overrides', type=dict, default={'eval_on_test': False},
+                   help='training arguments that overwrite the ones of the train_config for all variants such as the '
+                        'data paths to make sure every variant is trained on the same data')
+    p.add_argument('--variants', type=list, default=[{'name': 'default'}],
+                   help='list of dictionaries with a name and optionally train_overrides')
+    p.add_argument('--targets', type=dict, default={'accuracy': [80]},
+                   help='dictionary with lists of targets for the keys [accuracy, mcc]. Accuracy is in percent')
+    p.add_argument('--repeats', type=int, default=1, help='number of times every variant is trained')
+    args = p.parse_args()
+    if args.config:
+        data = yaml.load(args.config, Loader=yaml.FullLoader)
+        arg_dict = args.__dict__
+        for key, value in data.items():
+            arg_dict[key] = value
+    return args
+
+
+if __name__ == '__main__':
+    benchmark(parse_arguments())
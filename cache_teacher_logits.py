@@ -0,0 +1,168 @@
+import argparse
+import os
+from typing import Tuple
+
+import h5py
+import numpy as np
+import torch
+import yaml
+from Bio import SeqIO
+from tqdm import tqdm
+
+from models import *  # For loading classes specified in config
+from models.legacy import *  # For loading classes specified in config
+from datasets.transforms import ProjectEmbeddings
+from utils.general import LOCALIZATION, AMINO_ACIDS
+
+
+def read_corpus(remapping: str, key_format: str) -> list:
+    """
+    Read the proteins of a fasta file whose headers may or may not contain localization and solubility labels
+    Args:
+        remapping: fasta file with the keys of the proteins in the embeddings file
+        key_format: the formatting of the keys in the h5 file [fasta_descriptor_old, fasta_descriptor, hash]
+
+    Returns:
+        list of dictionaries with id, sequence, localization (-1 if unknown) and solubility ('U' if unknown)
+    """
+    proteins = []
+    for record in SeqIO.parse(open(remapping), 'fasta'):
+        fields = record.description.split(' ')
+        if key_format == 'hash':
+            label = fields[2] if len(fields) > 2 else ''
+            id = str(record.id)
+        elif key_format == 'fasta_descriptor':
+            label = fields[1] if len(fields) > 1 else ''
+            id = str(record.description).replace('.', '_').replace('/', '_')
+        elif key_format == 'fasta_descriptor_old':
+            label = fields[1] if len(fields) > 1 else ''
+            id = str(record.description)
+        else:
+            raise ValueError('Unknown key_format: {}'.format(key_format))
+        localization, solubility = label.split('-')[0], label.split('-')[-1]
+        known = localization in LOCALIZATION
+        proteins.append({'id': id, 'sequence': str(record.seq),
+                         'localization': LOCALIZATION.index(localization) if known else -1,
+                         'solubility': solubility if known and solubility in ['M', 'S'] else 'U'})
+    return proteins
+
+
+def load_teacher(args, device: torch.device) -> Tuple[torch.nn.Module, ProjectEmbeddings]:
+    """
+    Returns:
+        the model of the checkpoint in eval mode and the projection of its input embeddings or None if it was trained
+        on the original embeddings. LightAttention models are run packed such that the logits of a protein do not
+        depend on the other proteins in its batch and with the chunk_size of args
+    """
+    with open(os.path.join(args.checkpoint, 'train_arguments.yaml'), 'r') as file:
+        train_arguments = yaml.load(file, Loader=yaml.FullLoader)
+    checkpoint = torch.load(os.path.join(args.checkpoint, 'checkpoint.pt'), map_location=device)
+    model_parameters = train_arguments['model_parameters']
+    # Needs "from models import *" to work
+    model_class = globals()[train_arguments['model_type']]
+    if issubclass(model_class, LightAttention):
+        model_parameters = {**model_parameters, 'packed': True, 'chunk_size': args.chunk_size}
+    projection = None
+    embeddings_dim = args.embeddings_dim
+    if train_arguments.get('projection'):
+        projection = ProjectEmbeddings(train_arguments['projection'])
+        embeddings_dim = projection.components.shape[0]
+    model = model_class(embeddings_dim=embeddings_dim, **model_parameters)
+    model.load_state_dict(checkpoint['model_state_dict'])
+    return model.to(device).eval(), projection
+
+
+def cache_teacher_logits(args):
+    """
+    Run the teacher once over the per residue embeddings of all corpora and save the mean pooled embeddings, the logits
+    of the teacher and the labels (if they are known) to args.output for training a student with the DistillationLoss
+    """
+    device = torch.device(args.device or ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    proteins = []
+    embeddings_files = []
+    for corpus in args.corpora:
+        embeddings_file = h5py.File(corpus['embeddings'], 'r')
+        embeddings_files.append(embeddings_file)
+        for protein in read_corpus(corpus['remapping'], corpus.get('key_format', args.key_format)):
+            if protein['id'] in embeddings_file:
+                proteins.append({**protein, 'embeddings_file': embeddings_file})
+    if args.exclude:  # make sure that no protein of the val or test set ends up in the training data of the student
+        excluded = {str(record.seq) for path in args.exclude for record in SeqIO.parse(open(path), 'fasta')}
+        proteins = [protein for protein in proteins if protein['sequence'] not in excluded]
+    args.embeddings_dim = proteins[0]['embeddings_file'][proteins[0]['id']].shape[-1]
+    teacher, projection = load_teacher(args, device)
+
+    # sort by length such that the batches contain proteins of similar length
+    order = sorted(range(len(proteins)), key=lambda i: len(proteins[i]['sequence']))
+    pooled = np.zeros((len(proteins), args.embeddings_dim), dtype=np.float32)
+    teacher_logits = None
+    with torch.no_grad():
+        for start in tqdm(range(0, len(order), args.batch_size)):
+            indices = order[start:start + args.batch_size]
+            embeddings = [torch.from_numpy(proteins[i]['embeddings_file'][proteins[i]['id']][:]).float()
+                          for i in indices]
+            for i, embedding in zip(indices, embeddings):
+                pooled[i] = embedding.mean(dim=0).numpy()
+            if projection is not None:  # the student is trained on the original embeddings and the teacher is not
+                embeddings = [projection((embedding, 0, 0))[0] for embedding in embeddings]
+            lengths = torch.tensor([len(embedding) for embedding in embeddings], device=device)
+            x = torch.nn.utils.rnn.pad_sequence(embeddings, batch_first=True).permute(0, 2, 1).to(device)
+            mask = torch.arange(lengths.max(), device=device)[None, :] < lengths[:, None]
+            logits = teacher(x, mask=mask, sequence_lengths=lengths[:, None]).cpu().numpy()
+            if teacher_logits is None:
+                teacher_logits = np.zeros((len(proteins), logits.shape[-1]), dtype=np.float32)
+            teacher_logits[indices] = logits
+    for embeddings_file in embeddings_files:
+        embeddings_file.close()
+
+    frequencies = np.zeros((len(proteins), 25), dtype=np.float32)
+    for i, protein in enumerate(proteins):
+        for j, aa in enumerate(AMINO_ACIDS):
+            frequencies[i, j] = protein['sequence'].count(aa)
+        frequencies[i] /= len(protein['sequence'])
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with h5py.File(args.output, 'w') as file:
+        file.create_dataset('ids', data=[protein['id'] for protein in proteins], dtype=h5py.string_dtype())
+        file.create_dataset('embeddings', data=pooled)
+        file.create_dataset('teacher_logits', data=teacher_logits)
+        file.create_dataset('localization', data=np.array([protein['localization'] for protein in proteins]))
+        file.create_dataset('solubility', data=[protein['solubility'] for protein in proteins],
+                            dtype=h5py.string_dtype())
+        file.create_dataset('lengths', data=np.array([len(protein['sequence']) for protein in proteins]))
+        file.create_dataset('frequencies', data=frequencies)
+        file.attrs['teacher'] = args.checkpoint
+    n_labeled = sum(protein['localization'] >= 0 for protein in proteins)
+    print('Cached the teacher logits of {} proteins ({} with localization label) to {}'.format(
+        len(proteins), n_labeled, args.output))
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser()
+    p.add_argument('--config', type=argparse.FileType(mode='r'), default='configs/cache_teacher_logits.yaml')
+    p.add_argument('--checkpoint', type=str, help='run directory of the teacher like a trained LightAttention')
+    p.add_argument('--corpora', type=list, default=[],
+                   help='list of dictionaries with the per residue embeddings, the remapping fasta and optionally the '
+                        'key_format of a corpus. The fasta headers may contain labels like the ones of the train set '
+                        'or none at all for unlabeled proteins')
+    p.add_argument('--exclude', type=list, default=[],
+                   help='fasta files like the ones of the val and test set whose sequences are left out of the cache')
+    p.add_argument('--output', type=str, default='data_files/teacher_logits.h5',
+                   help='h5 file for the pooled embeddings and teacher logits that is used as distillation_cache')
+    p.add_argument('--batch_size', type=int, default=32, help='proteins that are run through the teacher at once')
+    p.add_argument('--chunk_size', type=int, default=0,
+                   help='chunk size of LightAttention teachers to bound the memory for long proteins (0 for off)')
+    p.add_argument('--device', type=str, default=None,
+                   help='device to run the teacher on like cpu or cuda:1 (cuda:0 if it is available by default)')
+    p.add_argument('--key_format', type=str, default='hash',
+                   help='the formatting of the keys in the h5 files [fasta_descriptor_old, fasta_descriptor, hash]')
+    args = p.parse_args()
+    if args.config:
+        data = yaml.load(args.config, Loader=yaml.FullLoader)
+        arg_dict = args.__dict__
+        for key, value in data.items():
+            arg_dict[key] = value
+    return args
+
+
+if __name__ == '__main__':
+    cache_teacher_logits(parse_arguments())
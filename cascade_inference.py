@@ -0,0 +1,221 @@
+import argparse
+import os
+import time
+from datetime import datetime
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+import yaml
+from sklearn.metrics import matthews_corrcoef
+from torch.utils.data import DataLoader
+from torchvision.transforms import transforms
+
+from models import *  # For loading classes specified in config
+from datasets.embeddings_localization_dataset import EmbeddingsLocalizationDataset
+from datasets.transforms import SolubilityToInt, ToTensor, ProjectEmbeddings
+from utils.general import padded_permuted_collate, LOCALIZATION
+
+
+def read_train_arguments(checkpoint: str) -> dict:
+    with open(os.path.join(checkpoint, 'train_arguments.yaml'), 'r') as file:
+        return yaml.load(file, Loader=yaml.FullLoader)
+
+
+def load_model(checkpoint: str, train_arguments: dict, embeddings_dim: int, device: torch.device) -> nn.Module:
+    """
+    Returns:
+        the model of the run directory checkpoint in eval mode
+    """
+    # Needs "from models import *" to work
+    model = globals()[train_arguments['model_type']](embeddings_dim=embeddings_dim,
+                                                     **train_arguments['model_parameters'])
+    checkpoint = torch.load(os.path.join(checkpoint, 'checkpoint.pt'), map_location=device)
+    model.load_state_dict(checkpoint['model_state_dict'])
+    return model.to(device).eval()
+
+
+def load_dataset(embeddings: str, remapping: str, train_arguments: dict, args) -> EmbeddingsLocalizationDataset:
+    """
+    Returns:
+        dataset of the embeddings with the projection that the model of the train_arguments was trained with
+    """
+    transform = [SolubilityToInt(), ToTensor()]
+    if train_arguments.get('projection'):
+        transform.append(ProjectEmbeddings(train_arguments['projection']))
+    return EmbeddingsLocalizationDataset(embeddings, remapping, key_format=args.key_format,
+                                         transform=transforms.Compose(transform))
+
+
+def predict_logits(model: nn.Module, data_set: EmbeddingsLocalizationDataset, batch_size: int,
+                   device: torch.device) -> Tuple[torch.Tensor, float]:
+    """
+    Returns:
+        [n_samples, output_dim] logits of the model for the data_set and the seconds it took including the reads
+    """
+    collate_function = padded_permuted_collate if len(data_set[0][0].shape) == 2 else None
+    data_loader = DataLoader(data_set, batch_size=batch_size, collate_fn=collate_function)
+    logits = []
+    start = time.perf_counter()
+    with torch.no_grad():
+        for embedding, _, _, metadata in data_loader:
+            lengths = metadata['length'].to(device)
+            mask = torch.arange(lengths.max(), device=device)[None, :] < lengths[:, None]
+            logits.append(model(embedding.to(device), mask=mask, sequence_lengths=lengths[:, None],
+                                frequencies=metadata['frequencies'].to(device)).cpu())
+    return torch.cat(logits), time.perf_counter() - start
+
+
+def confidence(logits: torch.Tensor, gate: str) -> np.ndarray:
+    """
+    Args:
+        logits: [n_samples, output_dim] logits of which the first 10 are for the localization
+        gate: [max_probability, margin] the highest softmax probability or the difference between the two highest
+
+    Returns:
+        [n_samples] confidence of the localization predictions
+    """
+    probabilities = torch.softmax(logits[:, :10], dim=-1)
+    top = probabilities.topk(2, dim=-1).values
+    if gate == 'max_probability':
+        return top[:, 0].numpy()
+    elif gate == 'margin':
+        return (top[:, 0] - top[:, 1]).numpy()
+    raise ValueError('Unknown gate: {}'.format(gate))
+
+
+def calibrate_threshold(ffn_confidence: np.ndarray, ffn_correct: np.ndarray, light_attention_correct: np.ndarray,
+                        max_accuracy_drop: float) -> float:
+    """
+    Find the lowest threshold, which routes the fewest proteins to LightAttention, at which the accuracy of the cascade
+    is at most max_accuracy_drop percentage points below the one of LightAttention alone
+    Args:
+        ffn_confidence: [n_samples] confidence of the FFN
+        ffn_correct: [n_samples] whether the FFN prediction is correct
+        light_attention_correct: [n_samples] whether the LightAttention prediction is correct
+
+    Returns:
+        threshold below which proteins are routed to LightAttention
+    """
+    order = np.argsort(-ffn_confidence)  # proteins that stay with the FFN for decreasing thresholds
+    # accuracy of the cascade if the k most confident proteins are kept with the FFN for k = 0, ..., n_samples
+    kept_correct = np.concatenate([[0], np.cumsum(ffn_correct[order])])
+    routed_correct = np.concatenate([[0], np.cumsum(light_attention_correct[order[::-1]])])[::-1]
+    accuracies = 100 * (kept_correct + routed_correct) / len(order)
+    target = 100 * light_attention_correct.mean() - max_accuracy_drop
+    k = np.nonzero(accuracies >= target)[0].max()  # k = 0 always reaches the target
+    if k == 0:
+        return float('inf')
+    if k == len(order):
+        return float('-inf')
+    # between the confidence of the last protein that is kept and the first one that is routed
+    return (ffn_confidence[order[k - 1]] + ffn_confidence[order[k]]) / 2
+
+
+def cascade(args):
+    device = torch.device(args.device or ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    ffn_arguments = read_train_arguments(args.ffn_checkpoint)
+    light_attention_arguments = read_train_arguments(args.light_attention_checkpoint)
+    ffn_set = load_dataset(args.reduced_embeddings, args.remapping, ffn_arguments, args)
+    light_attention_set = load_dataset(args.embeddings, args.remapping, light_attention_arguments, args)
+    ffn = load_model(args.ffn_checkpoint, ffn_arguments, ffn_set[0][0].shape[-1], device)
+    light_attention = load_model(args.light_attention_checkpoint, light_attention_arguments,
+                                 light_attention_set[0][0].shape[-1], device)
+
+    threshold = args.threshold
+    if threshold is None:  # calibrate on a labeled set that is not the one of the evaluation
+        calibration_ffn_set = load_dataset(args.calibration_reduced_embeddings, args.calibration_remapping,
+                                           ffn_arguments, args)
+        calibration_light_attention_set = load_dataset(args.calibration_embeddings, args.calibration_remapping,
+                                                       light_attention_arguments, args)
+        labels = np.array([item['localization'] for item in calibration_ffn_set.localization_solubility_metadata_list])
+        ffn_logits, _ = predict_logits(ffn, calibration_ffn_set, args.batch_size, device)
+        light_attention_logits, _ = predict_logits(light_attention, calibration_light_attention_set,
+                                                   args.batch_size, device)
+        threshold = calibrate_threshold(confidence(ffn_logits, args.gate),
+                                        ffn_logits[:, :10].argmax(dim=-1).numpy() == labels,
+                                        light_attention_logits[:, :10].argmax(dim=-1).numpy() == labels,
+                                        args.max_accuracy_drop)
+        print('Calibrated {} threshold: {}'.format(args.gate, threshold))
+
+    labels = np.array([item['localization'] for item in ffn_set.localization_solubility_metadata_list])
+    ffn_logits, ffn_seconds = predict_logits(ffn, ffn_set, args.batch_size, device)
+    predictions = ffn_logits[:, :10].argmax(dim=-1).numpy()
+    routed = np.nonzero(confidence(ffn_logits, args.gate) < threshold)[0]
+    light_attention_seconds = 0
+    if len(routed) > 0:  # only the per residue embeddings of the routed proteins are read
+        routed_logits, light_attention_seconds = predict_logits(light_attention, light_attention_set.subset(routed),
+                                                                args.batch_size, device)
+        predictions[routed] = routed_logits[:, :10].argmax(dim=-1).numpy()
+    cascade_seconds = ffn_seconds + light_attention_seconds
+
+    row = {'gate': args.gate, 'threshold': threshold, 'n_proteins': len(labels),
+           'routing_fraction': len(routed) / len(labels),
+           'accuracy': 100 * (predictions == labels).mean(), 'mcc': matthews_corrcoef(labels, predictions),
+           'seconds': cascade_seconds, 'proteins_per_sec': len(labels) / cascade_seconds}
+    if args.compare:  # LightAttention on all proteins
+        light_attention_logits, seconds = predict_logits(light_attention, light_attention_set, args.batch_size, device)
+        light_attention_predictions = light_attention_logits[:, :10].argmax(dim=-1).numpy()
+        row.update({'light_attention_accuracy': 100 * (light_attention_predictions == labels).mean(),
+                    'light_attention_mcc': matthews_corrcoef(labels, light_attention_predictions),
+                    'light_attention_seconds': seconds, 'light_attention_proteins_per_sec': len(labels) / seconds,
+                    'agreement_with_light_attention': 100 * (predictions == light_attention_predictions).mean(),
+                    'speedup': seconds / cascade_seconds})
+
+    run_dir = 'runs/cascade_{}_{}'.format(args.experiment_name, datetime.now().strftime('%d-%m_%H-%M-%S'))
+    os.makedirs(run_dir, exist_ok=True)
+    pd.DataFrame([row]).to_csv(os.path.join(run_dir, 'cascade.csv'), index=False)
+    with open(os.path.join(run_dir, 'predictions.txt'), 'w') as file:
+        for prediction in predictions:
+            file.write('%s\n' % LOCALIZATION[prediction])
+    print(pd.Series(row).to_string())
+    print('Saved results to {}'.format(run_dir))
+    return row
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser()
+    p.add_argument('--config', type=argparse.FileType(mode='r'), default='configs/cascade.yaml')
+    p.add_argument('--experiment_name', type=str, default='', help='name that will be added to the runs folder output')
+    p.add_argument('--ffn_checkpoint', type=str, help='run directory of an FFN trained on reduced embeddings')
+    p.add_argument('--light_attention_checkpoint', type=str, help='run directory of a LightAttention')
+    p.add_argument('--reduced_embeddings', type=str, help='.h5 file with the reduced embeddings for the FFN')
+    p.add_argument('--embeddings', type=str, help='.h5 file with the per residue embeddings for LightAttention')
+    p.add_argument('--remapping', type=str, help='fasta file with the keys of both embeddings files')
+    p.add_argument('--gate', type=str, default='max_probability',
+                   help='confidence of the FFN that decides the routing [max_probability, margin]')
+    p.add_argument('--threshold', type=float, default=None,
+                   help='proteins with a confidence below the threshold are routed to LightAttention. If it is None, '
+                        'it is calibrated on the calibration set with max_accuracy_drop')
+    p.add_argument('--max_accuracy_drop', type=float, default=0.5,
+                   help='percentage points of accuracy that the cascade may lose against LightAttention alone on the '
+                        'calibration set')
+    p.add_argument('--calibration_reduced_embeddings', type=str, default=None,
+                   help='.h5 file with the reduced embeddings of the calibration set like the val set')
+    p.add_argument('--calibration_embeddings', type=str, default=None,
+                   help='.h5 file with the per residue embeddings of the calibration set')
+    p.add_argument('--calibration_remapping', type=str, default=None, help='fasta file of the calibration set')
+    p.add_argument('--compare', type=bool, default=True,
+                   help='also run LightAttention on all proteins to report the accuracy and the speedup against it')
+    p.add_argument('--batch_size', type=int, default=16, help='samples that will be processed in parallel')
+    p.add_argument('--device', type=str, default=None,
+                   help='device to run on like cpu or cuda:1 (cuda:0 if it is available by default)')
+    p.add_argument('--num_threads', type=int, default=0,
+                   help='number of threads torch uses for intraop parallelism on cpu (0 for the torch default)')
+    p.add_argument('--key_format', type=str, default='hash',
+                   help='the formatting of the keys in the h5 file [fasta_descriptor_old, fasta_descriptor, hash]')
+    args = p.parse_args()
+    if args.config:
+        data = yaml.load(args.config, Loader=yaml.FullLoader)
+        arg_dict = args.__dict__
+        for key, value in data.items():
+            arg_dict[key] = value
+    return args
+
+
+if __name__ == '__main__':
+    cascade(parse_arguments())
@@ -0,0 +1,137 @@
+import argparse
+
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import yaml
+
+from models.light_attention import LightAttention, MaskedAttentionPool
+
+
+def masked_pool(o: torch.Tensor, attention: torch.Tensor, mask: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Reference masked softmax attention pooling and masked max pooling through autograd that MaskedAttentionPool replaces
+    Args:
+        o: [batch_size, embeddings_dim, sequence_length] features
+        attention: [batch_size, embeddings_dim, sequence_length] attention logits
+        mask: [batch_size, sequence_length] mask that is False for the padding
+
+    Returns:
+        [batch_size, embeddings_dim] attention pooled and [batch_size, embeddings_dim] max pooled features
+    """
+    attention = attention.masked_fill(mask[:, None, :] == False, float('-inf'))
+    max_pooled, _ = torch.max(o.masked_fill(mask[:, None, :] == False, float('-inf')), dim=-1)
+    return torch.sum(o * torch.softmax(attention, dim=-1), dim=-1), max_pooled
+
+
+def random_inputs(batch_size: int, embeddings_dim: int, length: int, kernel_size: int):
+    """
+    Double precision features, embeddings and attention convolution parameters for sequences with random lengths
+    between 1 and length
+    """
+    lengths = torch.randint(1, length + 1, (batch_size,))
+    lengths[0] = length  # at least one sequence without padding
+    mask = torch.arange(length)[None, :] < lengths[:, None]
+    o = torch.randn(batch_size, embeddings_dim, length, dtype=torch.float64, requires_grad=True)
+    x = torch.randn(batch_size, embeddings_dim, length, dtype=torch.float64)
+    x = x.masked_fill(mask[:, None, :] == False, 0).requires_grad_()  # zero padding as in the batches of the loader
+    convolution = nn.Conv1d(embeddings_dim, embeddings_dim, kernel_size, padding=kernel_size // 2).double()
+    return o, x, convolution.weight, convolution.bias, mask
+
+
+def check(args):
+    torch.manual_seed(args.seed)
+    differences = {}
+    padding = args.kernel_size // 2
+    o, x, weight, bias, mask = random_inputs(args.gradcheck_batch_size, args.gradcheck_embeddings_dim,
+                                             args.gradcheck_length, args.kernel_size)
+
+    def fused(o, x, weight, bias):
+        return MaskedAttentionPool.apply(o, x, mask, lambda x: F.conv1d(x, weight, bias, padding=padding), weight,
+                                         bias)
+
+    # raises an error if the analytical gradients of the backward pass do not match the numerical ones
+    torch.autograd.gradcheck(fused, (o, x, weight, bias))
+    print('gradcheck of MaskedAttentionPool passed')
+
+    o, x, weight, bias, mask = random_inputs(args.batch_size, args.embeddings_dim, args.length, args.kernel_size)
+    inputs = (o, x, weight, bias)
+    grad_outputs = (torch.randn(args.batch_size, args.embeddings_dim, dtype=torch.float64),
+                    torch.randn(args.batch_size, args.embeddings_dim, dtype=torch.float64))
+    fused_outputs = fused(*inputs)
+    fused_grads = torch.autograd.grad(fused_outputs, inputs, grad_outputs)
+    reference_outputs = masked_pool(o, F.conv1d(x, weight, bias, padding=padding), mask)
+    reference_grads = torch.autograd.grad(reference_outputs, inputs, grad_outputs)
+    for name, fused_output, reference_output in zip(['attention pooling', 'max pooling'], fused_outputs,
+                                                    reference_outputs):
+        differences[name] = (fused_output - reference_output).abs().max().item()
+    for name, fused_grad, reference_grad in zip(['features', 'embeddings', 'weight', 'bias'], fused_grads,
+                                                reference_grads):
+        differences['gradient of the ' + name] = (fused_grad - reference_grad).abs().max().item()
+
+    # the training pooling of fused_pooling models has the same outputs and parameter gradients as the default pooling
+    # for sequences without padding (the default max pooling includes the padding)
+    x = torch.randn(args.batch_size, args.embeddings_dim, args.length, dtype=torch.float64)
+    full_mask = torch.ones(args.batch_size, args.length, dtype=torch.bool)
+    for fused_convolution in [False, True]:
+        model = LightAttention(embeddings_dim=args.embeddings_dim, kernel_size=args.kernel_size, conv_dropout=0,
+                               fused_convolution=fused_convolution, fused_pooling=True,
+                               **args.model_parameters).double().train()
+        parameters = [parameter for parameter in model.parameters() if parameter.requires_grad]
+        pooled = {}
+        for fused_pooling in [True, False]:
+            model.fused_pooling = fused_pooling
+            output = model.pool(x, full_mask)
+            pooled[fused_pooling] = [output] + list(torch.autograd.grad(output.sum(), parameters, allow_unused=True))
+        name = 'model pooling' + (' with fused_convolution' if fused_convolution else '')
+        differences[name] = max((fused - reference).abs().max().item()
+                                for fused, reference in zip(pooled[True], pooled[False]) if reference is not None)
+
+    # the chunked pooling for long sequences in eval mode has to pool the same as the fused pooling of the whole length
+    model = LightAttention(embeddings_dim=args.embeddings_dim, kernel_size=args.kernel_size, fused_pooling=True,
+                           chunk_size=args.chunk_size, **args.model_parameters).double().eval()
+    x = torch.randn(args.batch_size, args.embeddings_dim, args.length, dtype=torch.float64)
+    with torch.no_grad():
+        chunked = model.chunked_pool(x, mask)
+        model.chunk_size = 0  # pool over the whole length at once
+        differences['chunked pooling'] = (chunked - model.pool(x, mask)).abs().max().item()
+
+    for name, difference in differences.items():
+        print('Maximum absolute difference of the {}: {}'.format(name, difference))
+    failed = [name for name, difference in differences.items() if difference > args.tolerance]
+    if failed:
+        raise ValueError('The fused pooling differs from the masked pooling of autograd by more than the tolerance of '
+                         '{} for: {}'.format(args.tolerance, ', '.join(failed)))
+    print('MaskedAttentionPool matches the masked pooling of autograd')
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser()
+    p.add_argument('--config', type=argparse.FileType(mode='r'), default='configs/check_fused_pooling.yaml')
+    p.add_argument('--seed', type=int, default=123, help='seed for the random inputs and the model initialization')
+    p.add_argument('--gradcheck_batch_size', type=int, default=3, help='batch size of the inputs of the gradcheck')
+    p.add_argument('--gradcheck_embeddings_dim', type=int, default=4,
+                   help='number of channels of the inputs of the gradcheck')
+    p.add_argument('--gradcheck_length', type=int, default=7, help='sequence length of the inputs of the gradcheck')
+    p.add_argument('--batch_size', type=int, default=8, help='batch size of the comparison with the reference')
+    p.add_argument('--embeddings_dim', type=int, default=64, help='number of channels of the comparison')
+    p.add_argument('--length', type=int, default=300, help='sequence length of the comparison')
+    p.add_argument('--kernel_size', type=int, default=9, help='kernel size of the attention convolution')
+    p.add_argument('--chunk_size', type=int, default=64, help='chunk size of the compared chunked pooling')
+    p.add_argument('--model_parameters', type=dict, default={},
+                   help='parameters of the LightAttention model of the chunked pooling comparison')
+    p.add_argument('--tolerance', type=float, default=1e-10,
+                   help='maximum absolute difference to the reference that is accepted')
+    args = p.parse_args()
+    if args.config:
+        data = yaml.load(args.config, Loader=yaml.FullLoader)
+        arg_dict = args.__dict__
+        for key, value in data.items():
+            arg_dict[key] = value
+    return args
+
+
+if __name__ == '__main__':
+    check(parse_arguments())
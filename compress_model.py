@@ -0,0 +1,195 @@
+import argparse
+import os
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Tuple
+
+import matplotlib.pyplot as plt
+import pandas as pd
+import seaborn as sn
+import torch
+import yaml
+
+from models import *  # For loading classes specified in config
+from torch.optim import *  # For loading optimizer specified in config
+from inference import timed_predict
+from models.compressed_light_attention import CompressedLightAttention
+from solver import Solver
+from train import load_datasets, make_loaders, parse_arguments as parse_train_arguments
+
+CONVOLUTIONS = ['feature_convolution', 'attention_convolution']
+
+
+def select_compression(method: str, budget: float, embeddings_dim: int, kernel_size: int) -> Tuple[int, int]:
+    """
+    Choose the rank or the number of channels such that the convolutions need budget times their original MACs
+    Args:
+        method: [low_rank, prune]
+        budget: fraction of the multiply accumulate operations of the original convolutions
+        embeddings_dim: input and output channels of the original convolutions
+        kernel_size: kernel size of the convolutions
+
+    Returns:
+        rank and channels of the CompressedLightAttention (0 for not compressed in that way)
+    """
+    if method == 'low_rank':  # rank * (embeddings_dim * kernel_size + embeddings_dim) MACs per convolution
+        return max(1, int(budget * embeddings_dim * kernel_size / (kernel_size + 1))), 0
+    elif method == 'prune':  # channels * embeddings_dim * kernel_size MACs per convolution
+        return 0, max(1, int(round(budget * embeddings_dim)))
+    raise ValueError('Unknown compression method: {}'.format(method))
+
+
+def channel_importance(state_dict: dict, embeddings_dim: int) -> torch.Tensor:
+    """
+    Importance of every output channel of the convolutions as the norm of its feature convolution filter times the norm
+    of the weights with which the linear layer reads its attention pooled and max pooled feature
+    Returns:
+        [embeddings_dim] importance of every channel
+    """
+    filter_norm = state_dict['feature_convolution.weight'].flatten(1).norm(dim=-1)
+    linear_weight = state_dict['linear.0.weight']  # [32, 2 * embeddings_dim]
+    usage = linear_weight[:, :embeddings_dim].norm(dim=0) + linear_weight[:, embeddings_dim:].norm(dim=0)
+    return filter_norm * usage
+
+
+def low_rank_factors(weight: torch.Tensor, rank: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Factor a convolution weight with a truncated SVD of its [out_channels, in_channels * kernel_size] matrix
+    Args:
+        weight: [out_channels, in_channels, kernel_size] convolution weight
+        rank: number of singular values that are kept
+
+    Returns:
+        [rank, in_channels, kernel_size] weight of the first and [out_channels, rank, 1] weight of the 1x1 convolution
+    """
+    out_channels, in_channels, kernel_size = weight.shape
+    u, s, vh = torch.linalg.svd(weight.reshape(out_channels, -1), full_matrices=False)
+    root = s[:rank].sqrt()
+    first = (root[:, None] * vh[:rank]).reshape(rank, in_channels, kernel_size)
+    second = (u[:, :rank] * root[None, :])[:, :, None]
+    return first.contiguous(), second.contiguous()
+
+
+def compress_state_dict(state_dict: dict, embeddings_dim: int, rank: int, channels: int) -> dict:
+    """
+    Map the state dict of a LightAttention onto a CompressedLightAttention with rank and channels
+    """
+    if channels and channels < embeddings_dim:  # keep the most important channels in their original order
+        keep = channel_importance(state_dict, embeddings_dim).topk(channels).indices.sort().values
+    else:
+        keep = torch.arange(embeddings_dim)
+    compressed = {key: value for key, value in state_dict.items()
+                  if key.split('.')[0] not in CONVOLUTIONS and key != 'linear.0.weight'}
+    for name in CONVOLUTIONS:
+        weight, bias = state_dict[name + '.weight'][keep], state_dict[name + '.bias'][keep]
+        if rank > 0:
+            compressed[name + '.0.weight'], compressed[name + '.1.weight'] = low_rank_factors(weight, rank)
+            compressed[name + '.1.bias'] = bias
+        else:
+            compressed[name + '.weight'], compressed[name + '.bias'] = weight, bias
+    compressed['linear.0.weight'] = state_dict['linear.0.weight'][:, torch.cat([keep, keep + embeddings_dim])]
+    return compressed
+
+
+def compress(args):
+    train_args = parse_train_arguments(['--config', os.path.join(args.checkpoint, 'train_arguments.yaml')])
+    for key, value in args.train_overrides.items():
+        setattr(train_args, key, value)
+    if train_args.model_type != 'LightAttention' or train_args.model_parameters.get('fused_convolution'):
+        raise ValueError('Only LightAttention checkpoints without fused_convolution can be compressed')
+    train_args.config = SimpleNamespace(name=args.config.name)  # copied into the run directories of the variants
+    train_args.eval_on_test = False
+    train_set, val_set = load_datasets(train_args)
+    train_loader, val_loader = make_loaders(train_args, train_set, val_set)
+    embeddings_dim = val_set[0][0].shape[-1]
+    kernel_size = train_args.model_parameters.get('kernel_size', 9)
+
+    # evaluate the original model without an optimizer or a run directory such that its run is only read
+    original_args = SimpleNamespace(**{**vars(train_args), 'checkpoint': None})
+    model = LightAttention(embeddings_dim=embeddings_dim, **train_args.model_parameters)
+    checkpoint = torch.load(os.path.join(args.checkpoint, 'checkpoint.pt'), map_location='cpu')
+    model.load_state_dict(checkpoint['model_state_dict'])
+    # Needs "from models import *" to work
+    solver = Solver(model, original_args, loss_func=globals()[train_args.loss_function], eval=True)
+    original = timed_predict(solver, val_set, train_args)
+    rows = [{'method': 'original', 'budget': 1.0, 'rank': 0, 'channels': embeddings_dim,
+             'conv_macs_per_residue': 2 * embeddings_dim * embeddings_dim * kernel_size,
+             'parameters': sum(p.numel() for p in solver.model.parameters()), **original, 'speedup': 1.0,
+             'run_dir': args.checkpoint}]
+    state_dict = {key: value.cpu() for key, value in solver.model.state_dict().items()}
+
+    run_dir = 'runs/compression_{}_{}'.format(args.experiment_name, datetime.now().strftime('%d-%m_%H-%M-%S'))
+    os.makedirs(run_dir, exist_ok=True)
+    for method in args.methods:
+        for budget in args.budgets:
+            rank, channels = select_compression(method, budget, embeddings_dim, kernel_size)
+            variant_args = SimpleNamespace(**vars(train_args))
+            variant_args.checkpoint = None  # a new run and not the continuation of the one of the original checkpoint
+            variant_args.model_type = 'CompressedLightAttention'
+            variant_args.model_parameters = {**train_args.model_parameters, 'rank': rank, 'channels': channels}
+            variant_args.experiment_name = '{}_{}_{}'.format(args.experiment_name, method, budget)
+            variant_args.num_epochs = args.finetune_epochs
+            if args.finetune_lr:
+                variant_args.optimizer_parameters = {**train_args.optimizer_parameters, 'lr': args.finetune_lr}
+            model = CompressedLightAttention(embeddings_dim=embeddings_dim, **variant_args.model_parameters)
+            model.load_state_dict(compress_state_dict(state_dict, embeddings_dim, rank, channels))
+            # Needs "from torch.optim import *" and "from models import *" to work
+            solver = Solver(model, variant_args, globals()[variant_args.optimizer],
+                            globals()[variant_args.loss_function], weight=train_set.class_weights)
+            compressed = timed_predict(solver, val_set, variant_args)
+            # fine-tuning only replaces the checkpoint if it improves the val accuracy of the early stopping target
+            solver.max_val_acc = compressed['sol_accuracy'] if variant_args.target == 'sol' else \
+                compressed['loc_accuracy']
+            solver.save_checkpoint(0)
+            with open(os.path.join(solver.writer.log_dir, 'epoch.txt'), 'w') as file:
+                file.write('0')
+            if args.finetune_epochs > 0:
+                solver.train(train_loader, val_loader)
+                solver.best_checkpoint_metrics(val_loader)  # loads the best checkpoint
+            result = timed_predict(solver, val_set, variant_args)
+            rows.append({'method': method, 'budget': budget, 'rank': rank, 'channels': channels or embeddings_dim,
+                         'conv_macs_per_residue': model.convolution_macs(),
+                         'parameters': sum(p.numel() for p in model.parameters()), **result,
+                         'speedup': original['seconds'] / result['seconds'], 'run_dir': solver.writer.log_dir})
+            print(rows[-1])
+            pd.DataFrame(rows).to_csv(os.path.join(run_dir, 'compression.csv'), index=False)
+
+    results = pd.DataFrame(rows)
+    sn.set_style('darkgrid')
+    fig, ax = plt.subplots(1, 2, figsize=(15, 6.5))
+    for i, metric in enumerate(['loc_accuracy', 'loc_mcc']):
+        sn.scatterplot(data=results, x='speedup', y=metric, hue='method', size='budget', ax=ax[i])
+        ax[i].set_title('Val {} against measured speedup'.format(metric))
+    plt.tight_layout()
+    fig.savefig(os.path.join(run_dir, 'compression.png'))
+    print(results.to_string())
+    print('Saved results to {}'.format(run_dir))
+    return results
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser()
+    p.add_argument('--config', type=argparse.FileType(mode='r'), default='configs/compression.yaml')
+    p.add_argument('--experiment_name', type=str, default='', help='name that will be added to the runs folder output')
+    p.add_argument('--checkpoint', type=str, help='run directory of the LightAttention checkpoint to compress')
+    p.add_argument('--methods', type=list, default=['low_rank', 'prune'],
+                   help='compression methods [low_rank, prune] that are each applied with every budget')
+    p.add_argument('--budgets', type=list, default=[0.5, 0.25, 0.1],
+                   help='fractions of the multiply accumulate operations of the original convolutions')
+    p.add_argument('--finetune_epochs', type=int, default=0,
+                   help='epochs of training the compressed models with the Solver (0 for no fine-tuning)')
+    p.add_argument('--finetune_lr', type=float, default=None,
+                   help='learning rate for fine-tuning (the one of the checkpoint by default)')
+    p.add_argument('--train_overrides', type=dict, default={},
+                   help='training arguments that overwrite the ones of the checkpoint such as the data paths')
+    args = p.parse_args()
+    if args.config:
+        data = yaml.load(args.config, Loader=yaml.FullLoader)
+        arg_dict = args.__dict__
+        for key, value in data.items():
+            arg_dict[key] = value
+    return args
+
+
+if __name__ == '__main__':
+    compress(parse_arguments())
@@ -0,0 +1,155 @@
+import argparse
+import copy
+import multiprocessing
+import os
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import torch
+import yaml
+
+from models import *  # For loading classes specified in config
+from torch.optim import *  # For loading optimizer specified in config
+from datasets.embeddings_localization_dataset import EmbeddingsLocalizationDataset
+from solver import Solver
+from train import get_transforms, make_loaders, parse_arguments as parse_train_arguments
+from utils.general import cross_validation_folds, seed_all
+
+# dataset and folds that are created once in the main process and inherited by the forked fold processes
+DATASET = {}
+
+
+def read_clusters(path: str) -> dict:
+    """
+    Read a cluster assignment like the cluster.tsv of mmseqs easy-cluster
+    Args:
+        path: tab separated file without header with the cluster representative in the first and the member in the
+        second column
+
+    Returns:
+        dictionary from the member ids to their cluster
+    """
+    clusters = pd.read_csv(path, sep='\t', header=None, usecols=[0, 1], dtype=str)
+    return dict(zip(clusters[1], clusters[0]))
+
+
+def sample_groups(dataset: EmbeddingsLocalizationDataset, clusters: dict) -> np.ndarray:
+    """
+    Returns:
+        [n_samples] group of every sample. Samples without a cluster are grouped by their sequence.
+    """
+    return np.array([clusters.get(item['metadata']['id'], item['metadata']['sequence'])
+                     for item in dataset.localization_solubility_metadata_list])
+
+
+def run_fold(fold: int) -> dict:
+    """
+    Train on all folds except fold and evaluate the best checkpoint on fold
+    Args:
+        fold: index of the validation fold
+
+    Returns:
+        metrics of the fold
+    """
+    start = time.time()
+    args = copy.deepcopy(DATASET['args'])
+    args.experiment_name = '{}_fold{}'.format(args.experiment_name, fold)
+    seed_all(args.seed)
+    dataset = DATASET['dataset']
+    train_indices, val_indices = DATASET['folds'][fold]
+    # only val sequences up to max_length like in train.py while the train set keeps long ones if they are cropped
+    lengths = np.array([dataset.localization_solubility_metadata_list[i]['metadata']['length'] for i in val_indices])
+    train_set = dataset.subset(train_indices, DATASET['train_transform'])
+    val_set = dataset.subset(val_indices[lengths <= args.max_length])
+    train_loader, val_loader = make_loaders(args, train_set, val_set)
+
+    # Needs "from models import *" to work
+    model = globals()[args.model_type](embeddings_dim=train_set[0][0].shape[-1], **args.model_parameters)
+    # Needs "from torch.optim import *" and "from models import *" to work
+    solver = Solver(model, args, globals()[args.optimizer], globals()[args.loss_function],
+                    weight=train_set.class_weights)
+    solver.train(train_loader, val_loader)
+    loc_acc, loc_mcc, sol_acc = solver.best_checkpoint_metrics(val_loader)
+    with open(os.path.join(solver.writer.log_dir, 'epoch.txt'), 'r') as file:
+        epochs = int(file.read()) + 1
+    solver.writer.close()
+    return {'fold': fold, 'n_train': len(train_set), 'n_val': len(val_set), 'epochs': epochs,
+            'loc_accuracy': loc_acc, 'loc_mcc': loc_mcc, 'sol_accuracy': sol_acc, 'seconds': time.time() - start,
+            'run_dir': solver.writer.log_dir}
+
+
+def initialize_worker(threads: int):
+    torch.set_num_threads(max(threads, 1))
+
+
+def cross_validate(args):
+    # the main process only runs on one thread such that no OpenMP thread pool exists that the forked fold processes
+    # would inherit in a broken state (which can make them deadlock in their first parallel operation)
+    torch.set_num_threads(1)
+    train_args = parse_train_arguments(['--config', args.train_config])
+    train_args.config = SimpleNamespace(name=args.train_config)  # file objects cannot be sent to the fold processes
+    train_args.eval_on_test = False
+    train_args.checkpoint = None
+    train_args.experiment_name = args.experiment_name or train_args.experiment_name
+    transform, train_transform, train_max_length = get_transforms(train_args)
+    # the embeddings and the index are read once and every fold is a subset that shares them
+    dataset = EmbeddingsLocalizationDataset(train_args.train_embeddings, train_args.train_remapping,
+                                            train_args.unknown_solubility, max_length=train_max_length,
+                                            key_format=train_args.key_format, embedding_mode=train_args.embedding_mode,
+                                            transform=transform, preload=True)
+    key = 'solubility' if train_args.target == 'sol' else 'localization'
+    labels = np.array([item[key] for item in dataset.localization_solubility_metadata_list])
+    groups = sample_groups(dataset, read_clusters(args.cluster_file)) if args.cluster_file else None
+    folds = cross_validation_folds(labels, args.n_folds, groups, args.stratify, args.seed)
+    DATASET.update({'args': train_args, 'dataset': dataset, 'folds': folds, 'train_transform': train_transform})
+
+    run_dir = 'runs/cv_{}_{}'.format(args.experiment_name, datetime.now().strftime('%d-%m_%H-%M-%S'))
+    os.makedirs(run_dir, exist_ok=True)
+    with open(os.path.join(run_dir, 'cv_arguments.yaml'), 'w') as file:
+        yaml.dump({key: value for key, value in args.__dict__.items() if key != 'config'}, file)
+    # fork such that the fold processes share the dataset that was loaded before the pool was created
+    if torch.cuda.is_initialized():
+        raise ValueError('The fold processes cannot be forked after cuda was initialized in the main process')
+    context = multiprocessing.get_context('fork')
+    with context.Pool(args.n_workers, initializer=initialize_worker, initargs=(args.threads_per_worker,)) as pool:
+        results = pd.DataFrame(pool.map(run_fold, range(args.n_folds), chunksize=1))
+    results.to_csv(os.path.join(run_dir, 'folds.csv'), index=False)
+
+    metrics = ['loc_accuracy', 'loc_mcc', 'sol_accuracy', 'epochs', 'seconds']
+    summary = pd.DataFrame({'mean': results[metrics].mean(), 'std': results[metrics].std()})
+    summary.to_csv(os.path.join(run_dir, 'summary.csv'))
+    print(results.to_string())
+    for metric in metrics:
+        print('%s: %.4f +- %.4f' % (metric, summary.loc[metric, 'mean'], summary.loc[metric, 'std']))
+    print('Saved results to {}'.format(run_dir))
+    return summary
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser()
+    p.add_argument('--config', type=argparse.FileType(mode='r'), default='configs/cross_validation.yaml')
+    p.add_argument('--experiment_name', type=str, default='', help='name that will be added to the runs folder output')
+    p.add_argument('--train_config', type=str, default='configs/light_attention.yaml',
+                   help='training config of every fold. Its train set is split into the folds')
+    p.add_argument('--n_folds', type=int, default=5, help='number of folds')
+    p.add_argument('--stratify', type=bool, default=True, help='keep the class proportions in every fold')
+    p.add_argument('--cluster_file', type=str, default=None,
+                   help='tsv with cluster representatives and members like the cluster.tsv of mmseqs easy-cluster. '
+                        'Members are matched with the keys of the embeddings and a cluster is never split over folds')
+    p.add_argument('--n_workers', type=int, default=1, help='number of folds that are trained in parallel')
+    p.add_argument('--threads_per_worker', type=int, default=1, help='torch threads of every fold process')
+    p.add_argument('--seed', type=int, default=123, help='seed for splitting the folds')
+    args = p.parse_args()
+    if args.config:
+        data = yaml.load(args.config, Loader=yaml.FullLoader)
+        arg_dict = args.__dict__
+        for key, value in data.items():
+            arg_dict[key] = value
+    return args
+
+
+if __name__ == '__main__':
+    cross_validate(parse_arguments())
@@ -0,0 +1,74 @@
+from typing import Tuple
+
+import h5py
+import torch
+from torch.utils.data import Dataset
+
+
+class DistillationDataset(Dataset):
+    """
+    Dataset of pooled protein embeddings together with the soft logits of a teacher model as cached by
+    cache_teacher_logits.py. Proteins without a localization label get the localization predicted by the teacher.
+    """
+
+    def __init__(self, cache_path: str, unknown_solubility: bool = True, transform=lambda x: x) -> None:
+        """
+        Args:
+            cache_path: h5 file written by cache_teacher_logits.py with the datasets ids, embeddings, teacher_logits,
+            localization (-1 for unknown), solubility, lengths and frequencies
+            unknown_solubility: Whether or not to include sequences with unknown solubility in the dataset
+            transform: Pytorch torchvision transforms that should be applied to each sample
+        """
+        super().__init__()
+        self.transform = transform
+        with h5py.File(cache_path, 'r') as file:
+            ids = [id.decode() if isinstance(id, bytes) else id for id in file['ids'][:]]
+            self.embeddings = file['embeddings'][:]  # [n_samples, embeddings_dim] pooled embeddings
+            teacher_logits = torch.from_numpy(file['teacher_logits'][:]).float()  # [n_samples, teacher_output_dim]
+            localization = file['localization'][:]
+            solubility = [sol.decode() if isinstance(sol, bytes) else sol for sol in file['solubility'][:]]
+            lengths = file['lengths'][:]
+            frequencies = torch.from_numpy(file['frequencies'][:]).float()
+
+        self.localization_solubility_metadata_list = []
+        self.class_weights = torch.zeros(10)
+        for i, id in enumerate(ids):
+            labeled = localization[i] >= 0
+            # train on the localization predicted by the teacher for proteins without label
+            label = int(localization[i]) if labeled else int(teacher_logits[i, :10].argmax())
+            metadata = {'id': id,
+                        'length': int(lengths[i]),
+                        'frequencies': frequencies[i],
+                        'solubility_known': not (solubility[i] == 'U'),
+                        'labeled': bool(labeled),
+                        'teacher_logits': teacher_logits[i]}
+            if unknown_solubility or not (solubility[i] == 'U'):
+                self.localization_solubility_metadata_list.append(
+                    {'localization': label, 'solubility': solubility[i], 'metadata': metadata, 'index': i})
+                self.class_weights[label] += 1
+        self.class_weights /= self.class_weights.sum()
+
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, dict]:
+        """retrieve single sample from the dataset
+
+        Args:
+            index: index of sample to retrieve
+
+        Returns:
+            embedding: [embeddings_dim] pooled embedding
+            localization: localization label or the one predicted by the teacher in the format of the given transform
+            solubility: solubility as specified by a transform
+            metadata: dictionary with the teacher_logits and the metadata of the EmbeddingsLocalizationDataset
+        """
+        item = self.localization_solubility_metadata_list[index]
+        embedding, localization, solubility = self.transform(
+            (self.embeddings[item['index']], item['localization'], item['solubility']))
+        return embedding, localization, solubility, item['metadata']
+
+    def __len__(self) -> int:
+        return len(self.localization_solubility_metadata_list)
+
+    @property
+    def n_labeled(self) -> int:
+        return sum(item['metadata']['labeled'] for item in self.localization_solubility_metadata_list)
+
@@ -1,3 +1,4 @@
+import copy
 from typing import Tuple
 
 import h5py
@@ -18,7 +19,8 @@ class EmbeddingsLocalizationDataset(Dataset):
                  key_format:str = 'hash',
                  max_length: int = float('inf'),
                  embedding_mode: str = 'lm',
-                 transform=lambda x: x) -> None:
+                 transform=lambda x: x,
+                 preload: bool = False) -> None:
         """Create dataset.
         Args:
             embeddings_path:  path to .hdf5 .h5 file with embeddings as generated by the bio_embeddings pipeline, or the profiles (pssms) in an h5 file, or None if embedding_mode is 'onehot'
@@ -30,6 +32,8 @@ class EmbeddingsLocalizationDataset(Dataset):
             transform: Pytorch torchvision transforms that should be applied to each sample
             max_length: bigger sequences wont be taken into the dataset
             embedding_mode: ['lm', 'onehot', 'profiles'] what type of protein encoding to return (lm stands for language model) the embeddings_file needs to be either the lm embeddings or the profiles or none if embedding_mode is 'onehot'
+            preload: read all embeddings into memory once and close the h5 file. Then the dataset can be shared with
+                forked processes and no sample is read from disk again
         """
         super().__init__()
         self.transform = transform
@@ -81,6 +85,14 @@ class EmbeddingsLocalizationDataset(Dataset):
             self.class_weights[localization] += 1
         self.class_weights /= self.class_weights.sum()
 
+        self.preloaded = None  # embeddings in the order of localization_solubility_metadata_list if preload is true
+        if preload and (self.embedding_mode == 'lm' or self.embedding_mode == 'profiles'):
+            key = 'id' if self.embedding_mode == 'lm' else 'sequence'
+            self.preloaded = [self.embeddings_file[item['metadata'][key]][:]
+                              for item in self.localization_solubility_metadata_list]
+            self.embeddings_file.close()
+            del self.embeddings_file
+
     def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, dict]:
         """retrieve single sample from the dataset
 
@@ -94,7 +106,9 @@ class EmbeddingsLocalizationDataset(Dataset):
             solubility: solubility as specified by a transform.
         """
         localization_solubility_metadata = self.localization_solubility_metadata_list[index]
-        if self.embedding_mode == 'lm':
+        if self.preloaded is not None:
+            embedding = self.preloaded[index]
+        elif self.embedding_mode == 'lm':
             embedding = self.embeddings_file[localization_solubility_metadata['metadata']['id']][:]
         elif self.embedding_mode == 'profiles':
             embedding = self.embeddings_file[localization_solubility_metadata['metadata']['sequence']][:]
@@ -107,7 +121,34 @@ class EmbeddingsLocalizationDataset(Dataset):
             (embedding, localization_solubility_metadata['localization'],
              localization_solubility_metadata['solubility']))
 
-        return embedding, localization, solubility, localization_solubility_metadata['metadata']
+        metadata = localization_solubility_metadata['metadata']
+        if len(embedding.shape) == 2 and embedding.shape[0] < metadata['length']:  # the transform cropped the sequence
+            metadata = {**metadata, 'length': embedding.shape[0]}  # copy such that the stored length is unchanged
+        return embedding, localization, solubility, metadata
+
+    def subset(self, indices, transform=None) -> 'EmbeddingsLocalizationDataset':
+        """
+        Dataset of the samples at indices that shares the loaded embeddings and the open h5 file with this dataset
+        Args:
+            indices: indices of the samples to keep
+            transform: transform of the subset. If it is None, the transform of this dataset is used
+
+        Returns:
+            the subset with class weights of its own samples
+        """
+        subset = copy.copy(self)
+        subset.localization_solubility_metadata_list = [self.localization_solubility_metadata_list[i] for i in indices]
+        if self.preloaded is not None:
+            subset.preloaded = [self.preloaded[i] for i in indices]
+        if self.embedding_mode == 'onehot':
+            subset.one_hot_enc = [self.one_hot_enc[i] for i in indices]
+        if transform is not None:
+            subset.transform = transform
+        subset.class_weights = torch.zeros(10)
+        for item in subset.localization_solubility_metadata_list:
+            subset.class_weights[item['localization']] += 1
+        subset.class_weights /= subset.class_weights.sum()
+        return subset
 
     def __len__(self) -> int:
         return len(self.localization_solubility_metadata_list)
@@ -0,0 +1,53 @@
+from typing import Iterator, Sized
+
+import torch
+from torch.utils.data import Sampler
+
+
+class ResumableRandomSampler(Sampler):
+    """
+    Random sampler like the torch RandomSampler whose state can be saved in the middle of an epoch. After loading the
+    state, the next epoch continues with the saved permutation at the saved position instead of drawing a new one.
+    """
+
+    def __init__(self, data_source: Sized):
+        """
+        Args:
+            data_source: dataset to sample from
+        """
+        self.data_source = data_source
+        self.permutation = torch.arange(len(data_source))
+        self.resume_position = None  # position in the loaded permutation at which the next epoch continues
+
+    def next_permutation(self) -> torch.Tensor:
+        """
+        Returns:
+            [n_samples] tensor of the indices for the next epoch. Either a new random permutation or the rest of the
+            loaded one if a state was loaded.
+        """
+        if self.resume_position is None:
+            self.permutation = torch.randperm(len(self.data_source))
+            return self.permutation
+        position = self.resume_position
+        self.resume_position = None
+        return self.permutation[position:]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.next_permutation().tolist())
+
+    def __len__(self) -> int:
+        return len(self.data_source)
+
+    def state_dict(self, position: int) -> dict:
+        """
+        Args:
+            position: number of samples of the current permutation that were already consumed
+
+        Returns:
+            state from which the epoch can be resumed with load_state_dict
+        """
+        return {'permutation': self.permutation.clone(), 'position': position}
+
+    def load_state_dict(self, state: dict):
+        self.permutation = state['permutation']
+        self.resume_position = state['position']
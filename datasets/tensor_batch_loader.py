@@ -0,0 +1,120 @@
+from typing import Iterator, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Subset
+
+from datasets.samplers import ResumableRandomSampler
+
+
+class TensorBatchLoader():
+    """
+    Replacement for the DataLoader for datasets of reduced (fixed size) embeddings. All embeddings, labels and the
+    metadata that is used for training are loaded into contiguous tensors once and the batches are taken from them with
+    index_select instead of reading and collating every single item in every epoch.
+    """
+
+    def __init__(self, dataset: Dataset, batch_size: int = 1, shuffle: bool = False, device: torch.device = 'cpu'):
+        """
+        Args:
+            dataset: dataset that returns tuples of [embeddings_dim] embedding, localization, solubility and metadata
+            like the EmbeddingsLocalizationDataset with reduced embeddings
+            batch_size: samples per batch
+            shuffle: whether or not to iterate over a new random permutation of the samples in every epoch
+            device: device on which the tensors are kept
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = device
+        items = [dataset[i] for i in range(len(dataset))]
+        if len(items[0][0].shape) != 1:
+            raise ValueError('TensorBatchLoader only supports reduced embeddings but got embeddings of shape {}'.format(
+                tuple(items[0][0].shape)))
+        self.embeddings = torch.stack([item[0] for item in items]).contiguous().to(device)  # [n_samples, emb_dim]
+        self.localization = torch.stack([item[1] for item in items]).to(device)  # [n_samples]
+        self.solubility = torch.stack([item[2] for item in items]).to(device)  # [n_samples]
+        self.metadata = {
+            'solubility_known': torch.tensor([item[3]['solubility_known'] for item in items]).to(device),
+            'length': torch.tensor([item[3]['length'] for item in items]).to(device),
+            'frequencies': torch.stack([item[3]['frequencies'] for item in items]).to(device),  # [n_samples, 25]
+        }
+        if 'teacher_logits' in items[0][3]:  # soft logits of a teacher like in the DistillationDataset
+            self.metadata['teacher_logits'] = torch.stack([item[3]['teacher_logits'] for item in items]).to(device)
+        self.sampler = ResumableRandomSampler(self.localization) if shuffle else None
+
+    def __iter__(self) -> Iterator[Tuple[torch.Tensor, torch.Tensor, torch.Tensor, dict]]:
+        """
+        Yields batches in the same format as the DataLoader with the default collate function
+        """
+        n_samples = len(self.embeddings)
+        if self.shuffle:
+            order = self.sampler.next_permutation().to(self.device)
+        else:
+            order = torch.arange(n_samples, device=self.device)
+        for start in range(0, len(order), self.batch_size):
+            yield self.batch(order[start:start + self.batch_size])
+
+    def batch(self, indices: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, dict]:
+        """
+        Args:
+            indices: [batch_size] indices of the samples in the batch
+
+        Returns:
+            embedding, localization, solubility and metadata of the samples
+        """
+        metadata = {key: value.index_select(0, indices) for key, value in self.metadata.items()}
+        return self.embeddings.index_select(0, indices), self.localization.index_select(0, indices), \
+               self.solubility.index_select(0, indices), metadata
+
+    def subset(self, indices: np.ndarray) -> 'TensorBatchLoader':
+        """
+        Create a loader with the same settings over part of the samples without reloading them from the dataset
+        Args:
+            indices: indices of the samples to keep
+
+        Returns:
+            TensorBatchLoader over the samples at indices
+        """
+        index_tensor = torch.as_tensor(indices, dtype=torch.long, device=self.device)
+        return TensorBatchLoader.from_tensors(self.embeddings.index_select(0, index_tensor),
+                                              self.localization.index_select(0, index_tensor),
+                                              self.solubility.index_select(0, index_tensor),
+                                              {key: value.index_select(0, index_tensor) for key, value in
+                                               self.metadata.items()},
+                                              Subset(self.dataset, indices), self.batch_size, self.shuffle, self.device)
+
+    @classmethod
+    def from_tensors(cls, embeddings: torch.Tensor, localization: torch.Tensor, solubility: torch.Tensor,
+                     metadata: dict, dataset: Dataset = None, batch_size: int = 1, shuffle: bool = False,
+                     device: torch.device = 'cpu') -> 'TensorBatchLoader':
+        """
+        Create a loader from tensors that are already in memory such as pooled features of a model
+        Args:
+            embeddings: [n_samples, embeddings_dim]
+            localization: [n_samples]
+            solubility: [n_samples]
+            metadata: dictionary with the [n_samples, ...] tensors solubility_known, length, frequencies and
+            optionally teacher_logits
+            dataset: the dataset from which the tensors were computed
+            batch_size: samples per batch
+            shuffle: whether or not to iterate over a new random permutation of the samples in every epoch
+            device: device on which the tensors are kept
+
+        Returns:
+            TensorBatchLoader over the tensors
+        """
+        loader = cls.__new__(cls)
+        loader.dataset = dataset
+        loader.batch_size = batch_size
+        loader.shuffle = shuffle
+        loader.device = device
+        loader.embeddings = embeddings.contiguous().to(device)
+        loader.localization = localization.to(device)
+        loader.solubility = solubility.to(device)
+        loader.metadata = {key: value.to(device) for key, value in metadata.items()}
+        loader.sampler = ResumableRandomSampler(loader.localization) if shuffle else None
+        return loader
+
+    def __len__(self) -> int:
+        return (len(self.embeddings) + self.batch_size - 1) // self.batch_size
@@ -54,6 +54,96 @@ class AvgMaxPool():
         return embedding, localization, solubility
 
 
+class ProjectEmbeddings():
+    """
+    Project embeddings with the PCA or random projection of project_embeddings.py such that a model that was trained on
+    projected embeddings can be applied to the original ones. Embeddings that already have the projected dimension are
+    returned unchanged and embeddings of any other dimension raise a ValueError.
+    """
+
+    def __init__(self, projection_path: str):
+        """
+
+        Args:
+            projection_path: .npz file with the [embeddings_dim] mean and the [n_components, embeddings_dim] components
+        """
+        projection = np.load(projection_path)
+        self.mean = torch.from_numpy(projection['mean']).float()
+        self.components = torch.from_numpy(projection['components']).float()
+
+    def __call__(self, sample: Tuple[torch.Tensor, torch.Tensor, torch.Tensor]) -> Tuple[
+        torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+
+        Args:
+            sample: ([sequence_length, embeddings_dim] or [embeddings_dim], localization, solubility) tuple of embedding
+            and labels
+
+        Returns:
+            embedding: [sequence_length, n_components] or [n_components] the projected embedding
+            localization: the original localization
+            solubility: the original solubility
+        """
+        embedding, localization, solubility = sample
+        if embedding.shape[-1] == self.components.shape[1]:  # per residue or mean pooled embeddings
+            embedding = (embedding - self.mean) @ self.components.T  # affine, so it commutes with mean pooling only
+        elif embedding.shape[-1] != self.components.shape[0]:  # already projected embeddings are returned unchanged
+            raise ValueError('Embeddings of dimension {} can neither be projected from {} nor are they projected to {} '
+                             'dimensions'.format(embedding.shape[-1], self.components.shape[1],
+                                                 self.components.shape[0]))
+        return embedding, localization, solubility
+
+
+class RandomWindowCrop():
+    """
+    Crop per residue embeddings that are longer than max_length to a random window of max_length residues. Optionally
+    biased towards the termini of the sequence because many targeting signals are located at the N- or C-terminus.
+    """
+
+    def __init__(self, max_length: int, mode: str = 'uniform', terminus_probability: float = 0.5):
+        """
+
+        Args:
+            max_length: maximum number of residues that are kept
+            mode: how to choose the window [uniform, termini, both_ends]. uniform takes a window at a random position,
+            termini takes the N-terminal or the C-terminal window with probability terminus_probability and a random
+            one otherwise, both_ends concatenates the first and the last max_length/2 residues
+            terminus_probability: probability of choosing a terminal window in the termini mode
+        """
+        if mode not in ['uniform', 'termini', 'both_ends']:
+            raise ValueError('Unknown crop mode: {}'.format(mode))
+        self.max_length = max_length
+        self.mode = mode
+        self.terminus_probability = terminus_probability
+
+    def __call__(self, sample: Tuple[torch.Tensor, torch.Tensor, torch.Tensor]) -> Tuple[
+        torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+
+        Args:
+            sample: ([sequence_length, embedding_size], localization, solubility) tuple of embedding and labels
+
+        Returns:
+            embedding: [min(sequence_length, max_length), embedding_size] the cropped embedding
+            localization: the original localization
+            solubility: the original solubility
+        """
+        embedding, localization, solubility = sample
+        length = embedding.shape[0]
+        if embedding.dim() != 2 or length <= self.max_length:  # reduced embeddings or short enough
+            return embedding, localization, solubility
+        if self.mode == 'both_ends':
+            n_terminal_length = (self.max_length + 1) // 2
+            embedding = torch.cat([embedding[:n_terminal_length],
+                                   embedding[length - (self.max_length - n_terminal_length):]])
+            return embedding, localization, solubility
+        if self.mode == 'termini' and torch.rand(1).item() < self.terminus_probability:
+            start = 0 if torch.rand(1).item() < 0.5 else length - self.max_length
+        else:
+            start = torch.randint(0, length - self.max_length + 1, (1,)).item()
+        return embedding[start:start + self.max_length], localization, solubility
+
+
 class SolubilityToInt():
     """
     Turn string localization of localization into an integer and  solubility into 0 for membrane bound OR UNKNOWN
@@ -0,0 +1,56 @@
+import argparse
+import os
+
+import torch
+import yaml
+
+from models import *  # For loading classes specified in config
+from utils.onnx_export import export_onnx, OnnxRuntimeModel
+
+
+def export_checkpoint(args):
+    """
+    Export the model of a checkpoint like LightAttention or FFN to model.onnx in its run directory and compare the
+    logits of onnxruntime with the ones of PyTorch on a random batch with padding
+    """
+    output = args.output or os.path.join(args.checkpoint, 'model.onnx')
+    with open(os.path.join(args.checkpoint, 'train_arguments.yaml'), 'r') as file:
+        train_arguments = yaml.load(file, Loader=yaml.FullLoader)
+    checkpoint = torch.load(os.path.join(args.checkpoint, 'checkpoint.pt'), map_location='cpu')
+    # the exported graph uses the padded pooling of LightAttention
+    model_parameters = {key: value for key, value in train_arguments['model_parameters'].items()
+                        if key not in ['packed', 'chunk_size']}
+    # Needs "from models import *" to work
+    model = globals()[train_arguments['model_type']](embeddings_dim=args.embeddings_dim, **model_parameters)
+    model.load_state_dict(checkpoint['model_state_dict'])
+    model.eval()
+    per_residue = train_arguments['model_type'] != 'FFN'  # FFN is trained on reduced embeddings
+    export_onnx(model, args.embeddings_dim, output, per_residue, args.opset)
+
+    onnx_model = OnnxRuntimeModel(output)
+    lengths = torch.tensor([300, 250, 120, 7])
+    mask = torch.arange(300)[None, :] < lengths[:, None]
+    if per_residue:
+        x = torch.randn(4, args.embeddings_dim, 300) * mask[:, None, :]  # zero padding like padded_permuted_collate
+    else:
+        x = torch.randn(4, args.embeddings_dim)
+    with torch.no_grad():
+        difference = (model(x, mask=mask) - onnx_model(x, mask=mask)).abs().max().item()
+    print('Maximum absolute difference of the logits of onnxruntime: {}'.format(difference))
+    print('Saved the ONNX graph to {}'.format(output))
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser()
+    p.add_argument('--checkpoint', type=str, required=True,
+                   help='run directory with checkpoint.pt and train_arguments.yaml of a LightAttention or FFN')
+    p.add_argument('--output', type=str, default=None,
+                   help='.onnx file for the graph (model.onnx in the checkpoint directory by default)')
+    p.add_argument('--embeddings_dim', type=int, default=1024,
+                   help='dimension of the embeddings the model was trained on')
+    p.add_argument('--opset', type=int, default=17, help='ONNX opset version')
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    export_checkpoint(parse_arguments())
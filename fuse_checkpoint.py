@@ -0,0 +1,62 @@
+import argparse
+import os
+import shutil
+
+import torch
+import yaml
+
+from models.light_attention import LightAttention, fuse_convolutions_state_dict, \
+    fuse_convolutions_optimizer_state_dict
+
+
+def fuse_checkpoint(args):
+    """
+    Copy the run directory of a LightAttention checkpoint and convert the copy such that it uses fused_convolution
+    """
+    output = args.output or args.checkpoint.rstrip('/') + '_fused'
+    shutil.copytree(args.checkpoint, output)
+    checkpoint = torch.load(os.path.join(args.checkpoint, 'checkpoint.pt'), map_location='cpu')
+    with open(os.path.join(args.checkpoint, 'train_arguments.yaml'), 'r') as file:
+        train_arguments = yaml.load(file, Loader=yaml.FullLoader)
+    if train_arguments['model_type'] != 'LightAttention':
+        raise ValueError('Only LightAttention checkpoints can be fused but got {}'.format(train_arguments['model_type']))
+    if train_arguments['model_parameters'].get('fused_convolution'):
+        raise ValueError('The checkpoint in {} already uses fused_convolution'.format(args.checkpoint))
+
+    fused_checkpoint = {**checkpoint, 'model_state_dict': fuse_convolutions_state_dict(checkpoint['model_state_dict'])}
+    if 'optimizer_state_dict' in checkpoint:
+        fused_checkpoint['optimizer_state_dict'] = fuse_convolutions_optimizer_state_dict(
+            checkpoint['optimizer_state_dict'])
+    torch.save(fused_checkpoint, os.path.join(output, 'checkpoint.pt'))
+    train_arguments['model_parameters']['fused_convolution'] = True
+    with open(os.path.join(output, 'train_arguments.yaml'), 'w') as file:
+        yaml.dump(train_arguments, file)
+
+    # compare both models on a random batch with padding
+    embeddings_dim = checkpoint['model_state_dict']['feature_convolution.weight'].shape[1]
+    model_parameters = {**train_arguments['model_parameters'], 'fused_convolution': False}
+    model = LightAttention(embeddings_dim=embeddings_dim, **model_parameters)
+    model.load_state_dict(checkpoint['model_state_dict'])
+    fused_model = LightAttention(embeddings_dim=embeddings_dim, **train_arguments['model_parameters'])
+    fused_model.load_state_dict(fused_checkpoint['model_state_dict'])
+    model.eval()
+    fused_model.eval()
+    x = torch.randn(4, embeddings_dim, 300)
+    mask = torch.arange(300)[None, :] < torch.tensor([300, 250, 120, 7])[:, None]
+    with torch.no_grad():
+        difference = (model(x, mask) - fused_model(x, mask)).abs().max().item()
+    print('Maximum absolute difference of the logits of the fused model: {}'.format(difference))
+    print('Saved the fused checkpoint to {}'.format(output))
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser()
+    p.add_argument('--checkpoint', type=str, required=True,
+                   help='run directory with checkpoint.pt and train_arguments.yaml of a LightAttention model')
+    p.add_argument('--output', type=str, default=None,
+                   help='directory for the converted copy (the checkpoint directory with the suffix _fused by default)')
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    fuse_checkpoint(parse_arguments())
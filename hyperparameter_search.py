@@ -0,0 +1,264 @@
+import argparse
+import copy
+import multiprocessing
+import os
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import torch
+import yaml
+
+from models import *  # For loading classes specified in config
+from torch.optim import *  # For loading optimizer specified in config
+from solver import Solver
+from train import load_datasets, make_loaders, parse_arguments as parse_train_arguments
+from utils.general import seed_all
+
+# train and val set that are loaded once in the main process and inherited by the forked trial processes
+DATASETS = {}
+
+
+def sample_parameters(search_space: dict, rng: np.random.RandomState) -> dict:
+    """
+    Draw one configuration from the search space
+    Args:
+        search_space: dictionary from argument names to a dictionary with one of the keys [uniform, log_uniform,
+        choice]. Parameters of dictionary arguments are addressed with a dot like optimizer_parameters.lr
+        rng: random state from which is drawn
+
+    Returns:
+        dictionary from the argument names to the drawn values
+    """
+    parameters = {}
+    for name, distribution in search_space.items():
+        if 'uniform' in distribution:
+            low, high = distribution['uniform']
+            parameters[name] = float(rng.uniform(low, high))
+        elif 'log_uniform' in distribution:
+            low, high = distribution['log_uniform']
+            parameters[name] = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+        elif 'choice' in distribution:
+            parameters[name] = distribution['choice'][rng.randint(len(distribution['choice']))]
+        else:
+            raise ValueError('Unknown distribution for {}: {}'.format(name, distribution))
+    return parameters
+
+
+def set_argument(args, name: str, value):
+    """
+    Set the argument name of args where names like optimizer_parameters.lr set an entry of a dictionary argument
+    """
+    keys = name.split('.')
+    if len(keys) == 1:
+        setattr(args, name, value)
+    else:
+        dictionary = getattr(args, keys[0])
+        for key in keys[1:-1]:
+            dictionary = dictionary.setdefault(key, {})
+        dictionary[keys[-1]] = value
+
+
+def run_trial(job: dict) -> dict:
+    """
+    Train one configuration up to the budget of its rung. A promoted trial continues from the last weights and optimizer
+    state of its previous rung in resume.pt. Afterwards the best checkpoint is evaluated on the full val set.
+    Args:
+        job: dictionary with the trial id, rung, training arguments and the parameters that were drawn
+
+    Returns:
+        result row of the summary
+    """
+    start = time.time()
+    args = job['args']
+    seed_all(args.seed)
+    train_loader, val_loader = make_loaders(args, DATASETS['train'], DATASETS['val'], resumable=True)
+    # Needs "from models import *" to work
+    model = globals()[args.model_type](embeddings_dim=DATASETS['train'][0][0].shape[-1], **args.model_parameters)
+    # Needs "from torch.optim import *" and "from models import *" to work
+    solver = Solver(model, args, globals()[args.optimizer], globals()[args.loss_function],
+                    weight=DATASETS['train'].class_weights)
+    solver.train(train_loader, val_loader)
+    with open(os.path.join(solver.writer.log_dir, 'epoch.txt'), 'r') as file:
+        epochs = int(file.read()) + 1
+    solver.save_end_state(train_loader, epochs)  # before the best checkpoint is loaded into the model
+
+    loc_acc, loc_mcc, sol_acc = solver.best_checkpoint_metrics(val_loader)
+    solver.writer.close()
+    return {'trial': job['trial'], 'rung': job['rung'], 'budget': args.num_epochs, 'epochs': epochs,
+            'accuracy': sol_acc if args.target == 'sol' else loc_acc,
+            'mcc': loc_mcc, 'seconds': time.time() - start, 'run_dir': solver.writer.log_dir, **job['parameters']}
+
+
+def initialize_worker(threads: int):
+    torch.set_num_threads(max(threads, 1))
+
+
+class SuccessiveHalving():
+    """
+    Asynchronous successive halving (ASHA). Trials start with the budget of the lowest rung and whenever a worker is
+    free, the best trial of the highest rung that is in the top 1/eta of the finished trials of its rung and was not yet
+    promoted continues to the budget of the next rung. Only if no trial can be promoted a new trial is started.
+    """
+
+    def __init__(self, args, train_args):
+        """
+        Args:
+            args: search arguments
+            train_args: training arguments shared by all trials
+        """
+        self.args = args
+        self.train_args = train_args
+        self.rng = np.random.RandomState(args.seed)
+        self.budgets = [args.min_epochs]  # number of epochs of every rung
+        while self.budgets[-1] * args.eta <= args.max_epochs:
+            self.budgets.append(self.budgets[-1] * args.eta)
+        self.results = [{} for _ in self.budgets]  # per rung the metric of every finished trial
+        self.promoted = [set() for _ in self.budgets]  # per rung the trials that were promoted to the next rung
+        self.trials = []  # parameters of every started trial
+        self.run_dirs = {}  # run directory of every trial from which a promotion continues
+        self.rows = []
+
+    def next_job(self, remaining_time: float) -> dict:
+        """
+        Returns:
+            the job of the next promotion or new trial or None if there is nothing to do
+        """
+        job = None
+        for rung in reversed(range(len(self.budgets) - 1)):
+            results = self.results[rung]
+            n_promotable = len(results) // self.args.eta
+            top = sorted(results, key=results.get, reverse=True)[:n_promotable]
+            candidates = [trial for trial in top if trial not in self.promoted[rung]]
+            if candidates:
+                self.promoted[rung].add(candidates[0])
+                job = {'trial': candidates[0], 'rung': rung + 1}
+                break
+        if job is None:
+            if len(self.trials) >= self.args.n_trials:
+                return None
+            self.trials.append(sample_parameters(self.args.search_space, self.rng))
+            job = {'trial': len(self.trials) - 1, 'rung': 0}
+
+        args = copy.deepcopy(self.train_args)
+        job['parameters'] = self.trials[job['trial']]
+        for name, value in job['parameters'].items():
+            set_argument(args, name, value)
+        args.experiment_name = '{}_trial{}'.format(self.args.experiment_name, job['trial'])
+        args.num_epochs = self.budgets[job['rung']]
+        args.checkpoint = self.run_dirs.get(job['trial'])  # continue the training of the previous rung
+        if remaining_time > 0:  # trials stop at their first validation event after the end of the time budget
+            args.max_time = remaining_time if args.max_time <= 0 else min(args.max_time, remaining_time)
+        job['args'] = args
+        return job
+
+    def add_result(self, row: dict):
+        self.rows.append(row)
+        self.results[row['rung']][row['trial']] = row[self.args.metric]
+        self.run_dirs[row['trial']] = row['run_dir']
+        print('[Trial %d Rung %d] %d epochs: accuracy %.4f%% MCC %.4f' % (row['trial'], row['rung'], row['epochs'],
+                                                                         row['accuracy'], row['mcc']))
+
+    def run(self, run_dir: str) -> pd.DataFrame:
+        start = time.time()
+        # fork such that the trial processes share the datasets that were loaded before the pool was created
+        if torch.cuda.is_initialized():
+            raise ValueError('The trial processes cannot be forked after cuda was initialized in the main process')
+        context = multiprocessing.get_context('fork')
+        with context.Pool(self.args.n_workers, initializer=initialize_worker,
+                          initargs=(self.args.threads_per_worker,)) as pool:
+            running = []
+            while True:
+                remaining_time = self.args.time_budget - (time.time() - start) if self.args.time_budget > 0 else 0
+                if self.args.time_budget <= 0 or remaining_time > 0:
+                    while len(running) < self.args.n_workers:
+                        job = self.next_job(remaining_time)
+                        if job is None:
+                            break
+                        running.append((job, pool.apply_async(run_trial, (job,))))
+                if not running:
+                    break
+                time.sleep(1)
+                for job, result in [(job, result) for job, result in running if result.ready()]:
+                    running.remove((job, result))
+                    try:
+                        self.add_result(result.get())
+                    except Exception as error:
+                        print('[Trial %d Rung %d] failed: %s' % (job['trial'], job['rung'], error))
+                    self.summary().to_csv(os.path.join(run_dir, 'summary.csv'), index=False)
+        return self.summary()
+
+    def summary(self) -> pd.DataFrame:
+        """
+        Returns:
+            one row for every finished trial and rung sorted by the rung and the metric
+        """
+        summary = pd.DataFrame(self.rows)
+        if len(summary) > 0:
+            summary = summary.sort_values(['rung', self.args.metric], ascending=False)
+        return summary
+
+
+def search(args):
+    # the main process only runs on one thread such that no OpenMP thread pool exists that the forked trial processes
+    # would inherit in a broken state (which can make them deadlock in their first parallel operation)
+    torch.set_num_threads(1)
+    train_args = parse_train_arguments(['--config', args.train_config])
+    for key, value in args.train_overrides.items():
+        set_argument(train_args, key, value)
+    train_args.config = SimpleNamespace(name=args.train_config)  # file objects cannot be sent to the trial processes
+    train_args.eval_on_test = False
+    train_args.preload = True  # trials only read the embeddings from memory
+    DATASETS['train'], DATASETS['val'] = load_datasets(train_args)
+
+    run_dir = 'runs/search_{}_{}'.format(args.experiment_name, datetime.now().strftime('%d-%m_%H-%M-%S'))
+    os.makedirs(run_dir, exist_ok=True)
+    with open(os.path.join(run_dir, 'search_arguments.yaml'), 'w') as file:
+        yaml.dump({key: value for key, value in args.__dict__.items() if key != 'config'}, file)
+    halving = SuccessiveHalving(args, train_args)
+    print('Budgets of the rungs in epochs: ', halving.budgets)
+    summary = halving.run(run_dir)
+    summary.to_csv(os.path.join(run_dir, 'summary.csv'), index=False)
+    print(summary.to_string())
+    print('Saved summary to {}'.format(os.path.join(run_dir, 'summary.csv')))
+    return summary
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser()
+    p.add_argument('--config', type=argparse.FileType(mode='r'), default='configs/hyperparameter_search.yaml')
+    p.add_argument('--experiment_name', type=str, default='', help='name that will be added to the runs folder output')
+    p.add_argument('--train_config', type=str, default='configs/light_attention.yaml',
+                   help='training config that is shared by all trials')
+    p.add_argument('--train_overrides', type=dict, default={},
+                   help='training arguments that overwrite the ones of the train_config for all trials')
+    p.add_argument('--search_space', type=dict, default={},
+                   help='dictionary from argument names like optimizer_parameters.lr to a dictionary with one of the '
+                        'keys [uniform, log_uniform, choice]')
+    p.add_argument('--n_trials', type=int, default=27, help='number of configurations that are drawn')
+    p.add_argument('--min_epochs', type=int, default=5, help='epochs of the lowest rung')
+    p.add_argument('--max_epochs', type=int, default=135, help='maximum epochs of the highest rung')
+    p.add_argument('--eta', type=int, default=3,
+                   help='the top 1/eta trials of a rung are promoted to the next rung with eta times the epochs')
+    p.add_argument('--metric', type=str, default='mcc', help='val metric for promoting trials [accuracy, mcc]')
+    p.add_argument('--n_workers', type=int, default=2, help='number of trials that are trained in parallel')
+    p.add_argument('--threads_per_worker', type=int, default=1, help='torch threads of every trial process')
+    p.add_argument('--time_budget', type=float, default=0,
+                   help='wall clock seconds after which no trials are started and running ones stop at their next '
+                        'validation event (0 for off)')
+    p.add_argument('--seed', type=int, default=123, help='seed for drawing the configurations')
+    args = p.parse_args()
+    if args.config:
+        data = yaml.load(args.config, Loader=yaml.FullLoader)
+        arg_dict = args.__dict__
+        for key, value in data.items():
+            arg_dict[key] = value
+    if args.metric not in ['accuracy', 'mcc']:
+        raise ValueError('Unknown metric: {}'.format(args.metric))
+    return args
+
+
+if __name__ == '__main__':
+    search(parse_arguments())
@@ -1,20 +1,39 @@
 import copy
+import time
 
+import numpy as np
+import pandas as pd
+import torch
 from models import *  # For loading classes specified in config
 from models.legacy import *  # For loading classes specified in config
-from torch.optim import *  # For loading optimizer class that was used in the checkpoint
 import os
 import argparse
 import yaml
 import torch.nn as nn
+from torch.utils.data import DataLoader
 from torchvision.transforms import transforms
 from datasets.embeddings_localization_dataset import EmbeddingsLocalizationDataset
 from datasets.transforms import *
 from solver import Solver
+from utils.compilation import compile_model, checkpoint_hash
+from utils.general import padded_permuted_collate
+from utils.onnx_export import export_onnx, OnnxRuntimeModel
+from utils.quantization import quantize_model, has_convolutions
+
+
+def eval_transform(args):
+    """
+    Returns:
+        transform of the inference sets that projects the embeddings if the checkpoint was trained on projected ones
+    """
+    transform = [SolubilityToInt(), ToTensor()]
+    if getattr(args, 'projection', None):  # checkpoints from before the projection option do not have it
+        transform.append(ProjectEmbeddings(args.projection))
+    return transforms.Compose(transform)
 
 
 def inference(args):
-    transform = transforms.Compose([SolubilityToInt(), ToTensor()])
+    transform = eval_transform(args)
     # lookup_set
     data_set = EmbeddingsLocalizationDataset(args.embeddings, args.remapping,
                                              unknown_solubility=args.unknown_solubility,
@@ -28,11 +47,154 @@ def inference(args):
                                                    embedding_mode=args.embedding_mode,
                                                    transform=transform)
 
+    model_parameters = args.model_parameters
     # Needs "from models import *" to work
-    model: nn.Module = globals()[args.model_type](embeddings_dim=data_set[0][0].shape[-1], **args.model_parameters)
+    model_class = globals()[args.model_type]
+    if args.backend == 'onnxruntime' or args.compile:  # the graphs use the padded pooling of LightAttention
+        model_parameters = {key: value for key, value in model_parameters.items()
+                            if key not in ['packed', 'chunk_size']}
+    elif args.chunk_size > 0 and issubclass(model_class, LightAttention):  # bound the memory for long sequences
+        model_parameters = {**model_parameters, 'chunk_size': args.chunk_size}
+    model: nn.Module = model_class(embeddings_dim=data_set[0][0].shape[-1], **model_parameters)
+
+    if args.quantize or args.backend == 'onnxruntime':
+        args.device = 'cpu'  # the quantized kernels and the onnxruntime session only run on the cpu
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    # Needs "from models import *" to work. Evaluation only: loads checkpoint.pt of args.checkpoint without an optimizer
+    solver = Solver(model, args, loss_func=globals()[args.loss_function], eval=True)
+    if args.quantize:
+        return quantized_inference(solver, data_set, lookup_set, args)
+    if args.backend == 'onnxruntime':
+        return onnxruntime_inference(solver, data_set, lookup_set, args)
+    elif args.backend != 'torch':
+        raise ValueError('Unknown backend: {}'.format(args.backend))
+    if args.compile:
+        solver.model.eval()
+        solver.model = compile_model(solver.model, args.compile, args.checkpoint, data_set[0][0].shape[-1],
+                                     len(data_set[0][0].shape) == 2, solver.device)
+    return solver.evaluation(data_set, args.output_files_name, lookup_set, args.distance_threshold)
+
+
+def timed_predict(solver: Solver, data_set: EmbeddingsLocalizationDataset, args) -> dict:
+    """
+    Returns:
+        latency and throughput of predicting the data_set with the model of the solver and the localization accuracy
+        and MCC and the solubility accuracy of the predictions
+    """
+    collate_function = padded_permuted_collate if len(data_set[0][0].shape) == 2 else None
+    data_loader = DataLoader(data_set, batch_size=args.batch_size, collate_fn=collate_function)
+    solver.model.eval()
+    start = time.perf_counter()
+    with torch.no_grad():
+        _, _, results = solver.predict(data_loader)
+    seconds = time.perf_counter() - start
+    loc_accuracy, loc_mcc, sol_accuracy = solver.metrics(results)
+    n_residues = sum(item['metadata']['length'] for item in data_set.localization_solubility_metadata_list)
+    return {'seconds': seconds, 'ms_per_batch': 1000 * seconds / len(data_loader),
+            'proteins_per_sec': len(data_set) / seconds, 'residues_per_sec': n_residues / seconds,
+            'loc_accuracy': loc_accuracy, 'loc_mcc': loc_mcc, 'sol_accuracy': sol_accuracy}
+
+
+def quantized_inference(solver: Solver, data_set: EmbeddingsLocalizationDataset,
+                        lookup_set: EmbeddingsLocalizationDataset, args):
+    """
+    Evaluate the float32 model and its int8 quantization on the cpu and write the latency, throughput and the accuracy
+    and MCC deltas to quantization_<output_files_name>.txt in the run directory. The quantized model is saved as
+    checkpoint_int8_<hash>.pt next to checkpoint.pt, where hash is the one of checkpoint.pt, and loaded from there in
+    later runs unless recalibrate is set. A retrained checkpoint.pt is therefore quantized again.
+
+    Returns:
+        accuracy, mcc and f1 of the quantized model
+    """
+    float_timing = timed_predict(solver, data_set, args)
+    float_accuracy, float_mcc, float_f1 = solver.evaluation(data_set, args.output_files_name + '_float32', lookup_set,
+                                                            args.distance_threshold)
+
+    quantized_path = os.path.join(args.checkpoint, 'checkpoint_int8_{}.pt'.format(
+        checkpoint_hash(os.path.join(args.checkpoint, 'checkpoint.pt'))))
+    if os.path.exists(quantized_path) and not args.recalibrate:
+        quantized_model = quantize_model(solver.model)
+        quantized_model.load_state_dict(torch.load(quantized_path, weights_only=False))
+    else:
+        calibration_loader = None
+        if has_convolutions(solver.model):  # static quantization of the convolutions needs activation ranges
+            transform = eval_transform(args)
+            calibration_set = EmbeddingsLocalizationDataset(args.calibration_embeddings or args.train_embeddings,
+                                                            args.calibration_remapping or args.train_remapping,
+                                                            key_format=args.key_format,
+                                                            embedding_mode=args.embedding_mode, transform=transform)
+            indices = np.random.RandomState(args.seed).permutation(len(calibration_set))[:args.calibration_samples]
+            calibration_loader = DataLoader(calibration_set.subset(indices), batch_size=args.batch_size,
+                                            collate_fn=padded_permuted_collate)
+        quantized_model = quantize_model(solver.model, calibration_loader)
+        torch.save(quantized_model.state_dict(), quantized_path)
+        print('Saved the quantized model to {}'.format(quantized_path))
+
+    solver.model = quantized_model
+    quantized_timing = timed_predict(solver, data_set, args)
+    accuracy, mcc, f1 = solver.evaluation(data_set, args.output_files_name + '_int8', lookup_set,
+                                          args.distance_threshold)
+
+    report = pd.DataFrame([{'precision': 'float32', 'accuracy': float_accuracy, 'mcc': float_mcc, 'f1': float_f1,
+                            **float_timing},
+                           {'precision': 'int8', 'accuracy': accuracy, 'mcc': mcc, 'f1': f1, **quantized_timing}])
+    results_string = '{}\n\n' \
+                     'Accuracy delta: {:.2f}%\n' \
+                     'MCC delta: {:.4f}\n' \
+                     'Speedup: {:.2f}x\n'.format(report.to_string(index=False), accuracy - float_accuracy,
+                                                  mcc - float_mcc, float_timing['seconds'] / quantized_timing['seconds'])
+    with open(os.path.join(solver.writer.log_dir, 'quantization_' + args.output_files_name + '.txt'), 'w') as file:
+        file.write(results_string)
+    print(results_string)
+    return accuracy, mcc, f1
+
+
+def onnxruntime_inference(solver: Solver, data_set: EmbeddingsLocalizationDataset,
+                          lookup_set: EmbeddingsLocalizationDataset, args):
+    """
+    Evaluate the model with the ONNX graph in model.onnx in the checkpoint directory with onnxruntime on the cpu. The
+    graph is exported if it does not exist or is older than checkpoint.pt. Before the evaluation, the logits of the
+    graph are compared with the ones of the PyTorch model on the data_set and the maximum absolute difference, the
+    latency and the throughput of both are written to onnxruntime_<output_files_name>.txt in the run directory.
+
+    Returns:
+        accuracy, mcc and f1 of the onnxruntime predictions
+    """
+    per_residue = len(data_set[0][0].shape) == 2
+    onnx_path = os.path.join(args.checkpoint, 'model.onnx')
+    checkpoint_path = os.path.join(args.checkpoint, 'checkpoint.pt')
+    if not os.path.exists(onnx_path) or os.path.getmtime(onnx_path) < os.path.getmtime(checkpoint_path):
+        export_onnx(solver.model, data_set[0][0].shape[-1], onnx_path, per_residue)
+        print('Exported the model to {}'.format(onnx_path))
+    onnx_model = OnnxRuntimeModel(onnx_path, args.num_threads)
+
+    data_loader = DataLoader(data_set, batch_size=args.batch_size,
+                             collate_fn=padded_permuted_collate if per_residue else None)
+    solver.model.eval()
+    difference = 0
+    with torch.no_grad():
+        for embedding, _, _, metadata in data_loader:
+            lengths = metadata['length']
+            mask = torch.arange(lengths.max())[None, :] < lengths[:, None]
+            torch_logits = solver.model(embedding, mask=mask, sequence_lengths=lengths[:, None],
+                                        frequencies=metadata['frequencies'])
+            difference = max(difference, (torch_logits - onnx_model(embedding, mask=mask)).abs().max().item())
+    if difference > args.onnx_tolerance:
+        raise ValueError('The logits of the ONNX graph differ from the ones of PyTorch by {} which is more than the '
+                         'onnx_tolerance of {}'.format(difference, args.onnx_tolerance))
 
-    # Needs "from torch.optim import *" and "from models import *" to work
-    solver = Solver(model, args, globals()[args.optimizer], globals()[args.loss_function])
+    torch_timing = timed_predict(solver, data_set, args)
+    solver.model = onnx_model
+    onnx_timing = timed_predict(solver, data_set, args)
+    report = pd.DataFrame([{'backend': 'torch', **torch_timing}, {'backend': 'onnxruntime', **onnx_timing}])
+    results_string = '{}\n\n' \
+                     'Maximum absolute difference of the logits: {}\n' \
+                     'Speedup: {:.2f}x\n'.format(report.to_string(index=False), difference,
+                                                  torch_timing['seconds'] / onnx_timing['seconds'])
+    with open(os.path.join(solver.writer.log_dir, 'onnxruntime_' + args.output_files_name + '.txt'), 'w') as file:
+        file.write(results_string)
+    print(results_string)
     return solver.evaluation(data_set, args.output_files_name, lookup_set, args.distance_threshold)
 
 
@@ -57,6 +219,44 @@ def parse_arguments():
                    help='.h5 or .h5py file with keys fitting the ids in the corresponding fasta remapping file for embedding based similarity annotation transfer')
     p.add_argument('--lookup_remapping', type=str, default='data/embeddings/val_remapped.fasta',
                    help='fasta file with remappings by bio_embeddings for the keys in the corresponding .h5 file for embedding based similarity annotation transfer')
+    p.add_argument('--chunk_size', type=int, default=0,
+                   help='run LightAttention on chunks of at most chunk_size residues with streaming pooling such that '
+                        'very long sequences fit into memory. Gives the same predictions (0 for off)')
+    p.add_argument('--device', type=str, default=None,
+                   help='device to run on like cpu or cuda:1 (cuda:0 if it is available by default)')
+    p.add_argument('--num_threads', type=int, default=0,
+                   help='number of threads for the operators on cpu of torch and onnxruntime (0 for their default)')
+    p.add_argument('--backend', type=str, default='torch',
+                   help='[torch, onnxruntime]. onnxruntime runs the ONNX graph in model.onnx in the checkpoint on the '
+                        'cpu and exports it there first if needed')
+    p.add_argument('--compile', type=str, default=None,
+                   help='[jit, inductor] run a compiled graph of the model with the BatchNorm folded into the linear '
+                        'layers. jit freezes a traced TorchScript module and inductor uses torch.compile. The compiled '
+                        'artifact is cached in the checkpoint for the hash of checkpoint.pt and the torch version')
+    p.add_argument('--onnx_tolerance', type=float, default=1e-4,
+                   help='maximum absolute difference between the logits of PyTorch and onnxruntime that is accepted')
+    p.add_argument('--quantize', type=bool, default=False,
+                   help='compare the float32 model with its int8 quantization on the cpu (dynamic for Linear and '
+                        'static for Conv1d layers). The quantized model is saved in the checkpoint as '
+                        'checkpoint_int8_<hash>.pt for the hash of checkpoint.pt')
+    p.add_argument('--recalibrate', type=bool, default=False,
+                   help='quantize and calibrate again even if there already is a quantized model of checkpoint.pt')
+    p.add_argument('--calibration_samples', type=int, default=256,
+                   help='number of random training samples for calibrating the ranges of the quantized activations')
+    p.add_argument('--calibration_embeddings', type=str, default=None,
+                   help='.h5 file with the calibration samples (train_embeddings of the checkpoint by default)')
+    p.add_argument('--calibration_remapping', type=str, default=None,
+                   help='fasta remapping of the calibration samples (train_remapping of the checkpoint by default)')
+    p.add_argument('--timing', type=bool, default=False,
+                   help='record the time spent in each phase of the Solver (only written to the logs during training)')
+    p.add_argument('--profiler', type=dict, default=None,
+                   help='run torch.profiler with the schedule parameters [wait, warmup, active, repeat, skip_first] '
+                        'on the batches of mode [train, predict] and save traces and tables to profiler/ in the run dir')
+    p.add_argument('--memory_tracking', type=bool, default=False,
+                   help='record the memory of every batch against its size and padded length to memory.csv/.png')
+    p.add_argument('--memory_guard', type=dict, default=None,
+                   help='dictionary with limit_mb and optionally mb_per_element. Batches whose projected memory '
+                        'exceeds limit_mb are split into smaller batches')
     p.add_argument('--key_format', type=str, default='hash',
                    help='the formatting of the keys in the h5 file [fasta_descriptor_old, fasta_descriptor, hash]')
 
@@ -0,0 +1,50 @@
+import torch.nn as nn
+
+from models.light_attention import LightAttention
+
+
+class CompressedLightAttention(LightAttention):
+    def __init__(self, embeddings_dim=1024, output_dim=11, dropout=0.25, kernel_size=9, conv_dropout: float = 0.25,
+                 rank: int = 0, channels: int = 0, **kwargs):
+        """
+        LightAttention with cheaper convolutions as created from a trained LightAttention by compress_model.py.
+        Args:
+            embeddings_dim: dimension of the input
+            output_dim: output dimension (number of classes that should be classified)
+            dropout: dropout ratio of the linear layer
+            kernel_size: kernel size of the feature and attention convolutions
+            conv_dropout: dropout ratio applied to the output of the feature convolution
+            rank: if it is > 0, every convolution is factored into a convolution with kernel_size from embeddings_dim
+            to rank channels and a 1x1 convolution from rank to the output channels
+            channels: number of output channels of the convolutions that are kept after pruning (embeddings_dim if 0)
+            **kwargs: the remaining options of LightAttention except fused_convolution
+        """
+        if kwargs.get('fused_convolution'):
+            raise ValueError('CompressedLightAttention does not support fused_convolution')
+        # set before the modules of LightAttention are created with make_convolution and convolution_channels
+        self.rank = rank
+        self.channels = channels or embeddings_dim
+        self.embeddings_dim = embeddings_dim
+        self.kernel_size = kernel_size
+        super(CompressedLightAttention, self).__init__(embeddings_dim, output_dim, dropout, kernel_size, conv_dropout,
+                                                       **kwargs)
+
+    def make_convolution(self, embeddings_dim: int, kernel_size: int) -> nn.Module:
+        if self.rank > 0:
+            return nn.Sequential(
+                nn.Conv1d(embeddings_dim, self.rank, kernel_size, stride=1, padding=kernel_size // 2, bias=False),
+                nn.Conv1d(self.rank, self.channels, 1)
+            )
+        return nn.Conv1d(embeddings_dim, self.channels, kernel_size, stride=1, padding=kernel_size // 2)
+
+    def convolution_channels(self, embeddings_dim: int) -> int:
+        return self.channels
+
+    def convolution_macs(self) -> int:
+        """
+        Returns:
+            multiply accumulate operations of both convolutions per residue
+        """
+        if self.rank > 0:
+            return 2 * self.rank * (self.embeddings_dim * self.kernel_size + self.channels)
+        return 2 * self.channels * self.embeddings_dim * self.kernel_size
@@ -7,13 +7,13 @@ from models.legacy.multi_head_attention import MultiHeadAttention
 
 class ConvSelfAttention(nn.Module):
     def __init__(self, embeddings_dim: int = 1024, output_dim: int = 12, dropout=0.25, kernel_size=7,
-                 attention_dropout: float = 0.25, n_heads=8):
+                 attention_dropout: float = 0.25, n_heads=8, scaled_dot_product: bool = True):
         super(ConvSelfAttention, self).__init__()
 
         self.conv1 = nn.Conv1d(embeddings_dim, embeddings_dim, kernel_size=kernel_size, stride=1,
                                padding=kernel_size // 2)
         self.multi_head_attention = MultiHeadAttention(embeddings_dim, attention_dropout, n_heads,
-                                                       skip_last_linear=True)
+                                                       skip_last_linear=True, scaled_dot_product=scaled_dot_product)
 
         self.linear = nn.Sequential(
             nn.Linear(embeddings_dim, 32),
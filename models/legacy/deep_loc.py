@@ -35,48 +35,64 @@ class AdditiveAttention(Attention):
         return torch.tanh(weights) @ self.v  # [seq_length]
 
 class DeepLoc(nn.Module):
-    def __init__(self, embeddings_dim: int, output_dim, lstm_hidden_dim, n_layers, dropout):
+    def __init__(self, embeddings_dim: int, output_dim: int = 10, lstm_hidden_dim: int = 256, n_layers: int = 1,
+                 dropout: float = 0.25, n_filters: int = 20, conv_channels: int = 128):
+        """
+        DeepLoc (Almagro Armenteros et al. 2017): convolutions with six kernel sizes whose outputs are concatenated
+        along the channels, a second convolution and a bidirectional LSTM over the residues of every protein
+        Args:
+            embeddings_dim: dimension of the passed embeddings
+            output_dim: number of classes
+            lstm_hidden_dim: hidden size of each direction of the LSTM
+            n_layers: number of LSTM layers
+            dropout: dropout of the convolution outputs, between the LSTM layers and of the last hidden state
+            n_filters: output channels of each of the six first convolutions
+            conv_channels: output channels of the second convolution and input dimension of the LSTM
+        """
         super(DeepLoc, self).__init__()
 
-        self.conv1 = nn.Conv1d(embeddings_dim, embeddings_dim, 21, stride=1, padding=21 // 2)
-        self.conv2 = nn.Conv1d(embeddings_dim, embeddings_dim, 15, stride=1, padding=15 // 2)
-        self.conv3 = nn.Conv1d(embeddings_dim, embeddings_dim, 9, stride=1, padding=9 // 2)
-        self.conv4 = nn.Conv1d(embeddings_dim, embeddings_dim, 5, stride=1, padding=5 // 2)
-        self.conv5 = nn.Conv1d(embeddings_dim, embeddings_dim, 3, stride=1, padding=3 // 2)
-        self.conv6 = nn.Conv1d(embeddings_dim, embeddings_dim, 1, stride=1, padding=1 // 2)
+        self.conv1 = nn.Conv1d(embeddings_dim, n_filters, 21, stride=1, padding=21 // 2)
+        self.conv2 = nn.Conv1d(embeddings_dim, n_filters, 15, stride=1, padding=15 // 2)
+        self.conv3 = nn.Conv1d(embeddings_dim, n_filters, 9, stride=1, padding=9 // 2)
+        self.conv4 = nn.Conv1d(embeddings_dim, n_filters, 5, stride=1, padding=5 // 2)
+        self.conv5 = nn.Conv1d(embeddings_dim, n_filters, 3, stride=1, padding=3 // 2)
+        self.conv6 = nn.Conv1d(embeddings_dim, n_filters, 1, stride=1, padding=1 // 2)
 
-        self.conv7 = nn.Conv1d(embeddings_dim, embeddings_dim, 3, stride=1, padding=3 // 2)
+        self.conv7 = nn.Conv1d(6 * n_filters, conv_channels, 3, stride=1, padding=3 // 2)
 
         self.dropout = nn.Dropout(dropout)
 
-        self.lstm = nn.LSTM(embeddings_dim, lstm_hidden_dim, num_layers=n_layers, bidirectional=True, dropout=dropout)
-        self.dropout = nn.Dropout(dropout)
+        self.lstm = nn.LSTM(conv_channels, lstm_hidden_dim, num_layers=n_layers, bidirectional=True,
+                            dropout=dropout if n_layers > 1 else 0)
 
         self.output = nn.Linear(lstm_hidden_dim * 2, output_dim)
 
-    def forward(self, x, mask):
+    def forward(self, x, mask, **kwargs):
         """
         Args:
             x: [batch_size, embeddings_dim, sequence_length] embedding tensor that should be classified
+            mask: [batch_size, sequence_length] mask corresponding to the zero padding used for the shorter sequences
 
         Returns:
             classification: [batch_size,output_dim] tensor with logits
         """
-        o1 = F.relu(self.conv1(x))  # [batchsize, embeddingsdim, seq_len]
+        o1 = F.relu(self.conv1(x))  # [batchsize, n_filters, seq_len]
         o2 = F.relu(self.conv2(x))
         o3 = F.relu(self.conv3(x))
         o4 = F.relu(self.conv4(x))
         o5 = F.relu(self.conv5(x))
         o6 = F.relu(self.conv6(x))
 
-        o = torch.cat([o1, o2, o3, o4, o5, o6], dim=-1)  # [batchsize, embeddingsdim, ~sequence_len*6]
+        o = torch.cat([o1, o2, o3, o4, o5, o6], dim=1)  # [batchsize, 6 * n_filters, seq_len]
+        # zero the padding such that the second convolution sees the same inputs as for an unpadded sequence
+        o = o * mask[:, None, :]
 
-        o = F.relu(self.conv7(o))
+        o = F.relu(self.conv7(o))  # [batchsize, conv_channels, seq_len]
         o = self.dropout(o)
-        print(o.shape)
-        o = o.permute(2, 0, 1)  # [seq_len, batch_size, embedding_dim]
+        o = o.permute(2, 0, 1)  # [seq_len, batch_size, conv_channels]
+        # the LSTM only runs over the residues and the hidden states are the ones of the last residue of each sequence
+        o = nn.utils.rnn.pack_padded_sequence(o, mask.sum(dim=-1).cpu(), enforce_sorted=False)
         # num_directions is 2 for a bidirectional lstm
-        # output: [seq_len, batch, num_directions * hidden_size] hidden state of t=seq_len
         # hidden_state: [num_layers * num_directions, batch, hidden_size] hidden state of t=seq_len
         # cell_state: [num_layers * num_directions, batch, hidden_size] cell state of t=seq_len
         output, (hidden_state, cell_state) = self.lstm(o)
@@ -8,10 +8,12 @@ class LSTMConv(nn.Module):
                  kernel_size: int = 9):
         super(LSTMConv, self).__init__()
 
+        self.kernel_size = kernel_size
         self.conv = nn.Conv1d(embeddings_dim, embeddings_dim, kernel_size, stride=1, padding=0)
 
         self.dropout1 = nn.Dropout(dropout)
-        self.lstm = nn.LSTM(embeddings_dim, lstm_hidden_dim, num_layers=n_layers, bidirectional=True, dropout=dropout)
+        self.lstm = nn.LSTM(embeddings_dim, lstm_hidden_dim, num_layers=n_layers, bidirectional=True,
+                            dropout=dropout if n_layers > 1 else 0)
         self.dropout2 = nn.Dropout(dropout)
 
         self.linear = nn.Sequential(
@@ -22,18 +24,23 @@ class LSTMConv(nn.Module):
         )
         self.output = nn.Linear(32, output_dim)
 
-    def forward(self, x, **kwargs):
+    def forward(self, x, mask, **kwargs):
         """
         Args:
             x: [batch_size, embeddings_dim, sequence_length] embedding tensor that should be classified
+            mask: [batch_size, sequence_length] mask corresponding to the zero padding used for the shorter sequences
 
         Returns:
             classification: [batch_size,output_dim] tensor with logits
         """
-        o = F.relu(self.conv(x))  # [batchsize, embeddingsdim, seq_len]
+        o = F.relu(self.conv(x))  # [batchsize, embeddingsdim, seq_len - kernel_size + 1]
 
         o = self.dropout1(o)
-        o = o.permute(2, 0, 1)  # [seq_len, batch_size, embedding_dim]
+        o = o.permute(2, 0, 1)  # [seq_len - kernel_size + 1, batch_size, embedding_dim]
+        # the unpadded convolution shortens every sequence by kernel_size - 1 and the LSTM only runs over the positions
+        # whose receptive field lies within the sequence
+        lengths = (mask.sum(dim=-1) - self.kernel_size + 1).clamp(min=1)
+        o = nn.utils.rnn.pack_padded_sequence(o, lengths.cpu(), enforce_sorted=False)
         # num_directions is 2 for a bidirectional lstm
         # output: [seq_len, batch, num_directions * hidden_size] hidden state of t=seq_len
         # hidden_state: [num_layers * num_directions, batch, hidden_size] hidden state of t=seq_len
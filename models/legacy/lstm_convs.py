@@ -13,19 +13,20 @@ class LSTMConvs(nn.Module):
         self.conv5 = nn.Conv1d(embeddings_dim, embeddings_dim, 3, stride=1, padding=3 // 2)
         self.conv6 = nn.Conv1d(embeddings_dim, embeddings_dim, 1, stride=1, padding=1 // 2)
 
-        self.conv7 = nn.Conv1d(embeddings_dim, embeddings_dim, 3, stride=1, padding=3 // 2)
+        self.conv7 = nn.Conv1d(6 * embeddings_dim, embeddings_dim, 3, stride=1, padding=3 // 2)
 
         self.dropout = nn.Dropout(dropout)
 
-        self.lstm = nn.LSTM(embeddings_dim, lstm_hidden_dim, num_layers=n_layers, bidirectional=True, dropout=dropout)
-        self.dropout = nn.Dropout(dropout)
+        self.lstm = nn.LSTM(embeddings_dim, lstm_hidden_dim, num_layers=n_layers, bidirectional=True,
+                            dropout=dropout if n_layers > 1 else 0)
 
         self.output = nn.Linear(lstm_hidden_dim * 2, output_dim)
 
-    def forward(self, x, mask):
+    def forward(self, x, mask, **kwargs):
         """
         Args:
             x: [batch_size, embeddings_dim, sequence_length] embedding tensor that should be classified
+            mask: [batch_size, sequence_length] mask corresponding to the zero padding used for the shorter sequences
 
         Returns:
             classification: [batch_size,output_dim] tensor with logits
@@ -37,14 +38,16 @@ class LSTMConvs(nn.Module):
         o5 = F.relu(self.conv5(x))
         o6 = F.relu(self.conv6(x))
 
-        o = torch.cat([o1, o2, o3, o4, o5, o6], dim=-1)  # [batchsize, embeddingsdim, ~sequence_len*6]
+        o = torch.cat([o1, o2, o3, o4, o5, o6], dim=1)  # [batchsize, 6 * embeddingsdim, seq_len]
+        # zero the padding such that the last convolution sees the same inputs as for an unpadded sequence
+        o = o * mask[:, None, :]
 
         o = F.relu(self.conv7(o))
         o = self.dropout(o)
-        print(o.shape)
         o = o.permute(2, 0, 1)  # [seq_len, batch_size, embedding_dim]
+        # the LSTM only runs over the residues and the hidden states are the ones of the last residue of each sequence
+        o = nn.utils.rnn.pack_padded_sequence(o, mask.sum(dim=-1).cpu(), enforce_sorted=False)
         # num_directions is 2 for a bidirectional lstm
-        # output: [seq_len, batch, num_directions * hidden_size] hidden state of t=seq_len
         # hidden_state: [num_layers * num_directions, batch, hidden_size] hidden state of t=seq_len
         # cell_state: [num_layers * num_directions, batch, hidden_size] cell state of t=seq_len
         output, (hidden_state, cell_state) = self.lstm(o)
@@ -2,16 +2,21 @@ import math
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class MultiHeadAttention(nn.Module):
-    def __init__(self, embeddings_dim: int = 1024, dropout: float = 0.25, n_heads: int = 8, skip_last_linear=False):
+    def __init__(self, embeddings_dim: int = 1024, dropout: float = 0.25, n_heads: int = 8, skip_last_linear=False,
+                 scaled_dot_product: bool = True):
         """
         CAREFUL: this does not do the multihead attention from the paper. The last linear layer is missing.
         Args:
             embeddings_dim: dimension of the passed embeddings
             dropout: dropout values
             n_heads: number of attention heads needs to be a divider of embeddings dim (see paper "Attention is all you need!")
+            scaled_dot_product: compute the attention with F.scaled_dot_product_attention, which uses fused kernels
+            that do not materialize the [batch size, n heads, query len, key len] scores where they are available.
+            The attention weights are then not returned. If it is False, the scores are computed with torch.matmul.
         """
         super().__init__()
 
@@ -29,8 +34,20 @@ class MultiHeadAttention(nn.Module):
         self.last_linear = nn.Linear(embeddings_dim, embeddings_dim)
 
         self.dropout = nn.Dropout(dropout)
+        self.scaled_dot_product = scaled_dot_product
 
-    def forward(self, query, key, value, mask):
+    def forward(self, query, key, value, mask=None):
+        """
+        Args:
+            query: [batch size, query len, embeddigns_dim] or [batch size, embeddigns_dim] for a single query
+            key: [batch size, key len, embeddigns_dim]
+            value: [batch size, value len, embeddigns_dim]
+            mask: [batch size, key len] mask that is False for the padding of the keys or None for no padding
+
+        Returns:
+            x: [batch size, query len, embeddigns_dim] and the [batch size, n heads, query len, key len] attention
+            weights (None with scaled_dot_product)
+        """
         batch_size = query.shape[0]
 
         # query = [batch size, query len, embeddigns_dim]
@@ -53,16 +70,21 @@ class MultiHeadAttention(nn.Module):
         # K = [batch size, n heads, key len, head dim]
         # V = [batch size, n heads, value len, head dim]
 
-        attention_scores = torch.matmul(Q, K.permute(0, 1, 3, 2)) / math.sqrt(self.head_dim)
-        if mask != None:
-            attention_scores.masked_fill(mask[:, None, None, :].expand(-1, 1, attention_scores.shape[2], -1) == False,
-                                         -1e9)
+        if self.scaled_dot_product:
+            attention = None
+            key_padding_mask = None if mask is None else mask[:, None, None, :].bool()  # True for the keys to attend to
+            x = F.scaled_dot_product_attention(Q, K, V, attn_mask=key_padding_mask,
+                                               dropout_p=self.dropout.p if self.training else 0.0)
+        else:
+            attention_scores = torch.matmul(Q, K.permute(0, 1, 3, 2)) / math.sqrt(self.head_dim)
+            if mask is not None:
+                attention_scores = attention_scores.masked_fill(mask[:, None, None, :] == False, -1e9)
 
-        attention = torch.softmax(attention_scores, dim=-1)
+            attention = torch.softmax(attention_scores, dim=-1)
 
-        # attention = [batch size, n heads, query len, key len]
+            # attention = [batch size, n heads, query len, key len]
 
-        x = torch.matmul(self.dropout(attention), V)  # x = [batch size, n heads, query len, head dim]
+            x = torch.matmul(self.dropout(attention), V)  # x = [batch size, n heads, query len, head dim]
 
         x = x.permute(0, 2, 1, 3).contiguous()
 
@@ -5,10 +5,12 @@ from models.legacy.multi_head_attention import MultiHeadAttention
 
 
 class SelfAttention(nn.Module):
-    def __init__(self, embeddings_dim: int = 1024, output_dim: int = 12 , dropout=0.25, attention_dropout=0.25, n_heads=8):
+    def __init__(self, embeddings_dim: int = 1024, output_dim: int = 12 , dropout=0.25, attention_dropout=0.25, n_heads=8,
+                 scaled_dot_product: bool = True):
         super(SelfAttention, self).__init__()
 
-        self.multi_head_attention = MultiHeadAttention(embeddings_dim, attention_dropout, n_heads, skip_last_linear=True)
+        self.multi_head_attention = MultiHeadAttention(embeddings_dim, attention_dropout, n_heads,
+                                                       skip_last_linear=True, scaled_dot_product=scaled_dot_product)
 
         self.linear = nn.Sequential(
             nn.Linear(embeddings_dim, 32),
@@ -5,12 +5,14 @@ from models.legacy.multi_head_attention import MultiHeadAttention
 
 
 class SelfAttentionMaxAvgPool(nn.Module):
-    def __init__(self, embeddings_dim: int = 1024, output_dim: int = 12 , dropout=0.25, attention_dropout=0.25, n_heads=8):
+    def __init__(self, embeddings_dim: int = 1024, output_dim: int = 12 , dropout=0.25, attention_dropout=0.25, n_heads=8,
+                 scaled_dot_product: bool = True):
         super(SelfAttentionMaxAvgPool, self).__init__()
 
-        self.multi_head_attention1 = MultiHeadAttention(embeddings_dim, attention_dropout, n_heads)
+        self.multi_head_attention1 = MultiHeadAttention(embeddings_dim, attention_dropout, n_heads,
+                                                        scaled_dot_product=scaled_dot_product)
         self.multi_head_attention2 = MultiHeadAttention(embeddings_dim, attention_dropout, n_heads,
-                                                        skip_last_linear=True)
+                                                        skip_last_linear=True, scaled_dot_product=scaled_dot_product)
 
         self.linear = nn.Sequential(
             nn.Linear(2*embeddings_dim, 32),
@@ -30,7 +32,7 @@ class SelfAttentionMaxAvgPool(nn.Module):
         """
         x = x.permute(0, 2, 1)  # [batch_size, sequence_length, embeddings_dim]
 
-        o, _ = self.multi_head_attention1(x, x, x)
+        o, _ = self.multi_head_attention1(x, x, x, mask)
 
         o1 = torch.mean(o, dim=-2)
         o2, _ = torch.max(o, dim=-2)
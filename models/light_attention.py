@@ -1,22 +1,65 @@
+from typing import Callable, List, Tuple
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 class LightAttention(nn.Module):
-    def __init__(self, embeddings_dim=1024, output_dim=11, dropout=0.25, kernel_size=9, conv_dropout: float = 0.25):
+    def __init__(self, embeddings_dim=1024, output_dim=11, dropout=0.25, kernel_size=9, conv_dropout: float = 0.25,
+                 activation_checkpointing: bool = False, fused_convolution: bool = False, packed: bool = False,
+                 chunk_size: int = 0, fused_pooling: bool = False):
+        """
+        Light attention architecture that pools the per residue embeddings with a softmax over the length dimension
+        that is weighted by a convolution and with max pooling and classifies the pooled features.
+        Args:
+            embeddings_dim: dimension of the input
+            output_dim: output dimension (number of classes that should be classified)
+            dropout: dropout ratio of the linear layer
+            kernel_size: kernel size of the feature and attention convolutions
+            conv_dropout: dropout ratio applied to the output of the feature convolution
+            activation_checkpointing: during training, do not keep the [batch_size, embeddings_dim, sequence_length]
+            activations of the convolutions and the attention pooling for the backward pass but recompute them in it.
+            Trades one additional forward pass of the convolutions for the memory of these activations.
+            fused_convolution: compute the feature and the attention convolution with one convolution with
+            2*embeddings_dim output channels such that the input is only read once. State dicts of the unfused model
+            can be converted with fuse_convolutions_state_dict.
+            packed: concatenate the sequences of a batch into one stream in which they are separated by kernel_size // 2
+            zeros instead of running the convolutions on the padding and pool each sequence separately. The compute
+            scales with the number of residues and the max pooling does not include padding such that the output of a
+            sequence does not depend on the other sequences in the batch.
+            chunk_size: in eval mode, run the convolutions on chunks of at most chunk_size positions with a halo of
+            kernel_size // 2 positions and combine the pooling of the chunks with a streaming softmax and a running max
+            such that the memory of the activations is bounded by the chunk size instead of the sequence length
+            (0 for off). The result is the same as without chunks.
+            fused_pooling: during training, compute the attention convolution together with the masked softmax
+            attention pooling and the max pooling in MaskedAttentionPool, which keeps neither the attention logits nor
+            the softmax for the backward pass but recomputes the logits from the input that the feature convolution
+            keeps anyway. Saves one [batch_size, embeddings_dim, sequence_length] activation for one additional
+            forward pass of the attention convolution. The max pooling then also excludes the padding.
+        """
         super(LightAttention, self).__init__()
+        self.activation_checkpointing = activation_checkpointing
+        self.fused_convolution = fused_convolution
+        self.packed = packed
+        self.separator = kernel_size // 2  # zeros between the packed sequences such that the convolutions do not mix them
+        self.chunk_size = chunk_size
+        self.fused_pooling = fused_pooling
 
-        self.feature_convolution = nn.Conv1d(embeddings_dim, embeddings_dim, kernel_size, stride=1,
-                                             padding=kernel_size // 2)
-        self.attention_convolution = nn.Conv1d(embeddings_dim, embeddings_dim, kernel_size, stride=1,
-                                               padding=kernel_size // 2)
+        if fused_convolution:  # output channels [:embeddings_dim] are the features and the rest the attention
+            self.convolution = nn.Conv1d(embeddings_dim, 2 * embeddings_dim, kernel_size, stride=1,
+                                         padding=kernel_size // 2)
+        else:
+            self.feature_convolution = self.make_convolution(embeddings_dim, kernel_size)
+            self.attention_convolution = self.make_convolution(embeddings_dim, kernel_size)
 
         self.softmax = nn.Softmax(dim=-1)
 
         self.dropout = nn.Dropout(conv_dropout)
 
         self.linear = nn.Sequential(
-            nn.Linear(2 * embeddings_dim, 32),
+            nn.Linear(2 * self.convolution_channels(embeddings_dim), 32),
             nn.Dropout(dropout),
             nn.ReLU(),
             nn.BatchNorm1d(32)
@@ -24,6 +67,20 @@ class LightAttention(nn.Module):
 
         self.output = nn.Linear(32, output_dim)
 
+    def make_convolution(self, embeddings_dim: int, kernel_size: int) -> nn.Module:
+        """
+        Returns:
+            the feature or the attention convolution (cheaper ones in CompressedLightAttention)
+        """
+        return nn.Conv1d(embeddings_dim, embeddings_dim, kernel_size, stride=1, padding=kernel_size // 2)
+
+    def convolution_channels(self, embeddings_dim: int) -> int:
+        """
+        Returns:
+            output channels of the feature and the attention convolution
+        """
+        return embeddings_dim
+
     def forward(self, x: torch.Tensor, mask, **kwargs) -> torch.Tensor:
         """
         Args:
@@ -33,9 +90,97 @@ class LightAttention(nn.Module):
         Returns:
             classification: [batch_size,output_dim] tensor with logits
         """
-        o = self.feature_convolution(x)  # [batch_size, embeddings_dim, sequence_length]
+        if self.activation_checkpointing and self.training and torch.is_grad_enabled():
+            # the rng state is restored for the recomputation such that the dropout mask is the same
+            o = checkpoint(self.pool, x, mask, use_reentrant=False)  # [batchsize, 2*embeddings_dim]
+        else:
+            o = self.pool(x, mask)  # [batchsize, 2*embeddings_dim]
+        return self.classify(o)  # [batchsize, output_dim]
+
+    def classify(self, o: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+            o: [batch_size, 2*embeddings_dim] pooled features as returned by pool
+
+        Returns:
+            classification: [batch_size,output_dim] tensor with logits
+        """
+        o = self.linear(o)  # [batchsize, 32]
+        return self.output(o)  # [batchsize, output_dim]
+
+    def convolve(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            x: [batch_size, embeddings_dim, sequence_length] embedding tensor
+
+        Returns:
+            [batch_size, embeddings_dim, sequence_length] features and attention logits
+        """
+        if self.fused_convolution:
+            return self.convolution(x).chunk(2, dim=1)
+        return self.feature_convolution(x), self.attention_convolution(x)
+
+    def convolve_features(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+            x: [batch_size, embeddings_dim, sequence_length] embedding tensor
+
+        Returns:
+            [batch_size, embeddings_dim, sequence_length] features without computing the attention logits
+        """
+        if self.fused_convolution:
+            channels = self.convolution.out_channels // 2
+            return F.conv1d(x, self.convolution.weight[:channels], self.convolution.bias[:channels],
+                            padding=self.convolution.padding)
+        return self.feature_convolution(x)
+
+    def convolve_attention(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+            x: [batch_size, embeddings_dim, sequence_length] embedding tensor
+
+        Returns:
+            [batch_size, embeddings_dim, sequence_length] attention logits without computing the features
+        """
+        if self.fused_convolution:
+            channels = self.convolution.out_channels // 2
+            return F.conv1d(x, self.convolution.weight[channels:], self.convolution.bias[channels:],
+                            padding=self.convolution.padding)
+        return self.attention_convolution(x)
+
+    def attention_parameters(self) -> List[nn.Parameter]:
+        """
+        Returns:
+            the parameters that convolve_attention uses
+        """
+        return list((self.convolution if self.fused_convolution else self.attention_convolution).parameters())
+
+    def pool(self, x: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        """
+        Convolutions and attention and max pooling over the length dimension
+        Args:
+            x: [batch_size, embeddings_dim, sequence_length] embedding tensor that should be classified
+            mask: [batch_size, sequence_length] mask corresponding to the zero padding
+
+        Returns:
+            [batch_size, 2*embeddings_dim] the attention pooled and max pooled features
+        """
+        if self.chunk_size > 0 and not self.training and x.shape[-1] > self.chunk_size:
+            return self.chunked_pool(x, mask)
+        if self.packed:
+            return self.packed_pool(x, mask)
+        if self.fused_pooling and torch.is_grad_enabled():
+            o = self.dropout(self.convolve_features(x))  # [batch_size, embeddings_dim, sequence_length]
+            # the attention logits are computed in MaskedAttentionPool and recomputed from x in its backward pass
+            o1, o2 = MaskedAttentionPool.apply(o, x, mask, self.convolve_attention, *self.attention_parameters())
+            return torch.cat([o1, o2], dim=-1)  # [batchsize, 2*embeddings_dim]
+        o, attention = self.convolve(x)  # [batch_size, embeddings_dim, sequence_length] each
         o = self.dropout(o)  # [batch_gsize, embeddings_dim, sequence_length]
-        attention = self.attention_convolution(x)  # [batch_size, embeddings_dim, sequence_length]
+        if self.fused_pooling:  # nothing is kept for a backward pass and these operations can be traced and exported
+            attention = attention.masked_fill(mask[:, None, :] == False, float('-inf'))
+            o1 = torch.sum(o * self.softmax(attention), dim=-1)  # [batchsize, embeddings_dim]
+            o2, _ = torch.max(o.masked_fill(mask[:, None, :] == False, float('-inf')), dim=-1)
+            return torch.cat([o1, o2], dim=-1)  # [batchsize, 2*embeddings_dim]
 
         # mask out the padding to which we do not want to pay any attention (we have the padding because the sequences have different lenghts).
         # This padding is added by the dataloader when using the padded_permuted_collate function in utils/general.py
@@ -47,6 +192,218 @@ class LightAttention(nn.Module):
 
         o1 = torch.sum(o * self.softmax(attention), dim=-1)  # [batchsize, embeddings_dim]
         o2, _ = torch.max(o, dim=-1)  # [batchsize, embeddings_dim]
-        o = torch.cat([o1, o2], dim=-1)  # [batchsize, 2*embeddings_dim]
-        o = self.linear(o)  # [batchsize, 32]
-        return self.output(o)  # [batchsize, output_dim]
+        return torch.cat([o1, o2], dim=-1)  # [batchsize, 2*embeddings_dim]
+
+    def chunked_pool(self, x: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        """
+        Like pool but the length dimension is processed in chunks of chunk_size. Every chunk is convolved together with
+        kernel_size // 2 neighbouring positions on each side such that its outputs are the same as in the full
+        convolution. The softmax is accumulated online: the running maximum of the attention logits is kept and the
+        accumulated numerator and denominator are rescaled whenever it increases.
+        Args:
+            x: [batch_size, embeddings_dim, sequence_length] embedding tensor that should be classified
+            mask: [batch_size, sequence_length] mask corresponding to the zero padding
+
+        Returns:
+            [batch_size, 2*embeddings_dim] the attention pooled and max pooled features
+        """
+        batch_size, _, sequence_length = x.shape
+        embeddings_dim = self.linear[0].in_features // 2  # output channels of the convolutions
+        halo = self.separator
+        maximum = x.new_full((batch_size, embeddings_dim), float('-inf'))  # running maximum of the attention logits
+        numerator = x.new_zeros(batch_size, embeddings_dim)  # sum of exp(attention - maximum) * features
+        denominator = x.new_zeros(batch_size, embeddings_dim)  # sum of exp(attention - maximum)
+        max_pooled = x.new_full((batch_size, embeddings_dim), float('-inf'))
+        for start in range(0, sequence_length, self.chunk_size):
+            end = min(start + self.chunk_size, sequence_length)
+            window_start, window_end = max(start - halo, 0), min(end + halo, sequence_length)
+            o, attention = self.convolve(x[:, :, window_start:window_end])
+            o = o[:, :, start - window_start:end - window_start]  # [batch_size, embeddings_dim, chunk_length]
+            attention = attention[:, :, start - window_start:end - window_start]
+            chunk_mask = mask[:, None, start:end]  # [batch_size, 1, chunk_length]
+            attention = attention.masked_fill(chunk_mask == False, -1e9)
+            if self.packed or self.fused_pooling:  # as in their pool the padding is not max pooled
+                o_max = o.masked_fill(chunk_mask == False, float('-inf'))
+            else:
+                o_max = o
+
+            new_maximum = torch.maximum(maximum, attention.max(dim=-1)[0])  # [batch_size, embeddings_dim]
+            rescale = torch.exp(maximum - new_maximum)  # 0 for the first chunk
+            weights = torch.exp(attention - new_maximum[:, :, None])  # [batch_size, embeddings_dim, chunk_length]
+            numerator = numerator * rescale + torch.sum(o * weights, dim=-1)
+            denominator = denominator * rescale + torch.sum(weights, dim=-1)
+            maximum = new_maximum
+            max_pooled = torch.maximum(max_pooled, o_max.max(dim=-1)[0])
+        return torch.cat([numerator / denominator, max_pooled], dim=-1)  # [batchsize, 2*embeddings_dim]
+
+    def packed_pool(self, x: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        """
+        Like pool but the convolutions run on the packed sequences and the pooling is done per sequence
+        Args:
+            x: [batch_size, embeddings_dim, sequence_length] embedding tensor that should be classified
+            mask: [batch_size, sequence_length] mask corresponding to the zero padding
+
+        Returns:
+            [batch_size, 2*embeddings_dim] the attention pooled and max pooled features
+        """
+        stream, positions, segments = pack_sequences(x, mask, self.separator)  # stream: [1, embeddings_dim, length]
+        o, attention = self.convolve(stream)  # [1, embeddings_dim, stream_length] each
+        o = self.dropout(o[0, :, positions].t())  # [n_residues, embeddings_dim]
+        attention = attention[0, :, positions].t()  # [n_residues, embeddings_dim]
+        return segment_attention_max_pool(o, attention, segments, len(x))  # [batchsize, 2*embeddings_dim]
+
+
+class MaskedAttentionPool(torch.autograd.Function):
+    """
+    Attention convolution followed by the softmax attention pooling and the max pooling over the length dimension where
+    the padding is excluded from both:
+    sum_l o[..., l] * softmax(attention_function(x).masked_fill(mask == False, -inf))[..., l] and
+    max_l o.masked_fill(mask == False, -inf)[..., l]
+    Only o, x (which the feature convolution saves anyway), the parameters of attention_function and [batch_size,
+    embeddings_dim] tensors are saved for the backward pass. The attention logits are recomputed from x in the backward
+    pass and the softmax from them and the saved log-sum-exp. The forward pass computes everything in the buffer of the
+    attention logits.
+    """
+
+    @staticmethod
+    def forward(ctx, o: torch.Tensor, x: torch.Tensor, mask: torch.Tensor,
+                attention_function: Callable[[torch.Tensor], torch.Tensor], *parameters: torch.Tensor) -> Tuple[
+        torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            o: [batch_size, embeddings_dim, sequence_length] features
+            x: [batch_size, input_dim, sequence_length] input of attention_function
+            mask: [batch_size, sequence_length] mask that is False for the padding
+            attention_function: computes the [batch_size, embeddings_dim, sequence_length] attention logits from x
+            *parameters: the parameters that attention_function uses
+
+        Returns:
+            [batch_size, embeddings_dim] attention pooled and [batch_size, embeddings_dim] max pooled features
+        """
+        padding = mask[:, None, :] == False
+        weights = attention_function(x).masked_fill_(padding, float('-inf'))  # [batch_size, embeddings_dim, length]
+        log_sum_exp = torch.logsumexp(weights, dim=-1)  # [batch_size, embeddings_dim]
+        weights = weights.sub_(log_sum_exp[:, :, None]).exp_()  # softmax in place
+        attention_pooled = weights.mul_(o).sum(dim=-1)  # [batch_size, embeddings_dim]
+        max_pooled, indices = weights.copy_(o).masked_fill_(padding, float('-inf')).max(dim=-1)
+        ctx.attention_function = attention_function
+        ctx.save_for_backward(o, x, mask, log_sum_exp, attention_pooled, indices, *parameters)
+        return attention_pooled, max_pooled
+
+    @staticmethod
+    def backward(ctx, grad_attention_pooled: torch.Tensor, grad_max_pooled: torch.Tensor) -> Tuple[
+        torch.Tensor, torch.Tensor, None, None]:
+        o, x, mask, log_sum_exp, attention_pooled, indices, *parameters = ctx.saved_tensors
+        needs_input_grad = [ctx.needs_input_grad[1]] + list(ctx.needs_input_grad[4:])
+        inputs = [tensor for tensor, needed in zip([x.detach().requires_grad_()] + parameters, needs_input_grad)
+                  if needed]
+        with torch.enable_grad():
+            attention = ctx.attention_function(inputs[0] if needs_input_grad[0] else x)
+        weights = attention.detach().masked_fill(mask[:, None, :] == False, float('-inf'))
+        weights = weights.sub_(log_sum_exp[:, :, None]).exp_()  # [batch_size, embeddings_dim, sequence_length]
+        grad_attention_pooled = grad_attention_pooled[:, :, None]
+        grad_o = None
+        if ctx.needs_input_grad[0]:
+            grad_o = weights * grad_attention_pooled
+            grad_o.scatter_add_(-1, indices[:, :, None], grad_max_pooled[:, :, None])
+        input_grads = []
+        if inputs:  # d attention_pooled / d attention_l = weights_l * (o_l - attention_pooled)
+            grad_attention = weights.mul_(o - attention_pooled[:, :, None]).mul_(grad_attention_pooled)
+            input_grads = list(torch.autograd.grad(attention, inputs, grad_attention))
+        grads = [input_grads.pop(0) if needed else None for needed in needs_input_grad]
+        return (grad_o, grads[0], None, None, *grads[1:])
+
+
+def pack_sequences(x: torch.Tensor, mask: torch.Tensor, separator: int) -> Tuple[torch.Tensor, torch.Tensor,
+                                                                                 torch.Tensor]:
+    """
+    Concatenate the residues of a padded batch into one stream in which consecutive sequences are separated by zeros
+    Args:
+        x: [batch_size, embeddings_dim, sequence_length] padded embeddings
+        mask: [batch_size, sequence_length] True for residues and False for the padding at the end of each sequence
+        separator: number of zeros between two sequences. With kernel_size // 2 a convolution with zero padding of
+        kernel_size // 2 gives the same result for every residue as for the sequence on its own
+
+    Returns:
+        stream: [1, embeddings_dim, n_residues + separator * (batch_size - 1)] packed embeddings
+        positions: [n_residues] position of every residue in the stream ordered by sequence
+        segments: [n_residues] index of the sequence of every residue
+    """
+    batch_size, embeddings_dim, sequence_length = x.shape
+    lengths = mask.sum(dim=-1)  # [batch_size]
+    strides = lengths + separator
+    offsets = torch.cumsum(strides, dim=0) - strides  # [batch_size] start of every sequence in the stream
+    positions = (offsets[:, None] + torch.arange(sequence_length, device=x.device)[None, :])[mask]  # [n_residues]
+    segments = torch.arange(batch_size, device=x.device)[:, None].expand(-1, sequence_length)[mask]  # [n_residues]
+    stream = x.new_zeros(embeddings_dim, int(strides.sum()) - separator)
+    stream[:, positions] = x.permute(1, 0, 2)[:, mask]  # [embeddings_dim, n_residues] into the stream
+    return stream[None], positions, segments
+
+
+def segment_attention_max_pool(o: torch.Tensor, attention: torch.Tensor, segments: torch.Tensor,
+                               n_segments: int) -> torch.Tensor:
+    """
+    Softmax attention pooling and max pooling of the residues of every segment
+    Args:
+        o: [n_residues, embeddings_dim] features
+        attention: [n_residues, embeddings_dim] attention logits
+        segments: [n_residues] index of the segment of every residue
+        n_segments: number of segments
+
+    Returns:
+        [n_segments, 2*embeddings_dim] the attention pooled and max pooled features of every segment
+    """
+    index = segments[:, None].expand_as(o)
+    empty = o.new_full((n_segments, o.shape[-1]), float('-inf'))
+    # the softmax does not depend on the subtracted maximum so it does not need a gradient
+    maximum = empty.scatter_reduce(0, index, attention.detach(), reduce='amax')  # [n_segments, embeddings_dim]
+    weights = torch.exp(attention - maximum[segments])  # [n_residues, embeddings_dim]
+    normalizer = o.new_zeros(n_segments, o.shape[-1]).index_add(0, segments, weights)
+    o1 = o.new_zeros(n_segments, o.shape[-1]).index_add(0, segments, o * weights) / normalizer
+    o2 = empty.scatter_reduce(0, index, o, reduce='amax')  # [n_segments, embeddings_dim]
+    return torch.cat([o1, o2], dim=-1)
+
+
+def fuse_convolutions_state_dict(state_dict: dict) -> dict:
+    """
+    Map the state dict of a LightAttention with separate convolutions onto one with fused_convolution
+    Args:
+        state_dict: state dict with feature_convolution and attention_convolution parameters
+
+    Returns:
+        the state dict with the concatenated parameters as convolution. The order of the keys is kept.
+    """
+    fused = {}
+    for key, value in state_dict.items():
+        if key.startswith('feature_convolution.'):
+            name = key[len('feature_convolution.'):]
+            fused['convolution.' + name] = torch.cat([value, state_dict['attention_convolution.' + name]], dim=0)
+        elif not key.startswith('attention_convolution.'):
+            fused[key] = value
+    return fused
+
+
+def fuse_convolutions_optimizer_state_dict(optimizer_state_dict: dict) -> dict:
+    """
+    Map the state of an optimizer with per parameter state like Adam of a LightAttention with separate convolutions
+    onto one with fused_convolution. The feature convolution weight and bias and the attention convolution weight and
+    bias are the first four parameters of the unfused model and the fused weight and bias the first two of the fused one.
+    Args:
+        optimizer_state_dict: state dict of an optimizer with one parameter group over model.parameters()
+
+    Returns:
+        the optimizer state dict for the parameters of the fused model
+    """
+    state = optimizer_state_dict['state']
+    fused_state = {}
+    for fused_index, (feature_index, attention_index) in enumerate([(0, 2), (1, 3)]):
+        if feature_index in state:
+            fused_state[fused_index] = {
+                key: torch.cat([value, state[attention_index][key]], dim=0) if torch.is_tensor(value) and value.dim() > 0
+                else value for key, value in state[feature_index].items()}
+    for index, value in state.items():
+        if index >= 4:
+            fused_state[index - 2] = value
+    param_groups = [{**group, 'params': list(range(len(group['params']) - 2))}
+                    for group in optimizer_state_dict['param_groups']]
+    return {'state': fused_state, 'param_groups': param_groups}
@@ -83,3 +83,51 @@ class SolCrossEntropy(nn.Module):
             """
         solubility_loss = F.cross_entropy(prediction[..., -2:], solubility)
         return solubility_loss, torch.tensor([0]), solubility_loss
+
+
+class DistillationLoss(nn.Module):
+    def __init__(self, weight=None) -> None:
+        '''
+            Knowledge distillation loss for training a student on the cached soft logits of a teacher
+        Args:
+            weight: weights for the individual classes of the localization cross entropy
+        '''
+        super(DistillationLoss, self).__init__()
+        self.joint_cross_entropy = JointCrossEntropy(weight)
+        self.loc_cross_entropy = LocCrossEntropy(weight)
+
+    def forward(self, prediction: Tensor, localization: Tensor, solubility: Tensor, solubility_known: bool, args,
+                teacher_logits: Tensor = None) -> Tuple[Tensor, Tensor, Tensor]:
+        """
+            The cross entropy with the labels (JointCrossEntropy for 12 logits and LocCrossEntropy otherwise) weighted
+            by 1 - args.distillation_weight plus the KL divergence between the localization distributions of teacher and
+            student at args.distillation_temperature weighted by args.distillation_weight. The KL divergence is scaled
+            by temperature^2 such that its gradients have the same magnitude for every temperature.
+            Args:
+                prediction: output of the network with 10 or 12 logits where the last two are for the solubility
+                localization: true label for localization
+                solubility: true label for solubility
+                solubility_known: tensor on device whether or not the solubility is known
+                args: training arguments containing the distillation temperature and weight
+                teacher_logits: [batch_size, teacher_output_dim] logits of the teacher or None for batches without them
+                like the ones of the validation set for which only the cross entropy is returned
+
+            Returns:
+                loss: the overall loss
+                loc_loss: loss of localization information
+                sol_loss: loss of the solubility prediction
+            """
+        if prediction.shape[-1] > 10:
+            loss, loc_loss, sol_loss = self.joint_cross_entropy(prediction, localization, solubility,
+                                                                solubility_known, args)
+        else:
+            loss, loc_loss, sol_loss = self.loc_cross_entropy(prediction, localization, solubility,
+                                                              solubility_known, args)
+        if teacher_logits is None:
+            return loss, loc_loss, sol_loss
+        temperature = args.distillation_temperature
+        distillation_loss = F.kl_div(F.log_softmax(prediction[..., :10] / temperature, dim=-1),
+                                     F.softmax(teacher_logits[..., :10] / temperature, dim=-1),
+                                     reduction='batchmean') * temperature ** 2
+        loss = (1 - args.distillation_weight) * loss + args.distillation_weight * distillation_loss
+        return loss, loc_loss, sol_loss
@@ -0,0 +1,135 @@
+import argparse
+import os
+from typing import Tuple
+
+import h5py
+import numpy as np
+import yaml
+from sklearn.decomposition import IncrementalPCA
+from tqdm import tqdm
+
+
+def fit_pca(embeddings_path: str, n_components: int, batch_residues: int, residue_fraction: float,
+            seed: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fit a PCA of the residues of a per residue embeddings file with an IncrementalPCA that is updated with batches of
+    residues while streaming over the proteins such that the file never has to fit into memory
+    Args:
+        embeddings_path: h5 file with [length, embeddings_dim] embeddings
+        n_components: number of principal components to fit
+        batch_residues: number of residues in every update (at least n_components)
+        residue_fraction: fraction of the residues of every protein that are randomly sampled for fitting
+        seed: seed of the residue sampling
+
+    Returns:
+        [embeddings_dim] mean, [n_components, embeddings_dim] components and [n_components] explained variance ratio
+    """
+    pca = IncrementalPCA(n_components=n_components)
+    batch_residues = max(batch_residues, n_components)
+    random_state = np.random.RandomState(seed)
+    buffer = []
+    n_buffered = 0
+    with h5py.File(embeddings_path, 'r') as file:
+        for key in tqdm(file.keys()):
+            embedding = file[key][:]
+            if residue_fraction < 1:
+                embedding = embedding[random_state.rand(len(embedding)) < residue_fraction]
+            buffer.append(embedding)
+            n_buffered += len(embedding)
+            if n_buffered >= batch_residues:
+                pca.partial_fit(np.concatenate(buffer))
+                buffer = []
+                n_buffered = 0
+    if n_buffered >= n_components:  # the last update needs at least n_components residues
+        pca.partial_fit(np.concatenate(buffer))
+    return pca.mean_, pca.components_, pca.explained_variance_ratio_
+
+
+def random_projection(embeddings_dim: int, n_components: int, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Gaussian random projection that approximately preserves the distances between the residues
+
+    Returns:
+        [embeddings_dim] zero mean and [n_components, embeddings_dim] components
+    """
+    components = np.random.RandomState(seed).normal(0, 1 / np.sqrt(n_components), (n_components, embeddings_dim))
+    return np.zeros(embeddings_dim), components
+
+
+def project_stores(stores: list, projections: dict, output_dir: str, dtype: str):
+    """
+    Write a projected copy of every per residue embeddings file for every projection. Every file is only read once.
+    Args:
+        stores: h5 files with [length, embeddings_dim] embeddings
+        projections: dictionary from a name like pca_256 to the mean and components of the projection
+        output_dir: directory of the projected files <name of the store>_<name of the projection>.h5
+        dtype: dtype of the projected embeddings
+    """
+    for store in stores:
+        name = os.path.splitext(os.path.basename(store))[0]
+        outputs = {projection: h5py.File(os.path.join(output_dir, '{}_{}.h5'.format(name, projection)), 'w')
+                   for projection in projections}
+        with h5py.File(store, 'r') as file:
+            for key in tqdm(file.keys(), desc=name):
+                embedding = file[key][:]
+                for projection, (mean, components) in projections.items():
+                    projected = (embedding - mean) @ components.T  # [length, n_components]
+                    outputs[projection].create_dataset(key, data=projected.astype(dtype))
+        for projection, output in outputs.items():
+            output.attrs['projection'] = os.path.join(output_dir, projection + '.npz')
+            output.close()
+
+
+def project_embeddings(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    with h5py.File(args.fit_embeddings, 'r') as file:
+        embeddings_dim = file[next(iter(file.keys()))].shape[-1]
+    projections = {}
+    if args.method == 'pca':  # the first k principal components of the largest PCA are the PCA with k components
+        mean, components, explained_variance_ratio = fit_pca(args.fit_embeddings, max(args.dims),
+                                                             args.batch_residues, args.residue_fraction, args.seed)
+        for dim in args.dims:
+            projections['pca_{}'.format(dim)] = (mean, components[:dim])
+            print('PCA with {} components explains {:.2f}% of the variance'.format(
+                dim, 100 * explained_variance_ratio[:dim].sum()))
+    elif args.method == 'random':
+        for dim in args.dims:
+            projections['random_{}'.format(dim)] = random_projection(embeddings_dim, dim, args.seed)
+    else:
+        raise ValueError('Unknown projection method: {}'.format(args.method))
+
+    projections = {projection: (mean.astype(np.float32), components.astype(np.float32))
+                   for projection, (mean, components) in projections.items()}
+    for projection, (mean, components) in projections.items():
+        np.savez(os.path.join(args.output_dir, projection + '.npz'), mean=mean, components=components)
+    project_stores(args.stores, projections, args.output_dir, args.dtype)
+    print('Saved the projections and projected embeddings to {}'.format(args.output_dir))
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser()
+    p.add_argument('--config', type=argparse.FileType(mode='r'), default='configs/projection.yaml')
+    p.add_argument('--method', type=str, default='pca', help='projection to fit [pca, random]')
+    p.add_argument('--dims', type=list, default=[256, 512], help='dimensions of the projected embeddings')
+    p.add_argument('--fit_embeddings', type=str, default='data_files/deeploc_our_train_embeddings.h5',
+                   help='per residue embeddings on which the PCA is fitted (only the train set to not leak val data)')
+    p.add_argument('--stores', type=list, default=[],
+                   help='per residue embeddings files of which a projected copy is written for every dimension')
+    p.add_argument('--output_dir', type=str, default='data_files/projections',
+                   help='directory for the projections <method>_<dim>.npz and the projected embeddings')
+    p.add_argument('--batch_residues', type=int, default=20000, help='residues in every update of the PCA')
+    p.add_argument('--residue_fraction', type=float, default=0.25,
+                   help='fraction of the residues of every protein that is used for fitting the PCA')
+    p.add_argument('--dtype', type=str, default='float32', help='dtype of the projected embeddings [float32, float16]')
+    p.add_argument('--seed', type=int, default=123, help='seed for the residue sampling and the random projection')
+    args = p.parse_args()
+    if args.config:
+        data = yaml.load(args.config, Loader=yaml.FullLoader)
+        arg_dict = args.__dict__
+        for key, value in data.items():
+            arg_dict[key] = value
+    return args
+
+
+if __name__ == '__main__':
+    project_embeddings(parse_arguments())
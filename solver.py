@@ -1,7 +1,9 @@
 import copy
 import inspect
+import json
 import os
 import shutil
+import time
 from typing import Tuple
 
 import pyaml
@@ -15,24 +17,45 @@ from torch.utils.tensorboard import SummaryWriter
 from datetime import datetime
 from tqdm import tqdm
 
+from datasets.tensor_batch_loader import TensorBatchLoader
 from models.loss_functions import JointCrossEntropy
+from utils.memory import MemoryTracker
+from utils.profiling import is_recording, make_profiler, schedule_length
+from utils.timing import PhaseTimer, TimedCollate, append_json_log
 from utils.general import tensorboard_confusion_matrix, padded_permuted_collate, plot_class_accuracies, \
-    tensorboard_class_accuracies, annotation_transfer, plot_confusion_matrix, LOCALIZATION
+    tensorboard_class_accuracies, annotation_transfer, plot_confusion_matrix, stratified_subsample_loader, \
+    get_rng_states, set_rng_states, split_batch, padded_length, LOCALIZATION
 
 
 class Solver():
     def __init__(self, model, args, optim=torch.optim.Adam, loss_func=JointCrossEntropy, weight=None, eval=False):
-        self.optim = optim(list(model.parameters()), **args.optimizer_parameters)
+        self.optim = None if eval else optim(list(model.parameters()), **args.optimizer_parameters)
         self.args = args
-        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        self.device = torch.device(args.device or ("cuda:0" if torch.cuda.is_available() else "cpu"))
         self.model = model.to(self.device)
+        self.timer = PhaseTimer(args.timing, self.device)  # per phase timings that are logged after every epoch
+        self.profiler = None  # torch profiler that is started at the first step of the mode set in args.profiler
+        self.profiler_finished = False
+        self.profiler_steps = 0
+        self.memory_tracker = None  # records the memory of every batch and splits batches that would exceed the limit
+        if args.memory_tracking or args.memory_guard:
+            memory_guard = args.memory_guard or {}
+            self.memory_tracker = MemoryTracker(self.device, memory_guard.get('limit_mb'),
+                                                memory_guard.get('mb_per_element', 0), record=args.memory_tracking)
+        self.resume_state = None  # state saved in the middle of an epoch from which training is continued
         if args.checkpoint and not eval:
-            checkpoint = torch.load(os.path.join(args.checkpoint, 'checkpoint.pt'), map_location=self.device)
             self.writer = SummaryWriter(args.checkpoint)
+            resume_path = os.path.join(args.checkpoint, 'resume.pt')
+            if os.path.exists(resume_path):  # continue exactly at the step at which the resume state was saved
+                checkpoint = torch.load(resume_path, map_location=self.device, weights_only=False)
+                self.start_epoch = checkpoint['epoch']
+                self.resume_state = checkpoint
+            else:
+                checkpoint = torch.load(os.path.join(args.checkpoint, 'checkpoint.pt'), map_location=self.device)
+                with open(os.path.join(self.writer.log_dir, 'epoch.txt'), "r") as f:  # last epoch not the best epoch
+                    self.start_epoch = int(f.read()) + 1
             self.model.load_state_dict(checkpoint['model_state_dict'])
             self.optim.load_state_dict(checkpoint['optimizer_state_dict'])
-            with open(os.path.join(self.writer.log_dir, 'epoch.txt'), "r") as f:  # last epoch not the best epoch
-                self.start_epoch = int(f.read()) + 1
             self.max_val_acc = checkpoint['maximum_accuracy']
             self.weight = checkpoint['weight'].to(self.device)
         elif not eval:
@@ -42,6 +65,13 @@ class Solver():
                 'runs/{}_{}_{}'.format(args.model_type, args.experiment_name,
                                        datetime.now().strftime('%d-%m_%H-%M-%S')))
             self.weight = weight.to(self.device)
+        else:  # only evaluation of the model of args.checkpoint (if it is set) without an optimizer
+            self.writer = SummaryWriter(args.checkpoint) if args.checkpoint else None  # output dir of evaluation
+            self.weight = None if weight is None else weight.to(self.device)
+            if args.checkpoint:
+                checkpoint = torch.load(os.path.join(args.checkpoint, 'checkpoint.pt'), map_location=self.device)
+                self.model.load_state_dict(checkpoint['model_state_dict'])
+                self.weight = checkpoint['weight'].to(self.device)
 
         if args.balanced_loss:
             self.loss_func = loss_func(self.weight)
@@ -60,56 +90,75 @@ class Solver():
 
         """
         args = self.args
-        epochs_no_improve = 0  # counts every epoch that the validation accuracy did not improve for early stopping
-        max_train_acc = 0
+        self.events_no_improve = 0  # counts every validation event without improvement of val accuracy for early stopping
+        self.max_train_acc = 0
+        self.step = self.start_epoch * len(train_loader)  # number of optimizer steps done so far
+        self.train_start = time.time()  # for stopping after max_time seconds and the validation curve over time
+        with open(os.path.join(self.writer.log_dir, 'run_settings.json'), 'w') as file:
+            json.dump({'device': str(self.device), 'threads': torch.get_num_threads(),
+                       'precision': str(next(self.model.parameters()).dtype).replace('torch.', ''),
+                       'torch_version': torch.__version__}, file)
+        if args.timing:  # time the collate functions separately from reading the data
+            for loader, prefix in [(train_loader, 'train'), (val_loader, 'val')]:
+                if isinstance(loader, DataLoader):
+                    loader.collate_fn = TimedCollate(loader.collate_fn, self.timer, prefix + '/collate')
+        self.early_stopping_loader = val_loader
+        if args.val_subsample:  # use a fixed stratified part of the val set as signal for early stopping
+            self.early_stopping_loader = stratified_subsample_loader(val_loader, args.val_subsample, args.target,
+                                                                     args.seed)
+            print('Early stopping on %d of %d validation samples' % (
+                len(self.early_stopping_loader.dataset), len(val_loader.dataset)))
+        self.frozen = False  # whether only the head of the model is trained on cached pooled features
+        if self.resume_state and self.resume_state.get('frozen'):  # the resumed weights already have the frozen model
+            train_loader, val_loader = self.freeze_and_cache(train_loader, val_loader, load_best=False)
+        self.reset_train_results()
+        self.start_profiler('train')
         for epoch in range(self.start_epoch, args.num_epochs):  # loop over the dataset multiple times
+            stop = False
+            first_batch = 0
+            self.epoch_samples = 0  # samples of the current epoch that were trained on for saving the sampler position
             self.model.train()
-            train_loc_loss, train_sol_loss, train_results = self.predict(train_loader, epoch + 1, optim=self.optim)
-
-            self.model.eval()
-            with torch.no_grad():
-                val_loc_loss, val_sol_loss, val_results = self.predict(val_loader, epoch + 1)
-
-            loc_train_acc = 100 * np.equal(train_results[:, 0], train_results[:, 1]).sum() / len(train_results)
-            loc_val_acc = 100 * np.equal(val_results[:, 0], val_results[:, 1]).sum() / len(val_results)
-            with warnings.catch_warnings():  # because sklearns mcc implementation is a little dim
-                warnings.filterwarnings("ignore", message="invalid value encountered in double_scalars")
-                loc_train_mcc = matthews_corrcoef(train_results[:, 1], train_results[:, 0])
-                loc_val_mcc = matthews_corrcoef(val_results[:, 1], val_results[:, 0])
-
-            sol_preds_train = np.equal(train_results[:, 2], train_results[:, 3]) * train_results[:, 4]
-            sol_train_acc = 100 * sol_preds_train.sum() / train_results[:, 4].sum()
-            sol_preds_val = np.equal(val_results[:, 2], val_results[:, 3]) * val_results[:, 4]
-            sol_val_acc = 100 * sol_preds_val.sum() / val_results[:, 4].sum()
-
-            val_acc = sol_val_acc if args.target == 'sol' else loc_val_acc
-            train_acc = sol_train_acc if args.target == 'sol' else loc_train_acc
-
-            print('[Epoch %d] VAL accuracy: %.4f%% train accuracy: %.4f%%' % (epoch + 1, val_acc, train_acc))
-
-            tensorboard_class_accuracies(train_results, val_results, self.writer, args, epoch + 1)
-            tensorboard_confusion_matrix(train_results, val_results, self.writer, args, epoch + 1)
-            self.writer.add_scalars('Loc_Acc', {'train': loc_train_acc, 'val': loc_val_acc}, epoch + 1)
-            self.writer.add_scalars('Loc_MCC', {'train': loc_train_mcc, 'val': loc_val_mcc}, epoch + 1)
-            self.writer.add_scalars('Loc_Loss', {'train': train_loc_loss, 'val': val_loc_loss}, epoch + 1)
-            if args.solubility_loss != 0 or args.target == 'sol':
-                self.writer.add_scalars('Sol_Loss', {'train': train_sol_loss, 'val': val_sol_loss}, epoch + 1)
-                self.writer.add_scalars('Sol_Acc', {'train': sol_train_acc, 'val': sol_val_acc}, epoch + 1)
-
-            if val_acc >= self.max_val_acc:  # save the model with the best accuracy
-                epochs_no_improve = 0
-                self.max_val_acc = val_acc
-                self.save_checkpoint(epoch + 1)
-            else:
-                epochs_no_improve += 1
+            if self.resume_state:
+                first_batch = self.load_resume_state(train_loader)
+            batches = iter(train_loader)
+            if self.resume_state:  # restore the random states after the loader drew its seed as in the saved run
+                set_rng_states(self.resume_state['rng_states'])
+                self.resume_state = None
+            for i, batch in enumerate(self.timer.iterate(batches, 'train/data'), start=first_batch):
+                self.train_step(batch, i, len(train_loader), epoch + 1)
+                self.epoch_samples += len(batch[1])
+                self.profiler_step('train')
+                # validate every val_interval steps but not between the train steps that are profiled
+                validation_step = args.val_interval > 0 and self.step % args.val_interval == 0
+                if validation_step and not self.profiler_recording('train'):
+                    stop = self.validate(val_loader, epoch + 1, self.step)
+                    self.model.train()
+                    if stop:
+                        break
+                    if self.plateau_reached():  # continue with the next epoch on the cached features
+                        train_loader, val_loader = self.freeze_and_cache(train_loader, val_loader)
+                        break
+                if args.resume_interval > 0 and self.step % args.resume_interval == 0:
+                    with self.timer.phase('checkpoint'):
+                        self.save_resume_state(train_loader, epoch, i + 1)
+            if args.val_interval <= 0 and not self.profiler_recording('train'):  # validate after every epoch
+                stop = self.validate(val_loader, epoch + 1, epoch + 1)
+                if not stop and self.plateau_reached():
+                    train_loader, val_loader = self.freeze_and_cache(train_loader, val_loader)
 
             with open(os.path.join(self.writer.log_dir, 'epoch.txt'), 'w') as file:  # save what the last epoch is
                 file.write(str(epoch))
-
-            if train_acc >= max_train_acc:
-                max_train_acc = train_acc
-            if epochs_no_improve >= args.patience and max_train_acc >= args.min_train_acc:  # stopping criterion
+            if args.timing:
+                self.log_timings(epoch + 1)
+            if args.memory_tracking:
+                self.memory_tracker.log(self.writer.log_dir, self.writer, epoch + 1)
+            if stop:
                 break
+        self.stop_profiler()
+        self.frozen = False  # the evaluation runs the full model on the embeddings
+        resume_path = os.path.join(self.writer.log_dir, 'resume.pt')
+        if os.path.exists(resume_path):  # training finished so it should not be resumed from an older step
+            os.remove(resume_path)
 
         if eval_data:  # do evaluation on the test data if a eval_data is provided
             # load checkpoint of best model to do evaluation
@@ -117,6 +166,221 @@ class Solver():
             self.model.load_state_dict(checkpoint['model_state_dict'])
             self.evaluation(eval_data, filename='val_data_after_training')
 
+    def best_checkpoint_metrics(self, data_loader: DataLoader) -> Tuple[float, float, float]:
+        """
+        Load the best checkpoint of the run and compute the metrics on data_loader
+        Args:
+            data_loader: data for which to compute the metrics
+
+        Returns:
+            localization accuracy, localization MCC and solubility accuracy
+        """
+        checkpoint = torch.load(os.path.join(self.writer.log_dir, 'checkpoint.pt'), map_location=self.device)
+        self.model.load_state_dict(checkpoint['model_state_dict'])
+        self.model.eval()
+        with torch.no_grad():
+            _, _, results = self.predict(data_loader)
+        return self.metrics(results)
+
+    def plateau_reached(self) -> bool:
+        """
+        Returns:
+            whether the val accuracy did not improve for freeze_patience validation events such that the training of
+            the full model should be stopped and only its head should be trained on cached features
+        """
+        return self.args.freeze_patience > 0 and not self.frozen and \
+               self.events_no_improve >= self.args.freeze_patience
+
+    def freeze_and_cache(self, train_loader: DataLoader, val_loader: DataLoader, load_best: bool = True) -> Tuple[
+        TensorBatchLoader, TensorBatchLoader]:
+        """
+        Second stage of training: freeze all parameters of the model except for its classification head (linear and
+        output), cache the pooled features of the train and val set in eval mode and continue training only the head
+        on the cached features which is as fast as training an FFN on reduced embeddings. The train set is pooled with
+        the transform of the val set such that no random crop of the train transform is cached.
+        Args:
+            train_loader: loader of the per residue training data
+            val_loader: loader of the per residue validation data
+            load_best: whether to freeze the weights of checkpoint.pt instead of the last weights which did not improve
+            for freeze_patience validation events
+
+        Returns:
+            loaders over the cached pooled features of the train and the val set
+        """
+        args = self.args
+        if not hasattr(self.model, 'pool') or not hasattr(self.model, 'classify'):
+            raise ValueError('freeze_patience needs a model with pool and classify methods like LightAttention')
+        print('Freezing all parameters except for the head and caching the pooled features')
+        if load_best:
+            checkpoint = torch.load(os.path.join(self.writer.log_dir, 'checkpoint.pt'), map_location=self.device)
+            self.model.load_state_dict(checkpoint['model_state_dict'])
+        cached_train_loader = self.cache_pooled_features(train_loader, shuffle=True,
+                                                         transform=val_loader.dataset.transform)
+        cached_val_loader = self.cache_pooled_features(val_loader, shuffle=False)
+        for name, parameter in self.model.named_parameters():
+            if not name.startswith(('linear.', 'output.')):
+                parameter.requires_grad = False
+        self.frozen = True
+        self.events_no_improve = 0  # the head training gets the full patience
+        self.early_stopping_loader = cached_val_loader
+        if args.val_subsample:
+            self.early_stopping_loader = stratified_subsample_loader(cached_val_loader, args.val_subsample,
+                                                                     args.target, args.seed)
+        self.model.train()
+        return cached_train_loader, cached_val_loader
+
+    def cache_pooled_features(self, data_loader: DataLoader, shuffle: bool, transform=None) -> TensorBatchLoader:
+        """
+        Run the pooling of the model in eval mode over all samples of the dataset of data_loader
+        Args:
+            data_loader: loader of per residue embeddings
+            shuffle: whether or not the returned loader shuffles
+            transform: transform that replaces the one of the dataset while pooling like the eval transform without
+            the random crop of the train transform. If it is None, the transform of the dataset is used
+
+        Returns:
+            loader over the [n_samples, 2*embeddings_dim] pooled features with the labels and metadata of the samples
+        """
+        self.model.eval()
+        features, localization, solubility = [], [], []
+        metadata = {'solubility_known': [], 'length': [], 'frequencies': []}
+        dataset = data_loader.dataset
+        if transform is not None and hasattr(dataset, 'subset'):
+            dataset = dataset.subset(range(len(dataset)), transform=transform)
+        ordered_loader = DataLoader(dataset, batch_size=data_loader.batch_size,
+                                    collate_fn=data_loader.collate_fn)
+        with torch.no_grad():
+            for embedding, loc, sol, batch_metadata in ordered_loader:
+                lengths = batch_metadata['length'].to(self.device)
+                mask = torch.arange(lengths.max(), device=self.device)[None, :] < lengths[:, None]
+                features.append(self.model.pool(embedding.to(self.device), mask))  # [batchsize, 2*embeddings_dim]
+                localization.append(loc)
+                solubility.append(sol)
+                for key in metadata.keys():
+                    metadata[key].append(batch_metadata[key])
+        metadata = {key: torch.cat(value) for key, value in metadata.items()}
+        return TensorBatchLoader.from_tensors(torch.cat(features), torch.cat(localization), torch.cat(solubility),
+                                              metadata, data_loader.dataset, data_loader.batch_size, shuffle,
+                                              self.device)
+
+    def train_step(self, batch, iteration: int, n_iterations: int, epoch: int):
+        """
+        Do one optimizer step on the batch and accumulate its results for the metrics of the next validation event
+        Args:
+            batch: batch as returned by the train dataloader
+            iteration: index of the batch in the current epoch for logging
+            n_iterations: number of batches in one epoch for logging
+            epoch: current epoch for logging
+
+        Returns:
+
+        """
+        loc_loss, sol_loss, results = self.process_batch(batch, optim=self.optim)
+        self.step += 1
+        self.train_results.append(results)
+        self.train_loc_loss += loc_loss
+        self.train_sol_loss += sol_loss
+        self.train_batches += 1
+        self.log_iteration(iteration, n_iterations, epoch, loc_loss, results, train=True)
+
+    def reset_train_results(self):
+        """
+        Reset the training results that are accumulated between two validation events
+        """
+        self.train_results = []
+        self.train_loc_loss = 0
+        self.train_sol_loss = 0
+        self.train_batches = 0
+
+    def validate(self, val_loader: DataLoader, epoch: int, step: int) -> bool:
+        """
+        Validation event: evaluate on the early stopping loader, log the metrics of training since the last event and
+        of validation, save a checkpoint if the val accuracy improved and check the stopping criterion.
+        Args:
+            val_loader: the full validation data. Only used if early stopping is done on a subsample of it
+            epoch: current epoch for printing
+            step: step at which to log to tensorboard (the epoch or the optimizer step)
+
+        Returns:
+            whether or not the stopping criterion is met
+        """
+        args = self.args
+        self.model.eval()
+        with torch.no_grad():
+            val_loc_loss, val_sol_loss, val_results = self.predict(self.early_stopping_loader, epoch)
+        train_loc_loss = self.train_loc_loss / max(self.train_batches, 1)
+        train_sol_loss = self.train_sol_loss / max(self.train_batches, 1)
+        train_results = np.concatenate(self.train_results)
+        self.reset_train_results()
+
+        with self.timer.phase('metrics'):
+            loc_train_acc, loc_train_mcc, sol_train_acc = self.metrics(train_results)
+            loc_val_acc, loc_val_mcc, sol_val_acc = self.metrics(val_results)
+
+        val_acc = sol_val_acc if args.target == 'sol' else loc_val_acc
+        train_acc = sol_train_acc if args.target == 'sol' else loc_train_acc
+
+        if args.val_interval > 0:
+            print('[Epoch %d Step %d] VAL accuracy: %.4f%% train accuracy: %.4f%%' % (epoch, step, val_acc, train_acc))
+        else:
+            print('[Epoch %d] VAL accuracy: %.4f%% train accuracy: %.4f%%' % (epoch, val_acc, train_acc))
+
+        append_json_log(os.path.join(self.writer.log_dir, 'validation.jsonl'),
+                        {'epoch': epoch, 'step': step, 'seconds': time.time() - self.train_start,
+                         'val_acc': val_acc, 'val_mcc': loc_val_mcc, 'train_acc': train_acc})
+        with self.timer.phase('figures'):
+            tensorboard_class_accuracies(train_results, val_results, self.writer, args, step)
+            tensorboard_confusion_matrix(train_results, val_results, self.writer, args, step)
+        self.writer.add_scalars('Loc_Acc', {'train': loc_train_acc, 'val': loc_val_acc}, step)
+        self.writer.add_scalars('Loc_MCC', {'train': loc_train_mcc, 'val': loc_val_mcc}, step)
+        self.writer.add_scalars('Loc_Loss', {'train': train_loc_loss, 'val': val_loc_loss}, step)
+        if args.solubility_loss != 0 or args.target == 'sol':
+            self.writer.add_scalars('Sol_Loss', {'train': train_sol_loss, 'val': val_sol_loss}, step)
+            self.writer.add_scalars('Sol_Acc', {'train': sol_train_acc, 'val': sol_val_acc}, step)
+
+        if val_acc >= self.max_val_acc:  # save the model with the best accuracy
+            self.events_no_improve = 0
+            self.max_val_acc = val_acc
+            with self.timer.phase('checkpoint'):
+                self.save_checkpoint(epoch)
+            if self.early_stopping_loader is not val_loader:  # full validation pass only for saved checkpoints
+                with torch.no_grad():
+                    full_loc_loss, _, full_results = self.predict(val_loader, epoch)
+                full_loc_acc, full_loc_mcc, full_sol_acc = self.metrics(full_results)
+                full_val_acc = full_sol_acc if args.target == 'sol' else full_loc_acc
+                print('[Epoch %d] full VAL accuracy: %.4f%%' % (epoch, full_val_acc))
+                self.writer.add_scalars('Full_Val', {'loc_acc': full_loc_acc, 'loc_mcc': full_loc_mcc,
+                                                     'loc_loss': full_loc_loss, 'sol_acc': full_sol_acc}, step)
+        else:
+            self.events_no_improve += 1
+
+        if train_acc >= self.max_train_acc:
+            self.max_train_acc = train_acc
+        if args.max_time > 0 and time.time() - self.train_start > args.max_time:
+            print('Stopping because the time limit of %d seconds is reached' % args.max_time)
+            return True
+        # stopping criterion with patience counted in validation events
+        return self.events_no_improve >= args.patience and self.max_train_acc >= args.min_train_acc
+
+    def metrics(self, results: np.ndarray) -> Tuple[float, float, float]:
+        """
+        Compute the metrics that are tracked during training from the results of predict
+        Args:
+            results: [n_proteins, 5] array as returned by predict
+
+        Returns:
+            loc_acc: localization accuracy in percent
+            loc_mcc: localization matthews correlation coefficient
+            sol_acc: solubility accuracy in percent for the proteins with known solubility
+        """
+        loc_acc = 100 * np.equal(results[:, 0], results[:, 1]).sum() / len(results)
+        with warnings.catch_warnings():  # because sklearns mcc implementation is a little dim
+            warnings.filterwarnings("ignore", message="invalid value encountered in double_scalars")
+            loc_mcc = matthews_corrcoef(results[:, 1], results[:, 0])
+        sol_preds = np.equal(results[:, 2], results[:, 3]) * results[:, 4]
+        sol_acc = 100 * sol_preds.sum() / results[:, 4].sum()
+        return loc_acc, loc_mcc, sol_acc
+
     def predict(self, data_loader: DataLoader, epoch: int = None, optim: torch.optim.Optimizer = None) -> \
             Tuple[float, float, np.ndarray]:
         """
@@ -131,48 +395,194 @@ class Solver():
             sol_loss: the average of the solubility loss across all batches
             results: localizations # [n_train_proteins, 2] predictions in first and loc in second position
         """
-        args = self.args
         results = []  # prediction and corresponding localization
         running_loc_loss = 0
         running_sol_loss = 0
-        for i, batch in enumerate(data_loader):
-            embedding, loc, sol, metadata = batch  # get localization and solubility label
+        self.start_profiler('predict')
+        for i, batch in enumerate(self.timer.iterate(data_loader, ('train' if optim else 'val') + '/data')):
+            loc_loss, sol_loss, batch_results = self.process_batch(batch, optim)
+            self.profiler_step('predict')
+            results.append(batch_results)
+            running_loc_loss += loc_loss
+            running_sol_loss += sol_loss
+            self.log_iteration(i, len(data_loader), epoch, loc_loss, batch_results, train=optim is not None)
+        if self.args.profiler and self.args.profiler.get('mode', 'predict') == 'predict':
+            self.stop_profiler()  # such that the training steps between validations are not recorded
+
+        running_loc_loss /= len(data_loader)
+        running_sol_loss /= len(data_loader)
+        return running_loc_loss, running_sol_loss, np.concatenate(results)  # [n_train_proteins, 2] pred and loc
+
+    def process_batch(self, batch, optim: torch.optim.Optimizer = None) -> Tuple[float, float, np.ndarray]:
+        """
+        get predictions for a single batch and do backpropagation if an optimizer is provided. If a memory guard is
+        configured and the projected memory of the batch exceeds its limit, the batch is split into smaller batches
+        whose gradients are accumulated before the optimizer step (BatchNorm statistics are computed per part then).
+        Args:
+            batch: tuple of embedding, localization, solubility and metadata as returned by the dataloaders
+            optim: pytorch optimiz. If this is none, no backpropagation is done
+
+        Returns:
+            loc_loss: the localization loss of the batch
+            sol_loss: the solubility loss of the batch
+            results: [batch_size, 5] loc prediction, loc, sol prediction, sol and whether the solubility is known
+        """
+        phase = 'train/' if optim else 'val/'
+        batch_size = len(batch[1])
+        sub_batches, order = [batch], None
+        if self.memory_tracker is not None:
+            n_splits = self.memory_tracker.n_splits(batch_size, padded_length(batch[0]))
+            if n_splits > 1:
+                sub_batches, order = split_batch(batch, n_splits)
+        loc_loss, sol_loss, results = 0, 0, []
+        for sub_batch in sub_batches:
+            fraction = len(sub_batch[1]) / batch_size  # losses are averages so the parts are weighted by their size
+            if self.memory_tracker is not None:
+                self.memory_tracker.start_batch()
+            loss, sub_loc_loss, sub_sol_loss, sub_results = self.forward_batch(sub_batch, phase)
+            if self.memory_tracker is not None:
+                self.memory_tracker.sample()
+            if optim:  # run backpropagation if an optimizer is provided
+                with self.timer.phase(phase + 'backward'):
+                    (loss * fraction if len(sub_batches) > 1 else loss).backward()
+            if self.memory_tracker is not None:
+                self.memory_tracker.end_batch(phase[:-1], len(sub_batch[1]), padded_length(sub_batch[0]))
+            loc_loss += sub_loc_loss.item() * fraction
+            sol_loss += sub_sol_loss.item() * fraction
+            results.append(sub_results)
+        if optim:
+            with self.timer.phase(phase + 'optimizer'):
+                optim.step()
+                optim.zero_grad()
+        results = np.concatenate(results)
+        if order is not None:  # put the results of the split batches back into the order of the batch
+            results = results[np.argsort(order)]
+        return loc_loss, sol_loss, results
+
+    def forward_batch(self, batch, phase: str) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, np.ndarray]:
+        """
+        Run the model and the loss function on a batch
+        Args:
+            batch: tuple of embedding, localization, solubility and metadata as returned by the dataloaders
+            phase: 'train/' or 'val/' prefix for the timer
+
+        Returns:
+            loss: the overall loss
+            loc_loss: the localization loss of the batch
+            sol_loss: the solubility loss of the batch
+            results: [batch_size, 5] loc prediction, loc, sol prediction, sol and whether the solubility is known
+        """
+        args = self.args
+        embedding, loc, sol, metadata = batch  # get localization and solubility label
+        with self.timer.phase(phase + 'to_device'):
             embedding, loc, sol, sol_known = embedding.to(self.device), loc.to(self.device), sol.to(self.device), \
                                              metadata['solubility_known'].to(self.device)
-            sequence_lengths = metadata['length'][:, None].to(self.device)  # [batchsize, 1]
+            lengths = metadata['length'].to(self.device)  # [batchsize]
+            sequence_lengths = lengths[:, None]  # [batchsize, 1]
             frequencies = metadata['frequencies'].to(self.device)  # [batchsize, 25]
+        if self.timer.enabled:
+            self.timer.count(phase + 'samples', len(loc))
+            self.timer.count(phase + 'residues', lengths.sum().item())
 
-            # create mask corresponding to the zero padding used for the shorter sequecnes in the batch. All values corresponding to padding are False and the rest is True.
-            mask = torch.arange(metadata['length'].max())[None, :] < metadata['length'][:,
-                                                                         None]  # [batchsize, seq_len]
-            prediction = self.model(embedding, mask=mask.to(self.device), sequence_lengths=sequence_lengths,
-                                    frequencies=frequencies)
-            loss, loc_loss, sol_loss = self.loss_func(prediction, loc, sol, sol_known, args)
-            if optim:  # run backpropagation if an optimizer is provided
-                loss.backward()
-                self.optim.step()
-                self.optim.zero_grad()
+        with self.timer.phase(phase + 'forward'):
+            if self.frozen:  # the embeddings are the cached pooled features of the model
+                prediction = self.model.classify(embedding)
+            else:
+                # create mask corresponding to the zero padding used for the shorter sequecnes in the batch. All values corresponding to padding are False and the rest is True.
+                mask = torch.arange(lengths.max(), device=self.device)[None, :] < lengths[:, None]  # [batchsize, seq_len]
+                prediction = self.model(embedding, mask=mask, sequence_lengths=sequence_lengths,
+                                        frequencies=frequencies)
+            if 'teacher_logits' in metadata:  # cached soft logits of a teacher for the DistillationLoss
+                loss, loc_loss, sol_loss = self.loss_func(prediction, loc, sol, sol_known, args,
+                                                          teacher_logits=metadata['teacher_logits'].to(self.device))
+            else:
+                loss, loc_loss, sol_loss = self.loss_func(prediction, loc, sol, sol_known, args)
 
+        with self.timer.phase(phase + 'results'):
             sol_pred = torch.max(prediction[..., -2:], dim=1)[1]  # get indices of the highest value for sol
 
             if args.target == 'sol':
                 loc_pred = sol_pred  # ignore loc predictions
             else:
                 loc_pred = torch.max(prediction[..., :10], dim=1)[1]  # get indices of the highest value for loc
-            results.append(torch.stack((loc_pred, loc, sol_pred, sol, sol_known), dim=1).detach().cpu().numpy())
-            loc_loss_item = loc_loss.item()
-            running_loc_loss += loc_loss_item
-            running_sol_loss += sol_loss.item()
-            if i % args.log_iterations == args.log_iterations - 1:  # log every log_iterations
-                if epoch:
-                    print('Epoch %d ' % (epoch), end=' ')
-                print('[Iter %5d/%5d] %s: loc loss: %.7f, loc accuracy: %.4f%%' % (
-                    i + 1, len(data_loader), 'Train' if optim else 'Val', loc_loss_item,
-                    100 * (loc_pred == loc).sum().item() / args.batch_size))
+            results = torch.stack((loc_pred, loc, sol_pred, sol, sol_known), dim=1).detach().cpu().numpy()
+        return loss, loc_loss, sol_loss, results
 
-        running_loc_loss /= len(data_loader)
-        running_sol_loss /= len(data_loader)
-        return running_loc_loss, running_sol_loss, np.concatenate(results)  # [n_train_proteins, 2] pred and loc
+    def start_profiler(self, mode: str):
+        """
+        Start the torch profiler if profiling of mode is configured in args.profiler and it was not started before
+        Args:
+            mode: 'train' for the optimizer steps in train or 'predict' for the batches of predict (validation and
+            evaluation)
+        """
+        profiler_parameters = self.args.profiler
+        if not profiler_parameters or profiler_parameters.get('mode', 'predict') != mode or self.writer is None:
+            return
+        if self.profiler is None and not self.profiler_finished:
+            self.profiler = make_profiler(profiler_parameters, self.writer.log_dir, self.device)
+            self.profiler.start()
+
+    def profiler_step(self, mode: str):
+        """
+        Signal the end of a step to the profiler such that it advances in its wait/warmup/active schedule
+        """
+        if self.profiler is not None and self.args.profiler.get('mode', 'predict') == mode:
+            self.profiler.step()
+            self.profiler_steps += 1
+            if self.profiler_steps == schedule_length(self.args.profiler):  # all cycles are recorded
+                self.stop_profiler()
+
+    def profiler_recording(self, mode: str) -> bool:
+        """
+        Returns:
+            whether the profiler of mode is in its warmup or active phase such that a validation event would be recorded
+            in the trace of its steps
+        """
+        return self.profiler is not None and self.args.profiler.get('mode', 'predict') == mode and \
+               is_recording(self.profiler)
+
+    def stop_profiler(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+            self.profiler_finished = True
+
+    def log_timings(self, epoch: int):
+        """
+        Write the per phase timings and the throughput since the last call to tensorboard and to timings.jsonl in the
+        run directory and reset the timer
+        Args:
+            epoch: step at which to log the timings
+
+        Returns:
+
+        """
+        summary = self.timer.summary()
+        seconds, counts = summary['seconds'], summary['counts']
+        for prefix in ['train/', 'val/']:  # make the phases disjoint by separating the collate time from the reading
+            if prefix + 'data' in seconds:
+                seconds[prefix + 'read'] = seconds.pop(prefix + 'data') - seconds.get(prefix + 'collate', 0)
+        train_seconds = sum(value for key, value in seconds.items() if key.startswith('train/'))
+        throughput = {'samples_per_sec': counts.get('train/samples', 0) / max(train_seconds, 1e-9),
+                      'residues_per_sec': counts.get('train/residues', 0) / max(train_seconds, 1e-9)}
+        self.writer.add_scalars('Timing', seconds, epoch)
+        self.writer.add_scalars('Throughput', throughput, epoch)
+        append_json_log(os.path.join(self.writer.log_dir, 'timings.jsonl'),
+                        {'epoch': epoch, 'step': self.step, 'seconds': seconds, 'counts': counts, **throughput})
+        self.timer.reset()
+
+    def log_iteration(self, iteration: int, n_iterations: int, epoch: int, loc_loss: float, results: np.ndarray,
+                      train: bool):
+        """
+        Print the loss and accuracy of a batch every log_iterations
+        """
+        args = self.args
+        if iteration % args.log_iterations == args.log_iterations - 1:  # log every log_iterations
+            if epoch:
+                print('Epoch %d ' % (epoch), end=' ')
+            print('[Iter %5d/%5d] %s: loc loss: %.7f, loc accuracy: %.4f%%' % (
+                iteration + 1, n_iterations, 'Train' if train else 'Val', loc_loss,
+                100 * np.equal(results[:, 0], results[:, 1]).sum() / args.batch_size))
 
     def evaluation(self, eval_dataset: Dataset, filename: str = '', lookup_dataset: Dataset = None,
                    distance_threshold=0.81):
@@ -199,6 +609,9 @@ class Solver():
 
         data_loader = DataLoader(eval_dataset, batch_size=self.args.batch_size, collate_fn=collate_function)
         loc_loss, sol_loss, de_novo_predictions = self.predict(data_loader)
+        self.stop_profiler()
+        if self.args.memory_tracking:
+            self.memory_tracker.log(self.writer.log_dir, self.writer, 0)
 
         # to save the results of the inference
         np.save(os.path.join(self.writer.log_dir, 'results_array_' + filename), de_novo_predictions)
@@ -270,6 +683,78 @@ class Solver():
                               os.path.join(self.writer.log_dir, 'conf_matrix_' + filename + '.png'))
         return accuracy, mcc, f1
 
+    def save_resume_state(self, train_loader: DataLoader, epoch: int, n_batches: int):
+        """
+        Saves everything that is needed to continue training exactly at the current step to resume.pt in the run dir
+        Args:
+            train_loader: loader with a ResumableRandomSampler whose position is saved
+            epoch: current epoch (zero based)
+            n_batches: number of batches of the current epoch that were already trained on
+
+        Returns:
+
+        """
+        state = {
+            'epoch': epoch,
+            'batch': n_batches,
+            'step': self.step,
+            'sampler': train_loader.sampler.state_dict(self.epoch_samples),
+            'rng_states': get_rng_states(),
+            'events_no_improve': self.events_no_improve,
+            'max_train_acc': self.max_train_acc,
+            'frozen': self.frozen,
+            'train_results': self.train_results,
+            'train_loc_loss': self.train_loc_loss,
+            'train_sol_loss': self.train_sol_loss,
+            'train_batches': self.train_batches,
+            'weight': self.weight,
+            'maximum_accuracy': self.max_val_acc,
+            'model_state_dict': self.model.state_dict(),
+            'optimizer_state_dict': self.optim.state_dict(),
+        }
+        resume_path = os.path.join(self.writer.log_dir, 'resume.pt')
+        torch.save(state, resume_path + '.tmp')
+        os.replace(resume_path + '.tmp', resume_path)  # replace atomically so preemption never leaves a broken file
+
+    def save_end_state(self, train_loader: DataLoader, n_epochs: int):
+        """
+        Save the last weights and optimizer state after training to resume.pt such that the training can be continued
+        for more epochs exactly where it ended and not from the best checkpoint (like the promoted trials of the
+        hyperparameter search do)
+        Args:
+            train_loader: loader with a ResumableRandomSampler that was passed to train
+            n_epochs: number of epochs that were trained such that the continued training starts at this epoch
+        """
+        train_loader.sampler.next_permutation()  # the continued training starts a new epoch with a new permutation
+        self.epoch_samples = 0
+        self.events_no_improve = 0  # the continued training has the full patience
+        self.reset_train_results()
+        self.save_resume_state(train_loader, n_epochs, 0)
+
+    def load_resume_state(self, train_loader: DataLoader) -> int:
+        """
+        Restore the counters of the training loop and the sampler position from the loaded resume state
+        Args:
+            train_loader: loader with a ResumableRandomSampler
+
+        Returns:
+            number of batches of the current epoch that were already trained on
+        """
+        state = self.resume_state
+        if not hasattr(train_loader.sampler, 'load_state_dict'):
+            raise ValueError('Resuming in the middle of an epoch needs a train loader with a ResumableRandomSampler. '
+                             'Set resume_interval to use one.')
+        train_loader.sampler.load_state_dict(state['sampler'])
+        self.epoch_samples = state['sampler']['position']
+        self.step = state['step']
+        self.events_no_improve = state['events_no_improve']
+        self.max_train_acc = state['max_train_acc']
+        self.train_results = state['train_results']
+        self.train_loc_loss = state['train_loc_loss']
+        self.train_sol_loss = state['train_sol_loss']
+        self.train_batches = state['train_batches']
+        return state['batch']
+
     def save_checkpoint(self, epoch: int):
         """
         Saves checkpoint of model in the logdir of the summarywriter/ in the used rundir
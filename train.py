@@ -1,33 +1,93 @@
 import argparse
+from typing import Tuple
+
 import yaml
+import torch
 from models import *  # For loading classes specified in config
 from torch.optim import *  # For loading optimizer specified in config
 from torch.utils.data import DataLoader
 from torchvision.transforms import transforms
+from datasets.distillation_dataset import DistillationDataset
 from datasets.embeddings_localization_dataset import EmbeddingsLocalizationDataset
+from datasets.samplers import ResumableRandomSampler
+from datasets.tensor_batch_loader import TensorBatchLoader
 from datasets.transforms import *
 
 from solver import Solver
 from utils.general import padded_permuted_collate, seed_all
 
 
-def train(args):
-    seed_all(args.seed)
-    transform = transforms.Compose([SolubilityToInt(), ToTensor()])
-    train_set = EmbeddingsLocalizationDataset(args.train_embeddings, args.train_remapping, args.unknown_solubility,
-                                               max_length=args.max_length, key_format=args.key_format,
-                                              embedding_mode=args.embedding_mode, transform=transform)
+def get_transforms(args):
+    """
+    Returns:
+        transform for evaluation, transform for training and the maximum length of training sequences
+    """
+    transform = [SolubilityToInt(), ToTensor()]
+    if args.projection:  # project embeddings that are not yet projected like the ones of the projected stores
+        transform.append(ProjectEmbeddings(args.projection))
+    if args.crop_length > 0:  # keep long proteins in training and crop them to windows of crop_length residues
+        train_transform = transforms.Compose(transform + [RandomWindowCrop(args.crop_length, args.crop_mode,
+                                                                           args.crop_terminus_probability)])
+        return transforms.Compose(transform), train_transform, float('inf')
+    return transforms.Compose(transform), transforms.Compose(transform), args.max_length
+
+
+def load_datasets(args) -> Tuple[EmbeddingsLocalizationDataset, EmbeddingsLocalizationDataset]:
+    """
+    Create the train and val set as specified by the training arguments
+    Returns:
+        train_set, val_set
+    """
+    transform, train_transform, train_max_length = get_transforms(args)
+    if args.distillation_cache:  # pooled embeddings and soft logits of a teacher as cached by cache_teacher_logits.py
+        train_set = DistillationDataset(args.distillation_cache, args.unknown_solubility, transform=transform)
+    else:
+        train_set = EmbeddingsLocalizationDataset(args.train_embeddings, args.train_remapping, args.unknown_solubility,
+                                                  max_length=train_max_length, key_format=args.key_format,
+                                                  embedding_mode=args.embedding_mode, transform=train_transform,
+                                                  preload=args.preload)
     val_set = EmbeddingsLocalizationDataset(args.val_embeddings, args.val_remapping, args.unknown_solubility,
                                             key_format=args.key_format, max_length=args.max_length,
-                                            embedding_mode=args.embedding_mode, transform=transform)
+                                            embedding_mode=args.embedding_mode, transform=transform,
+                                            preload=args.preload)
+    return train_set, val_set
+
 
+def make_loaders(args, train_set: EmbeddingsLocalizationDataset, val_set: EmbeddingsLocalizationDataset,
+                 resumable: bool = False):
+    """
+    Create the train and val loaders for the datasets as specified by the training arguments
+    Args:
+        resumable: use a train loader whose state can be saved to resume.pt even if resume_interval is off
+
+    Returns:
+        train_loader, val_loader
+    """
     if len(train_set[0][0].shape) == 2:  # if we have per residue embeddings they have an additional length dim
         collate_function = padded_permuted_collate
     else:  # if we have reduced sequence wise embeddings use the default collate function by passing None
         collate_function = None
 
-    train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, collate_fn=collate_function)
-    val_loader = DataLoader(val_set, batch_size=args.batch_size, collate_fn=collate_function)
+    if args.in_memory:  # keep reduced embeddings in contiguous tensors instead of loading and collating every batch
+        device = torch.device(args.device or ("cuda:0" if torch.cuda.is_available() else "cpu"))
+        train_loader = TensorBatchLoader(train_set, batch_size=args.batch_size, shuffle=True, device=device)
+        val_loader = TensorBatchLoader(val_set, batch_size=args.batch_size, device=device)
+    else:
+        if resumable or args.resume_interval > 0:  # sampler whose position can be saved for resuming mid-epoch
+            train_loader = DataLoader(train_set, batch_size=args.batch_size, sampler=ResumableRandomSampler(train_set),
+                                      collate_fn=collate_function)
+        else:
+            train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, collate_fn=collate_function)
+        val_loader = DataLoader(val_set, batch_size=args.batch_size, collate_fn=collate_function)
+    return train_loader, val_loader
+
+
+def train(args):
+    seed_all(args.seed)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    train_set, val_set = load_datasets(args)
+    train_loader, val_loader = make_loaders(args, train_set, val_set)
 
     # Needs "from models import *" to work
     model = globals()[args.model_type](embeddings_dim=train_set[0][0].shape[-1], **args.model_parameters)
@@ -39,19 +99,21 @@ def train(args):
     solver.train(train_loader, val_loader, eval_data=val_set)
 
     if args.eval_on_test:
+        transform, _, _ = get_transforms(args)
         test_set = EmbeddingsLocalizationDataset(args.test_embeddings, args.test_remapping, args.unknown_solubility,
                                                  key_format=args.key_format, embedding_mode=args.embedding_mode,
                                                  transform=transform)
         solver.evaluation(test_set, filename='test_set_after_train')
 
 
-def parse_arguments():
+def parse_arguments(argv: list = None):
     p = argparse.ArgumentParser()
     p.add_argument('--config', type=argparse.FileType(mode='r'), default='configs/inference2.yaml')
     p.add_argument('--experiment_name', type=str, help='name that will be added to the runs folder output')
     p.add_argument('--num_epochs', type=int, default=2500, help='number of times to iterate through all samples')
     p.add_argument('--batch_size', type=int, default=1024, help='samples that will be processed in parallel')
-    p.add_argument('--patience', type=int, default=50, help='stop training after no improvement in this many epochs')
+    p.add_argument('--patience', type=int, default=50,
+                   help='stop training after no improvement in this many validation events (epochs by default)')
     p.add_argument('--min_train_acc', type=int, default=0, help='dont stop training before reaching this acc')
     p.add_argument('--n_draws', type=int, default=200, help='number of times to sample for estimation of stderr')
     p.add_argument('--seed', type=int, default=123, help='seed for reproducibility')
@@ -60,11 +122,32 @@ def parse_arguments():
     p.add_argument('--log_iterations', type=int, default=-1,
                    help='log every log_iterations iterations (-1 for only logging after each epoch)')
     p.add_argument('--checkpoint', type=str, help='path to directory that contains a checkpoint')
+    p.add_argument('--freeze_patience', type=int, default=0,
+                   help='after this many validation events without improvement, freeze all but the head of the model '
+                        'and train the head on cached pooled features (0 for off). Needs a model like LightAttention')
+    p.add_argument('--resume_interval', type=int, default=0,
+                   help='save the state for resuming training in the middle of an epoch every resume_interval '
+                        'optimizer steps to resume.pt in the run dir (0 for off)')
+    p.add_argument('--val_interval', type=int, default=0,
+                   help='validate every val_interval optimizer steps (0 for validating after each epoch)')
+    p.add_argument('--max_time', type=float, default=0,
+                   help='stop training at the first validation event after max_time seconds (0 for off)')
+    p.add_argument('--val_subsample', type=float, default=0,
+                   help='fraction (<= 1) or number of val samples in a fixed stratified subsample that is used for '
+                        'early stopping. The full val set is only evaluated when a checkpoint is saved (0 for off)')
 
     p.add_argument('--model_type', type=str, default='FFN', help='Classname of one of the models in the models dir')
     p.add_argument('--model_parameters', type=dict, help='dictionary of model parameters')
     p.add_argument('--loss_function', type=str, default='LocCrossEntropy',
                    help='Classname of one of the loss functions models/loss_functions.py')
+    p.add_argument('--distillation_cache', type=str, default=None,
+                   help='h5 file of cache_teacher_logits.py whose pooled embeddings and teacher logits replace the '
+                        'train set. Use it with the loss_function DistillationLoss')
+    p.add_argument('--distillation_temperature', type=float, default=2.0,
+                   help='temperature that softens the logits of teacher and student in the DistillationLoss')
+    p.add_argument('--distillation_weight', type=float, default=0.5,
+                   help='weight of the distillation term of the DistillationLoss. The cross entropy with the labels '
+                        'is weighted by 1 - distillation_weight')
     p.add_argument('--target', type=str, default='loc', help='to predict solubility or localization [loc,sol]')
     p.add_argument('--balanced_loss', type=bool, default=False, help='balance loss by class prevalence in train set')
     p.add_argument('--solubility_loss', type=float, default=0,
@@ -73,6 +156,21 @@ def parse_arguments():
                    help='whether or not to include sequences with unknown solubility in the dataset')
     p.add_argument('--max_length', type=int, default=6000, help='maximum lenght of sequences that will be used for '
                                                                 'training when using embedddings of variable length')
+    p.add_argument('--in_memory', type=bool, default=False,
+                   help='load all reduced embeddings into tensors once and take the batches from them with index_select')
+    p.add_argument('--preload', type=bool, default=False,
+                   help='read all embeddings from the h5 files into memory once instead of for every sample')
+    p.add_argument('--crop_length', type=int, default=0,
+                   help='crop training sequences to random windows of at most crop_length residues instead of '
+                        'dropping the ones longer than max_length. Evaluation uses full sequences (0 for off)')
+    p.add_argument('--crop_mode', type=str, default='uniform',
+                   help='how to choose the training windows [uniform, termini, both_ends]')
+    p.add_argument('--crop_terminus_probability', type=float, default=0.5,
+                   help='probability of cropping the N- or C-terminal window with crop_mode termini')
+    p.add_argument('--projection', type=str, default=None,
+                   help='.npz file of project_embeddings.py with which embeddings of the original dimension are '
+                        'projected. Set it when training on projected stores such that inference can use the original '
+                        'embeddings (None for off)')
     p.add_argument('--embedding_mode', type=str, default='lm',
                    help='type of embedding to use (lm means Language model) [lm, onehot, profile]')
 
@@ -89,9 +187,26 @@ def parse_arguments():
                    help='.h5 or .h5py file with keys fitting the ids in the corresponding fasta remapping file')
     p.add_argument('--test_remapping', type=str, default='data/embeddings/test_remapped.fasta',
                    help='fasta file with remappings by bio_embeddings for the keys in the corresponding .h5 file')
+    p.add_argument('--device', type=str, default=None,
+                   help='device to train on like cpu or cuda:1 (cuda:0 if it is available by default)')
+    p.add_argument('--num_threads', type=int, default=0,
+                   help='number of threads torch uses for intraop parallelism on cpu (0 for the torch default)')
+    p.add_argument('--timing', type=bool, default=False,
+                   help='record the time spent in each phase of training and the throughput after every epoch')
+    p.add_argument('--profiler', type=dict, default=None,
+                   help='run torch.profiler with the schedule parameters [wait, warmup, active, repeat, skip_first] '
+                        'on the batches of mode [train, predict] and save traces and tables to profiler/ in the run '
+                        'dir. In predict mode only the batches of the first validation are recorded, in train mode '
+                        'validation events are skipped while the profiled steps are recorded')
+    p.add_argument('--memory_tracking', type=bool, default=False,
+                   help='record the memory of every batch against its size and padded length to memory.csv/.png')
+    p.add_argument('--memory_guard', type=dict, default=None,
+                   help='dictionary with limit_mb and optionally mb_per_element. Batches whose projected memory '
+                        'exceeds limit_mb are split into smaller batches of at least 2 samples. On cpu without '
+                        'procfs (macOS) set mb_per_element from benchmark_model.py since the peak of a batch is missed')
     p.add_argument('--key_format', type=str, default='hash',
                    help='the formatting of the keys in the h5 file [fasta_descriptor_old, fasta_descriptor, hash]')
-    args = p.parse_args()
+    args = p.parse_args(argv)
     if args.config:
         data = yaml.load(args.config, Loader=yaml.FullLoader)
         arg_dict = args.__dict__
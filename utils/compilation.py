@@ -0,0 +1,142 @@
+import copy
+import hashlib
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from models.ffn import FFN
+from models.light_attention import LightAttention
+from utils.onnx_export import MaskedModel
+
+
+def fold_batch_norm_into_linear(batch_norm: nn.BatchNorm1d, linear: nn.Linear) -> nn.Linear:
+    """
+    Fold an eval mode BatchNorm1d into the Linear layer that follows it:
+    W * (gamma * (h - mean) / std + beta) + b = (W * gamma / std) * h + W * (beta - gamma * mean / std) + b
+    Returns:
+        Linear layer that computes linear(batch_norm(h))
+    """
+    scale = batch_norm.weight / torch.sqrt(batch_norm.running_var + batch_norm.eps)  # [hidden_dim]
+    shift = batch_norm.bias - batch_norm.running_mean * scale  # [hidden_dim]
+    folded = nn.Linear(linear.in_features, linear.out_features).to(linear.weight.device)
+    with torch.no_grad():
+        folded.weight.copy_(linear.weight * scale[None, :])
+        folded.bias.copy_(linear.bias + linear.weight @ shift)
+    return folded
+
+
+def fold_batch_norm(model: nn.Module) -> nn.Module:
+    """
+    Fold the BatchNorm1d layers at the end of the linear blocks of LightAttention and FFN into the next Linear layer
+    and replace them with identities. Other models are returned unchanged.
+    Returns:
+        eval mode copy of the model that computes the same logits with one operation less per block
+    """
+    model = copy.deepcopy(model).eval()
+    if isinstance(model, LightAttention):  # head: Linear, Dropout, ReLU, BatchNorm, Linear
+        model.output = fold_batch_norm_into_linear(model.linear[3], model.output)
+        model.linear[3] = nn.Identity()
+    elif isinstance(model, FFN):  # blocks of Linear, Dropout, ReLU, BatchNorm that are followed by a Linear
+        blocks = [model.input] + list(model.hidden)
+        for block, next_block in zip(blocks, list(model.hidden) + [None]):
+            if next_block is None:
+                model.output = fold_batch_norm_into_linear(block[3], model.output)
+            else:
+                next_block[0] = fold_batch_norm_into_linear(block[3], next_block[0])
+            block[3] = nn.Identity()
+    return model
+
+
+def checkpoint_hash(path: str) -> str:
+    """
+    Returns:
+        the first 16 hex digits of the sha256 hash of the file at path
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()[:16]
+
+
+class CompiledModel(nn.Module):
+    """
+    Runs a TorchScript module or a torch.compile function that only takes the embeddings (and the mask for per residue
+    embeddings) in place of the model of the Solver for inference
+    """
+
+    def __init__(self, module, per_residue: bool):
+        super(CompiledModel, self).__init__()
+        self.module = module
+        self.per_residue = per_residue
+
+    def forward(self, x: torch.Tensor, mask: torch.Tensor = None, **kwargs) -> torch.Tensor:
+        with torch.no_grad():  # the frozen weights are constants of the compiled graph
+            if self.per_residue:
+                return self.module(x, mask)
+            return self.module(x)
+
+
+def compile_model(model: nn.Module, mode: str, checkpoint: str, embeddings_dim: int, per_residue: bool,
+                  device: torch.device) -> CompiledModel:
+    """
+    Compile a model like LightAttention or FFN for inference after folding its BatchNorm layers. The compiled artifact
+    is cached in the checkpoint directory under a key of the hash of checkpoint.pt, the torch version, the mode and the
+    device type such that later runs with the same checkpoint and torch version skip the compilation.
+    Args:
+        model: eval mode model with the weights of the checkpoint
+        mode: [jit, inductor]. jit traces the model, freezes it with torch.jit.freeze and applies
+        torch.jit.optimize_for_inference (which prepacks the convolution weights for oneDNN on the cpu) and saves the
+        result as compiled_<key>.pt. inductor uses torch.compile with freezing and weight prepacking and keeps the
+        generated kernels in inductor_cache_<key>
+        checkpoint: run directory with the checkpoint.pt of the model
+        embeddings_dim: dimension of the input
+        per_residue: whether the model takes per residue embeddings and a mask or reduced embeddings
+        device: device of the model and the inputs
+
+    Returns:
+        the compiled model
+    """
+    key = '{}_torch{}_{}_{}'.format(checkpoint_hash(os.path.join(checkpoint, 'checkpoint.pt')),
+                                    torch.__version__.replace('+', '_'), mode, device.type)
+    start = time.perf_counter()
+    path = os.path.join(checkpoint, 'compiled_{}.pt'.format(key))
+    if mode == 'jit' and os.path.exists(path):
+        module = torch.jit.load(path, map_location=device)
+        print('Loaded the compiled model from {} in {:.2f}s'.format(path, time.perf_counter() - start))
+        return CompiledModel(module, per_residue)
+
+    model = fold_batch_norm(model)
+    if isinstance(model, LightAttention):  # the packed and chunked pooling need the values of the lengths in python
+        model.packed = False
+        model.chunk_size = 0
+    if per_residue:
+        lengths = torch.tensor([50, 23], device=device)
+        example_inputs = (torch.randn(2, embeddings_dim, 50, device=device),
+                          torch.arange(50, device=device)[None, :] < lengths[:, None])
+        model = MaskedModel(model)
+    else:
+        example_inputs = (torch.randn(2, embeddings_dim, device=device),)
+
+    if mode == 'jit':
+        with torch.no_grad():
+            module = torch.jit.trace(model, example_inputs)
+            module = torch.jit.optimize_for_inference(torch.jit.freeze(module.eval()))
+        torch.jit.save(module, path)
+        print('Compiled the model to {} in {:.2f}s'.format(path, time.perf_counter() - start))
+    elif mode == 'inductor':
+        from torch._inductor import config  # only needed for this mode
+
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.join(os.path.abspath(checkpoint), 'inductor_cache_' + key)
+        config.fx_graph_cache = True
+        config.freezing = True  # constant folding and prepacking of the weights for oneDNN
+        module = torch.compile(model, dynamic=True)
+        with torch.no_grad():
+            module(*example_inputs)
+        print('Compiled the model with the cache in {} in {:.2f}s'.format(os.environ['TORCHINDUCTOR_CACHE_DIR'],
+                                                                           time.perf_counter() - start))
+    else:
+        raise ValueError('Unknown compile mode: {}'.format(mode))
+    return CompiledModel(module, per_residue)
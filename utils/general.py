@@ -5,9 +5,10 @@ from typing import List, Tuple
 import numpy as np
 import torch
 from sklearn.metrics import confusion_matrix
+from sklearn.model_selection import KFold, StratifiedKFold
 from sklearn.neighbors import KNeighborsClassifier
 from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Subset
 from torch.utils.tensorboard import SummaryWriter
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -64,6 +65,28 @@ def seed_all(seed):
     #torch.backends.cudnn.benchmark = False
 
 
+def get_rng_states() -> dict:
+    """
+    Returns:
+        the states of all random number generators that are seeded by seed_all
+    """
+    states = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states: dict):
+    """
+    Restore the states of the random number generators as returned by get_rng_states
+    """
+    torch.set_rng_state(states['torch'].cpu())
+    np.random.set_state(states['numpy'])
+    random.setstate(states['python'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([state.cpu() for state in states['cuda']])
+
+
 def annotation_transfer(evaluation_set: Dataset, lookup_set: Dataset):
     '''
     Uses knn for embedding space similarity based annotation transfer
@@ -97,6 +120,81 @@ def annotation_transfer(evaluation_set: Dataset, lookup_set: Dataset):
     return np.array([predictions, evaluation_data[1], distances.squeeze()]).T
 
 
+def stratified_subsample(labels: np.ndarray, size: float, seed: int = 0) -> np.ndarray:
+    """
+    Draw a fixed subsample of indices that keeps the class proportions of labels
+    Args:
+        labels: [n_samples] class label of every sample
+        size: fraction of the samples if <= 1 or else the absolute number of samples to draw
+        seed: seed for the random choice such that the subsample is the same in every run
+
+    Returns:
+        sorted array of the drawn indices. Every class keeps at least one sample.
+    """
+    rng = np.random.RandomState(seed)
+    fraction = size if size <= 1 else size / len(labels)
+    indices = []
+    for label in np.unique(labels):
+        class_indices = np.where(labels == label)[0]
+        n_samples = min(len(class_indices), max(1, int(round(fraction * len(class_indices)))))
+        indices.append(rng.choice(class_indices, n_samples, replace=False))
+    return np.sort(np.concatenate(indices))
+
+
+def stratified_subsample_loader(data_loader: DataLoader, size: float, target: str = 'loc',
+                                seed: int = 0) -> DataLoader:
+    """
+    Create a loader over a fixed stratified subsample of the dataset of data_loader with the same batching
+    Args:
+        data_loader: DataLoader or TensorBatchLoader of an EmbeddingsLocalizationDataset
+        size: fraction of the samples if <= 1 or else the absolute number of samples to use
+        target: stratify by localization if 'loc' and by solubility if 'sol'
+        seed: seed for drawing the subsample
+
+    Returns:
+        loader over a Subset of the dataset
+    """
+    dataset = data_loader.dataset
+    key = 'solubility' if target == 'sol' else 'localization'
+    labels = np.array([item[key] for item in dataset.localization_solubility_metadata_list])
+    indices = stratified_subsample(labels, size, seed)
+    if hasattr(data_loader, 'subset'):  # the TensorBatchLoader already holds all samples in memory
+        return data_loader.subset(indices)
+    return DataLoader(Subset(dataset, indices), batch_size=data_loader.batch_size, collate_fn=data_loader.collate_fn)
+
+
+def cross_validation_folds(labels: np.ndarray, n_folds: int, groups: np.ndarray = None, stratify: bool = True,
+                           seed: int = 0) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Split the samples into folds of indices
+    Args:
+        labels: [n_samples] class label of every sample
+        n_folds: number of folds
+        groups: [n_samples] group (e.g. homology cluster) of every sample. Samples of a group are always in the same
+        fold
+        stratify: whether or not every fold should keep the class proportions of labels
+        seed: seed for shuffling the samples (or the groups) before splitting
+
+    Returns:
+        list with train indices and val indices of every fold
+    """
+    indices = np.arange(len(labels))
+    if groups is not None:
+        try:
+            from sklearn.model_selection import StratifiedGroupKFold
+        except ImportError:
+            raise ImportError('Cross validation folds with groups need StratifiedGroupKFold of scikit-learn >= 1.0')
+        # the groups are shuffled and then assigned one by one to the fold that keeps the class proportions (or without
+        # stratification the fold sizes with a single class) most even, such that the seed changes the folds
+        folds = StratifiedGroupKFold(n_folds, shuffle=True, random_state=seed).split(
+            indices, labels if stratify else np.zeros(len(labels)), groups)
+    elif stratify:
+        folds = StratifiedKFold(n_folds, shuffle=True, random_state=seed).split(indices, labels)
+    else:
+        folds = KFold(n_folds, shuffle=True, random_state=seed).split(indices)
+    return list(folds)
+
+
 def tensorboard_class_accuracies(train_results: np.ndarray, val_results: np.ndarray, writer: SummaryWriter, args,
                                  step: int):
     """
@@ -242,6 +340,47 @@ def padded_permuted_collate(batch: List[Tuple[torch.Tensor, torch.Tensor, torch.
     return embeddings.permute(0, 2, 1), localization, solubility, metadata
 
 
+def padded_length(embeddings: torch.Tensor) -> int:
+    """
+    Returns:
+        the length dimension of a batch of [batchsize, embeddings_dim, length] embeddings or 1 for reduced embeddings
+    """
+    return embeddings.shape[-1] if embeddings.dim() == 3 else 1
+
+
+def split_batch(batch: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, dict], n_splits: int) -> Tuple[
+    List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor, dict]], np.ndarray]:
+    """
+    Split a collated batch into n_splits batches of sequences with similar lengths and remove the padding that is not
+    needed in the smaller batches anymore
+    Args:
+        batch: tuple of embeddings, localization, solubility and metadata as returned by padded_permuted_collate or the
+        default collate function
+        n_splits: number of batches to split into
+
+    Returns:
+        the smaller batches and the order of the original indices in them such that results of the smaller batches can
+        be put back into the original order with results[np.argsort(order)]
+    """
+    embeddings, localization, solubility, metadata = batch
+    order = np.argsort(metadata['length'].cpu().numpy(), kind='stable')
+    sub_batches = []
+    for indices in np.array_split(order, n_splits):
+        index_tensor = torch.as_tensor(indices, device=embeddings.device)
+        sub_embeddings = embeddings.index_select(0, index_tensor)
+        if sub_embeddings.dim() == 3:  # [batchsize, embeddings_dim, length] per residue embeddings
+            sub_embeddings = sub_embeddings[..., :int(metadata['length'][indices].max())]
+        sub_metadata = {}
+        for key, value in metadata.items():
+            if torch.is_tensor(value):
+                sub_metadata[key] = value.index_select(0, index_tensor.to(value.device))
+            else:
+                sub_metadata[key] = [value[i] for i in indices]
+        sub_batches.append((sub_embeddings, localization.index_select(0, index_tensor.to(localization.device)),
+                            solubility.index_select(0, index_tensor.to(solubility.device)), sub_metadata))
+    return sub_batches, order
+
+
 def numpy_collate_to_reduced(batch: List[Tuple[np.array, np.array, np.array, dict]]) -> Tuple[
     np.array, np.array, np.array, dict]:
     """
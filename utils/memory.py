@@ -0,0 +1,186 @@
+import math
+import os
+import sys
+
+import pandas as pd
+import torch
+import matplotlib.pyplot as plt
+import seaborn as sn
+from torch.utils.tensorboard import SummaryWriter
+
+
+def current_rss_mb() -> float:
+    """
+    Returns:
+        resident set size of the process in MB. Falls back to the peak resident set size if there is no procfs.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    """
+    Returns:
+        the maximum resident set size of the process so far in MB
+    """
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10  # bytes on macOS and kilobytes on linux
+
+
+def reset_peak_rss() -> bool:
+    """
+    Reset the peak resident set size of the process (VmHWM) to the current resident set size (needs linux 4.0)
+    Returns:
+        whether the peak could be reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def high_water_rss_mb() -> float:
+    """
+    Returns:
+        peak resident set size of the process since the last reset_peak_rss in MB. Falls back to the peak resident set
+        size of the process if there is no procfs.
+    """
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10  # kilobytes
+    except (OSError, ValueError):
+        pass
+    return peak_rss_mb()
+
+
+class MemoryTracker():
+    """
+    Records the memory of every batch together with its batch size and padded length. On cuda the peak of the caching
+    allocator is used, on cpu the high-water mark of the resident set size which is reset at the start of every batch
+    such that freed temporaries are included. Without procfs only the growth of the peak resident set size of the
+    process during a batch and the resident set size after the forward and the backward pass are seen, which
+    underestimates the memory of batches below the earlier peak. Set mb_per_element from benchmark_model.py then.
+    The largest observed memory per padded element (batch_size * padded_length) is used to project the memory of a batch
+    before it runs such that it can be split if the projection exceeds limit_mb.
+    """
+
+    def __init__(self, device: torch.device, limit_mb: float = None, mb_per_element: float = 0, record: bool = True):
+        """
+        Args:
+            device: device on which the model runs
+            limit_mb: memory limit of the process or the gpu in MB. If it is None, batches are never split
+            mb_per_element: initial estimate of the memory per padded element such that already the first batch is
+            guarded. It is raised to the largest observed value.
+            record: whether or not to keep the records for log or only use the measurements for the guard
+        """
+        self.cuda = torch.device(device).type == 'cuda'
+        self.limit_mb = limit_mb
+        self.mb_per_element = mb_per_element
+        self.record = record
+        self.records = []  # one dictionary per batch since the last log. The older ones are only kept in memory.csv
+        self.process_peak_mb = 0  # peak resident set size of the process as the high-water mark is reset on cpu
+
+    def current_mb(self) -> float:
+        return torch.cuda.memory_allocated() / 2 ** 20 if self.cuda else current_rss_mb()
+
+    def n_splits(self, batch_size: int, padded_length: int) -> int:
+        """
+        Number of parts into which a batch needs to be split such that each part stays below limit_mb. Every part keeps
+        at least 2 samples because the BatchNorm layers of the models cannot be trained on a single sample.
+        """
+        if not self.limit_mb or not self.mb_per_element:
+            return 1
+        projected_mb = self.mb_per_element * batch_size * padded_length
+        available_mb = max(self.limit_mb - self.current_mb(), 1e-9)
+        n_splits = math.ceil(projected_mb / available_mb)
+        max_splits = max(batch_size // 2, 1)
+        if n_splits > max_splits:
+            raise MemoryError('A batch of {} samples with padded length {} is projected to need {:.0f}MB and does not '
+                              'fit into the {:.0f}MB that are available below limit_mb even when it is split into '
+                              'parts of 2 samples'.format(batch_size, padded_length, projected_mb, available_mb))
+        return n_splits
+
+    def start_batch(self):
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            self.process_peak_mb = max(self.process_peak_mb, high_water_rss_mb())
+            self.peak_reset = reset_peak_rss()
+            self.batch_start_peak_mb = high_water_rss_mb()
+        self.batch_start_mb = self.current_mb()
+        self.batch_peak_mb = self.batch_start_mb
+
+    def sample(self):
+        """
+        Update the peak of the current batch with the current memory (only needed on cpu)
+        """
+        if not self.cuda:
+            self.batch_peak_mb = max(self.batch_peak_mb, self.current_mb())
+
+    def end_batch(self, mode: str, batch_size: int, padded_length: int):
+        """
+        Record the memory of the batch that was started with start_batch
+        Args:
+            mode: 'train' or 'val'
+            batch_size: number of samples in the batch
+            padded_length: length dimension of the padded batch (1 for reduced embeddings)
+        """
+        if self.cuda:
+            peak_mb = torch.cuda.max_memory_allocated() / 2 ** 20
+            self.process_peak_mb = peak_rss_mb()
+        else:
+            self.sample()
+            peak_mb = self.batch_peak_mb
+            high_water_mb = high_water_rss_mb()
+            if self.peak_reset or high_water_mb > self.batch_start_peak_mb:  # the high-water mark was set in the batch
+                peak_mb = max(peak_mb, high_water_mb)
+            self.process_peak_mb = max(self.process_peak_mb, high_water_mb)
+        batch_mb = max(peak_mb - self.batch_start_mb, 0)
+        self.mb_per_element = max(self.mb_per_element, batch_mb / (batch_size * padded_length))
+        if self.record:
+            self.records.append({'mode': mode, 'batch_size': batch_size, 'padded_length': padded_length,
+                                 'peak_mb': peak_mb, 'batch_mb': batch_mb, 'rss_mb': current_rss_mb(),
+                                 'process_peak_rss_mb': self.process_peak_mb})
+
+    def log(self, log_dir: str, writer: SummaryWriter, step: int):
+        """
+        Append the new records to memory.csv in log_dir and drop them, save the histogram and the scatter plot against
+        the padded length of all records in memory.csv to memory.png and write both to tensorboard
+        Args:
+            log_dir: run directory
+            writer: summary writer of the run
+            step: step at which to log to tensorboard
+
+        Returns:
+
+        """
+        if not self.records:
+            return
+        new_records = pd.DataFrame(self.records)
+        csv_path = os.path.join(log_dir, 'memory.csv')
+        new_records.to_csv(csv_path, mode='a', header=not os.path.exists(csv_path), index=False)
+        self.records = []
+
+        writer.add_histogram('Memory/batch_peak_mb', new_records['peak_mb'].values, step)
+        writer.add_scalars('Memory', {'max_batch_peak_mb': new_records['peak_mb'].max(),
+                                      'process_peak_rss_mb': new_records['process_peak_rss_mb'].max()}, step)
+        records = pd.read_csv(csv_path)
+        sn.set_style('darkgrid')
+        fig, ax = plt.subplots(1, 2, figsize=(15, 6.5))
+        ax[0].set_title('Peak memory per batch')
+        ax[1].set_title('Peak memory against padded length')
+        sn.histplot(data=records, x='peak_mb', hue='mode', ax=ax[0])
+        sn.scatterplot(data=records, x='padded_length', y='peak_mb', hue='mode', size='batch_size', ax=ax[1])
+        ax[0].set(xlabel='MB')
+        ax[1].set(xlabel='padded length', ylabel='MB')
+        plt.tight_layout()
+        fig.savefig(os.path.join(log_dir, 'memory.png'))
+        writer.add_figure('Memory against padded length', fig, global_step=step)
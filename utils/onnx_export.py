@@ -0,0 +1,93 @@
+import copy
+import inspect
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+class MaskedModel(nn.Module):
+    """
+    Fixes the inputs of a model that is exported to ONNX to the embeddings and the mask of the padding
+    """
+
+    def __init__(self, model: nn.Module):
+        super(MaskedModel, self).__init__()
+        self.model = model
+
+    def forward(self, x: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        return self.model(x, mask=mask)
+
+
+def export_onnx(model: nn.Module, embeddings_dim: int, path: str, per_residue: bool = True, opset: int = 17):
+    """
+    Export a model like LightAttention or FFN to ONNX with dynamic batch and sequence length axes. LightAttention is
+    exported with padded pooling because the packed and chunked pooling depend on the values of the lengths.
+    Args:
+        model: model in the format of the Solver
+        embeddings_dim: dimension of the input
+        path: .onnx file to which the graph is written
+        per_residue: whether the model takes [batch_size, embeddings_dim, sequence_length] embeddings and a
+        [batch_size, sequence_length] mask as inputs or [batch_size, embeddings_dim] reduced embeddings
+        opset: ONNX opset version
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    if hasattr(model, 'packed'):
+        model.packed = False
+    if hasattr(model, 'chunk_size'):
+        model.chunk_size = 0
+    if per_residue:
+        lengths = torch.tensor([50, 23])
+        inputs = (torch.randn(2, embeddings_dim, 50), torch.arange(50)[None, :] < lengths[:, None])
+        input_names = ['embeddings', 'mask']
+        dynamic_axes = {'embeddings': {0: 'batch_size', 2: 'sequence_length'},
+                        'mask': {0: 'batch_size', 1: 'sequence_length'}, 'logits': {0: 'batch_size'}}
+        model = MaskedModel(model)
+    else:
+        inputs = (torch.randn(2, embeddings_dim),)
+        input_names = ['embeddings']
+        dynamic_axes = {'embeddings': {0: 'batch_size'}, 'logits': {0: 'batch_size'}}
+    # the dynamo based exporter of newer torch versions does not take dynamic_axes
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(model, inputs, path, input_names=input_names, output_names=['logits'],
+                          dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True, **kwargs)
+
+
+class OnnxRuntimeModel(nn.Module):
+    """
+    Runs an exported ONNX graph with onnxruntime on the cpu and can be used in place of the model of the Solver for
+    inference
+    """
+
+    def __init__(self, path: str, num_threads: int = 0):
+        """
+        Args:
+            path: .onnx file written by export_onnx
+            num_threads: number of threads for the operators (0 for one per physical core)
+        """
+        super(OnnxRuntimeModel, self).__init__()
+        import onnxruntime  # only needed for this backend
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # the graph is a single chain of operators such that parallelism within the operators is all that is needed
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [input.name for input in self.session.get_inputs()]
+
+    def forward(self, x: torch.Tensor, mask: torch.Tensor = None, **kwargs) -> torch.Tensor:
+        """
+        Args:
+            x: [batch_size, embeddings_dim, sequence_length] or [batch_size, embeddings_dim] embedding tensor
+            mask: [batch_size, sequence_length] mask corresponding to the zero padding for per residue embeddings
+
+        Returns:
+            classification: [batch_size, output_dim] tensor with logits
+        """
+        inputs = {'embeddings': x.detach().cpu().float().numpy()}
+        if 'mask' in self.input_names:
+            inputs['mask'] = mask.cpu().numpy().astype(np.bool_)
+        return torch.from_numpy(self.session.run(['logits'], inputs)[0])
@@ -0,0 +1,71 @@
+import os
+
+import torch
+from torch.profiler import profile, schedule, ProfilerAction, ProfilerActivity
+
+
+def schedule_length(profiler_parameters: dict) -> int:
+    """
+    Returns:
+        the number of steps after which the schedule of make_profiler has recorded all of its cycles or 0 if it repeats
+        without end (repeat: 0)
+    """
+    repeat = profiler_parameters.get('repeat', 1)
+    if repeat == 0:
+        return 0
+    cycle = profiler_parameters.get('wait', 1) + profiler_parameters.get('warmup', 1) + \
+        profiler_parameters.get('active', 3)
+    return profiler_parameters.get('skip_first', 0) + repeat * cycle
+
+
+def is_recording(profiler: profile) -> bool:
+    """
+    Returns:
+        whether the next step of the profiler is in the warmup or active phase of its schedule such that everything
+        that runs before its next step ends up in the recorded cycle
+    """
+    return profiler.current_action != ProfilerAction.NONE
+
+
+def make_profiler(profiler_parameters: dict, log_dir: str, device: torch.device) -> profile:
+    """
+    Create a torch profiler that records the steps selected by a wait/warmup/active schedule with shapes and memory and
+    exports a chrome trace and operator summary tables for each recorded cycle into log_dir/profiler
+    Args:
+        profiler_parameters: dictionary with the keys of torch.profiler.schedule [wait, warmup, active, repeat,
+        skip_first] and optionally row_limit for the number of operators in the summary tables and with_stack
+        log_dir: run directory in which the profiler directory is created
+        device: if it is a cuda device the cuda activities are recorded as well
+
+    Returns:
+        the profiler which still needs to be started
+    """
+    output_dir = os.path.join(log_dir, 'profiler')
+    os.makedirs(output_dir, exist_ok=True)
+    activities = [ProfilerActivity.CPU]
+    if torch.device(device).type == 'cuda':
+        activities.append(ProfilerActivity.CUDA)
+    sort_by = 'self_cuda_time_total' if ProfilerActivity.CUDA in activities else 'self_cpu_time_total'
+    row_limit = profiler_parameters.get('row_limit', 50)
+
+    def trace_handler(prof: profile):
+        name = '{}_step_{}'.format(profiler_parameters.get('mode', 'predict'), prof.step_num)
+        prof.export_chrome_trace(os.path.join(output_dir, name + '_trace.json'))
+        with open(os.path.join(output_dir, name + '_operators.txt'), 'w') as file:
+            file.write(prof.key_averages().table(sort_by=sort_by, row_limit=row_limit))
+            file.write('\n\nGrouped by input shape:\n')
+            file.write(prof.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=row_limit))
+            file.write('\n\nSorted by memory:\n')
+            file.write(prof.key_averages().table(sort_by='self_cpu_memory_usage', row_limit=row_limit))
+        print('Saved profiler trace and operator tables to {}'.format(os.path.join(output_dir, name)))
+
+    return profile(activities=activities,
+                   schedule=schedule(wait=profiler_parameters.get('wait', 1),
+                                     warmup=profiler_parameters.get('warmup', 1),
+                                     active=profiler_parameters.get('active', 3),
+                                     repeat=profiler_parameters.get('repeat', 1),
+                                     skip_first=profiler_parameters.get('skip_first', 0)),
+                   on_trace_ready=trace_handler,
+                   record_shapes=True,
+                   profile_memory=True,
+                   with_stack=profiler_parameters.get('with_stack', False))
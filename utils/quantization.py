@@ -0,0 +1,71 @@
+import copy
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert, quantize_dynamic
+from torch.utils.data import DataLoader
+
+
+class QuantizedConvolution(nn.Module):
+    """
+    Wraps a Conv1d such that it keeps float inputs and outputs when it is statically quantized with prepare and convert.
+    The remaining operations of the model like the masking, softmax and max pooling stay in float.
+    """
+
+    def __init__(self, convolution: nn.Conv1d):
+        super(QuantizedConvolution, self).__init__()
+        self.quant = QuantStub()
+        self.convolution = convolution
+        self.dequant = DeQuantStub()
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.dequant(self.convolution(self.quant(x)))
+
+
+def default_backend() -> str:
+    return 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'fbgemm'
+
+
+def quantize_model(model: nn.Module, calibration_loader: DataLoader = None, backend: str = None) -> nn.Module:
+    """
+    Create an int8 copy of the model for inference on cpu. The Linear layers are quantized dynamically and the Conv1d
+    layers statically with the activation ranges that are observed on the batches of calibration_loader.
+    Args:
+        model: float model like LightAttention or FFN
+        calibration_loader: loader of training samples in the format of the Solver. If it is None, only the structure
+        of the quantized model is created such that a state dict that was saved from a quantized model can be loaded
+        backend: quantized engine [x86, fbgemm, qnnpack] (x86 or fbgemm by default)
+
+    Returns:
+        the quantized model in eval mode on the cpu
+    """
+    backend = backend or default_backend()
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    convolutions = [name for name, module in model.named_modules() if isinstance(module, nn.Conv1d)]
+    for name in convolutions:
+        parent_name, _, child_name = name.rpartition('.')
+        parent = model.get_submodule(parent_name) if parent_name else model
+        wrapper = QuantizedConvolution(getattr(parent, child_name))
+        wrapper.qconfig = get_default_qconfig(backend)  # only the wrapped convolutions are statically quantized
+        setattr(parent, child_name, wrapper)
+
+    if convolutions:
+        prepare(model, inplace=True)
+        if calibration_loader is not None:
+            with torch.no_grad():
+                for embedding, _, _, metadata in calibration_loader:  # record the ranges of the activations
+                    lengths = metadata['length']
+                    mask = torch.arange(lengths.max())[None, :] < lengths[:, None]
+                    model(embedding, mask=mask, sequence_lengths=lengths[:, None],
+                          frequencies=metadata['frequencies'])
+        convert(model, inplace=True)
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def has_convolutions(model: nn.Module) -> bool:
+    """
+    Returns:
+        whether the model has Conv1d layers that need to be calibrated for static quantization
+    """
+    return any(isinstance(module, nn.Conv1d) for module in model.modules())
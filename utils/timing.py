@@ -0,0 +1,104 @@
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+class PhaseTimer():
+    """
+    Low overhead wall clock timer that accumulates the time spent in named phases and counters such as the number of
+    processed samples and residues. If it is not enabled, phase returns a nullcontext and nothing is recorded.
+    """
+
+    def __init__(self, enabled: bool = True, device: torch.device = None):
+        """
+        Args:
+            enabled: whether or not to record anything
+            device: if it is a cuda device it is synchronized before reading the clock such that the asynchronously
+            launched kernels are attributed to the correct phase
+        """
+        self.enabled = enabled
+        self.synchronize = device is not None and torch.device(device).type == 'cuda'
+        self.reset()
+
+    def reset(self):
+        self.times = defaultdict(float)  # seconds spent in each phase
+        self.counts = defaultdict(int)
+
+    def phase(self, name: str):
+        """
+        Context manager that adds the time spent in its body to the phase name
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._phase(name)
+
+    @contextmanager
+    def _phase(self, name: str):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self.times[name] += time.perf_counter() - start
+
+    def iterate(self, iterable, name: str):
+        """
+        Iterate over iterable and add the time spent waiting for each item to the phase name
+        """
+        iterator = iter(iterable)
+        if not self.enabled:
+            return iterator
+        return self._iterate(iterator, name)
+
+    def _iterate(self, iterator, name: str):
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add(self, name: str, seconds: float):
+        if self.enabled:
+            self.times[name] += seconds
+
+    def count(self, name: str, n: int):
+        if self.enabled:
+            self.counts[name] += n
+
+    def summary(self) -> dict:
+        """
+        Returns:
+            dictionary with the seconds of every phase and the counts
+        """
+        return {'seconds': dict(self.times), 'counts': dict(self.counts)}
+
+
+class TimedCollate():
+    """
+    Wraps a collate function and adds the time spent in it to the phase name of the timer
+    """
+
+    def __init__(self, collate_fn, timer: PhaseTimer, name: str = 'collate'):
+        self.collate_fn = collate_fn
+        self.timer = timer
+        self.name = name
+
+    def __call__(self, batch):
+        with self.timer.phase(self.name):
+            return self.collate_fn(batch)
+
+
+def append_json_log(path: str, record: dict):
+    """
+    Append the record as one line of json to the file at path
+    """
+    with open(path, 'a') as file:
+        file.write(json.dumps(record) + '\n')